@@ -0,0 +1,161 @@
+"""
+Benchmark of text update dispatch: handler list with per-handler state and button membership filters, as bot
+registered them before, against single handler with (state, button) dispatch table (router.ButtonRouter).
+Handlers do nothing, so only finding the handler is measured. User state is preset as session middleware does
+
+Usage: python benchmarks/bench_dispatch.py [--repeat 5000] [--rounds 5]
+"""
+import argparse
+import asyncio
+import importlib
+import os
+import sys
+import time
+
+BENCHMARKS_DIR = os.path.dirname(os.path.abspath(__file__))
+sys.path.insert(0, os.path.dirname(BENCHMARKS_DIR))
+
+import load_test  # noqa: E402
+
+# (state, text) of updates: navigation, option buttons, free text falling through and unknown text
+SCENARIOS = [('BUILDING', 'next'),
+             ('BUILDING', 'cancel'),
+             ('FINISH', 'finish'),
+             ('OPTIONS', 'waypoints order'),
+             ('SET_TRANSIT_MODE', 'bus'),
+             ('SET_ORIGIN', 'Red Square'),
+             ('START', 'hello')]
+
+
+async def handle(message):
+    pass
+
+
+async def handle_button(message, route):
+    pass
+
+
+def register_common_head(dp):
+    dp.register_message_handler(handle, commands=['start'])
+    dp.register_message_handler(handle, commands=['help'], state='*')
+
+
+def register_common_tail(dp, bot_module):
+    from aiogram import types
+
+    states = bot_module.UserStates
+    for state in (states.SET_ORIGIN, states.SET_DESTINATION, states.SET_WAYPOINTS):
+        dp.register_message_handler(handle, state=state,
+                                    content_types=[types.ContentType.TEXT, types.ContentType.LOCATION])
+    dp.register_message_handler(handle, content_types=types.ContentType.LOCATION, state=states.BUILDING)
+
+
+def legacy_dispatcher(bot_module):
+    """
+    Handlers registered one per keyboard, each with its own button membership filter
+    """
+    from aiogram.dispatcher import Dispatcher
+    import config
+    import keyboard
+
+    states = bot_module.UserStates
+    dp = Dispatcher(bot_module.bot)
+    register_common_head(dp)
+    dp.register_message_handler(handle, commands=['transport'], state=states.START)
+    dp.register_message_handler(handle, lambda message: message.text in keyboard.OPTION_BUTTONS['mode'],
+                                state=states.TRAVEL_MODE)
+    dp.register_message_handler(handle, commands=['options'], state=states.START)
+    dp.register_message_handler(handle, lambda message: message.text in keyboard.OPTION_BUTTONS['options'],
+                                state=states.OPTIONS)
+    for name in ('units', 'traffic_model', 'transit_routing_preference', 'waypoints_order', 'avoid',
+                 'transit_mode'):
+        dp.register_message_handler(handle, lambda message, name=name: message.text in keyboard.OPTION_BUTTONS[name],
+                                    state=bot_module.PARAMETER_STATES[name])
+    dp.register_message_handler(handle, lambda message: message.text == 'cancel', state='*')
+    dp.register_message_handler(handle, commands=['go'], state=states.START)
+    register_common_tail(dp, bot_module)
+    dp.register_message_handler(handle, lambda message: message.text in keyboard.PATHFINDER_BUTTONS['start'],
+                                state=states.CONFIRMATION)
+    dp.register_message_handler(handle, lambda message: message.text in keyboard.PATHFINDER_BUTTONS['navigation'],
+                                state=states.BUILDING)
+    dp.register_message_handler(handle, lambda message: message.text in keyboard.PATHFINDER_BUTTONS['finish'],
+                                state=states.FINISH)
+    dp.register_message_handler(handle, commands=['profile'], user_id=config.ADMIN_IDS, state='*')
+    dp.register_message_handler(handle, state='*')
+    return dp
+
+
+def table_dispatcher(bot_module):
+    """
+    Handlers as registered by bot now: all buttons go through button_router dispatch table
+    """
+    from aiogram.dispatcher import Dispatcher
+    import config
+
+    states = bot_module.UserStates
+    dp = Dispatcher(bot_module.bot)
+    register_common_head(dp)
+    dp.register_message_handler(handle, commands=['transport'], state=states.START)
+    dp.register_message_handler(handle_button, bot_module.button_router.filter, state='*')
+    dp.register_message_handler(handle, commands=['options'], state=states.START)
+    dp.register_message_handler(handle, commands=['go'], state=states.START)
+    register_common_tail(dp, bot_module)
+    dp.register_message_handler(handle, commands=['profile'], user_id=config.ADMIN_IDS, state='*')
+    dp.register_message_handler(handle, state='*')
+    return dp
+
+
+async def measure(dp, message, state, repeat):
+    """
+    :return: float, seconds per update
+    """
+    from aiogram.dispatcher.filters.builtin import StateFilter
+
+    started = time.perf_counter()
+    for _ in range(repeat):
+        StateFilter.ctx_state.set(state)
+        await dp.message_handlers.notify(message)
+    return (time.perf_counter() - started) / repeat
+
+
+async def run(args):
+    os.environ.update(TG_TOKEN=load_test.FAKE_TOKEN, GMAPS_TOKEN='fake')
+    from aiogram import Bot, types
+    from aiogram.dispatcher import Dispatcher
+    bot_module = importlib.import_module('ivan_susanin_bot')
+    legacy, table = legacy_dispatcher(bot_module), table_dispatcher(bot_module)
+    Bot.set_current(bot_module.bot)
+
+    print('{} routes in dispatch table, best of {} rounds of {} updates'.format(len(bot_module.button_router),
+                                                                               args.rounds, args.repeat))
+    print('{:<36} {:>10} {:>10} {:>9}'.format('state / text', 'chain us', 'table us', 'speedup'))
+    totals = [0, 0]
+    for state_name, text in SCENARIOS:
+        message = load_test.make_update(1, 1, text).message
+        # Set by dispatcher for every update, "*" state filter needs them
+        types.Chat.set_current(message.chat)
+        types.User.set_current(message.from_user)
+        state = getattr(bot_module.UserStates, state_name).state
+        times = []
+        for dp in (legacy, table):
+            Dispatcher.set_current(dp)
+            # Best round: the least disturbed by the rest of the system
+            times.append(min([await measure(dp, message, state, args.repeat) for _ in range(args.rounds)]))
+        totals = [total + value for total, value in zip(totals, times)]
+        print('{:<36} {:>10.1f} {:>10.1f} {:>8.1f}x'.format('{} / {}'.format(state_name, text), times[0] * 10 ** 6,
+                                                            times[1] * 10 ** 6, times[0] / times[1]))
+    print('{:<36} {:>10.1f} {:>10.1f} {:>8.1f}x'.format('mean', totals[0] / len(SCENARIOS) * 10 ** 6,
+                                                        totals[1] / len(SCENARIOS) * 10 ** 6, totals[0] / totals[1]))
+    await bot_module.dp.bot.session.close()
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Update dispatch benchmark')
+    parser.add_argument('--repeat', type=int, default=5000, help='updates per round')
+    parser.add_argument('--rounds', type=int, default=5, help='rounds per scenario and dispatcher')
+    args = parser.parse_args()
+    asyncio.get_event_loop().run_until_complete(run(args))
+
+
+if __name__ == '__main__':
+    main()
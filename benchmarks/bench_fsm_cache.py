@@ -0,0 +1,144 @@
+"""
+Benchmark of in-process user state cache on navigation loop: chats build a route, then press next/previous
+against real dispatcher and handlers with cache off and on. Telegram and Google Maps are replaced with local
+fake servers (see fake_servers.py), Redis is fakeredis with simulated network latency per round trip
+
+Usage: python benchmarks/bench_fsm_cache.py [--chats 50] [--presses 20] [--concurrency 1]
+                                            [--redis-latency 0.0005] [--telegram-delay 0]
+"""
+import argparse
+import asyncio
+import importlib
+import os
+import sys
+import tempfile
+import time
+
+BENCHMARKS_DIR = os.path.dirname(os.path.abspath(__file__))
+sys.path.insert(0, os.path.dirname(BENCHMARKS_DIR))
+
+import fake_servers  # noqa: E402
+import load_test  # noqa: E402
+
+
+def add_latency(redis, latency):
+    """
+    Makes every command and pipeline of connection wait for latency seconds, as if Redis was over network
+    """
+    execute, pipeline, multi_exec = redis.execute, redis.pipeline, redis.multi_exec
+
+    async def delayed_execute(*args, **kwargs):
+        await asyncio.sleep(latency)
+        return await execute(*args, **kwargs)
+
+    def delayed(factory):
+        def create():
+            pipe = factory()
+            pipe_execute = pipe.execute
+
+            async def delayed_pipe_execute(**kwargs):
+                await asyncio.sleep(latency)
+                return await pipe_execute(**kwargs)
+            pipe.execute = delayed_pipe_execute
+            return pipe
+        return create
+
+    redis.execute = delayed_execute
+    redis.pipeline, redis.multi_exec = delayed(pipeline), delayed(multi_exec)
+    return redis
+
+
+async def run(args):
+    telegram = fake_servers.FakeTelegram(delay=args.telegram_delay)
+    google = fake_servers.FakeGoogleMaps(delay=0)
+    telegram_runner, telegram_url = await fake_servers.start_server(telegram.create_app())
+    google_runner, google_url = await fake_servers.start_server(google.create_app())
+
+    # Bot reads configuration on import
+    os.environ.update(TG_TOKEN=load_test.FAKE_TOKEN,
+                      TG_API_SERVER=telegram_url,
+                      GMAPS_TOKEN='fake',
+                      GMAPS_API_BASE=google_url,
+                      STREET_VIEW_PREFETCH_STEPS='0',
+                      STREET_VIEW_CACHE_DIR=tempfile.mkdtemp(prefix='bench_fsm_cache_street_view_'),
+                      TELEGRAM_RATE='0',
+                      TELEGRAM_CHAT_RATE='0')
+    from aiogram import Bot
+    from aiogram.dispatcher import Dispatcher
+    import fakeredis.aioredis
+    import fsm_storage
+    bot_module = importlib.import_module('ivan_susanin_bot')
+    dp = bot_module.dp
+    storage = bot_module.redis_storage
+    storage._redis = add_latency(await fakeredis.aioredis.create_redis_pool(), args.redis_latency)
+    Bot.set_current(dp.bot)
+    Dispatcher.set_current(dp)
+
+    update_ids = iter(range(1, 10 ** 9))
+    results = {}
+    for mode in ('off', 'on'):
+        storage.cache = fsm_storage.StateCache(storage.redis, max_entries=args.chats) if mode == 'on' else None
+        chats = range(len(results) * args.chats + 1, (len(results) + 1) * args.chats + 1)
+        for chat in chats:
+            for text in load_test.chat_script(chat, 0):
+                await dp.updates_handler.notify(load_test.make_update(next(update_ids), chat, text))
+
+        sessions = bot_module.session_middleware
+        updates_before, round_trips_before = sessions.updates, sessions.round_trips
+        latencies = []
+        semaphore = asyncio.Semaphore(args.concurrency)
+
+        async def press(chat):
+            async with semaphore:
+                await press_buttons(chat)
+
+        async def press_buttons(chat):
+            for number in range(args.presses):
+                update = load_test.make_update(next(update_ids), chat, 'next' if number % 2 == 0 else 'previous')
+                started = time.perf_counter()
+                await dp.updates_handler.notify(update)
+                latencies.append(time.perf_counter() - started)
+
+        started = time.perf_counter()
+        await asyncio.gather(*[press(chat) for chat in chats])
+        elapsed = time.perf_counter() - started
+        round_trips = (sessions.round_trips - round_trips_before) / (sessions.updates - updates_before)
+        latencies.sort()
+        results[mode] = {'throughput': len(latencies) / elapsed,
+                         'p50': load_test.percentile(latencies, 50) * 1000,
+                         'p95': load_test.percentile(latencies, 95) * 1000,
+                         'p99': load_test.percentile(latencies, 99) * 1000,
+                         'state_round_trips': round_trips,
+                         'cache': storage.cache.stats if storage.cache is not None else None}
+        if storage.cache is not None:
+            storage.cache.close()
+
+    print('process_path x {}: {} chats, {} at once, Redis latency {:.2f} ms'.format(
+        args.presses, args.chats, args.concurrency, args.redis_latency * 1000))
+    print('{:<6} {:>12} {:>9} {:>9} {:>9} {:>18}'.format('cache', 'updates/s', 'p50 ms', 'p95 ms', 'p99 ms',
+                                                         'state round trips'))
+    for mode, result in results.items():
+        print('{:<6} {:>12.1f} {:>9.2f} {:>9.2f} {:>9.2f} {:>18.2f}'.format(
+            mode, result['throughput'], result['p50'], result['p95'], result['p99'], result['state_round_trips']))
+    print('Cache: {}'.format(results['on']['cache']))
+
+    storage.cache = None
+    await bot_module.shutdown(dp)
+    await dp.bot.session.close()
+    await telegram_runner.cleanup()
+    await google_runner.cleanup()
+
+
+def main():
+    parser = argparse.ArgumentParser(description='User state cache benchmark')
+    parser.add_argument('--chats', type=int, default=50)
+    parser.add_argument('--presses', type=int, default=20, help='navigation buttons pressed by each chat')
+    parser.add_argument('--concurrency', type=int, default=1, help='chats navigating at once')
+    parser.add_argument('--redis-latency', type=float, default=0.0005, help='Redis round trip time, seconds')
+    parser.add_argument('--telegram-delay', type=float, default=0, help='fake Bot API response delay, seconds')
+    args = parser.parse_args()
+    asyncio.get_event_loop().run_until_complete(run(args))
+
+
+if __name__ == '__main__':
+    main()
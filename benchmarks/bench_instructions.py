@@ -0,0 +1,90 @@
+"""
+Micro-benchmark of step messages rendering: previous two-pass re.sub instructions processing
+and per-press rendering against table lookup of tags and route build stage rendering.
+
+Build stage rendering is paid for every step of the route, including steps user never looks at,
+and each press then only looks up the ready message. It pays off when build stage rendering of step
+costs less than legacy rendering times number of presses showing the step
+
+Usage: python benchmarks/bench_instructions.py [number of repetitions]
+"""
+import os
+import re
+import sys
+import timeit
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import messages  # noqa: E402
+import routes  # noqa: E402
+
+INSTRUCTIONS = ['Head <b>north</b> on <b>Tverskaya St</b> toward <b>Kamergersky Ln</b>',
+                'Turn <b>right</b> onto <b>Okhotny Ryad</b><div style="font-size:0.9em">Pass by '
+                '<span class="location">Bolshoi Theatre</span> (on the left)</div>',
+                'Take the ramp to <b>Leningradskoye Hwy</b><div style="font-size:0.9em">Toll road</div>',
+                'Walk to Teatralnaya']
+
+STEP = {'html_instructions': INSTRUCTIONS[1],
+        'distance': {'text': '0.4 km'},
+        'duration': {'text': '5 mins'},
+        'start_location': {'lat': 55.7575, 'lng': 37.6131},
+        'end_location': {'lat': 55.7601, 'lng': 37.6186},
+        'steps': [{'html_instructions': instructions, 'distance': {'text': '0.1 km'}}
+                  for instructions in INSTRUCTIONS],
+        'transit_details': {'departure_stop': {'name': 'Teatralnaya'},
+                            'arrival_stop': {'name': 'Belorusskaya'},
+                            'line': {'short_name': '2'}}}
+
+
+def legacy_process_instructions(current_step):
+    """
+    Instructions processing as it was done before single-pass translator
+    """
+    div_tag_regexp = '<div.*?>'
+    instructions = re.sub(div_tag_regexp, '. <b>', current_step.get("html_instructions", 'Go').replace('/div', '/b'))
+    span_tag_regexp = '<span.*?>'
+    instructions = re.sub(span_tag_regexp, '<i>', instructions.replace('/span', '/i'))
+    return instructions
+
+
+def legacy_reply_message(current_step):
+    """
+    Step message rendering as it was done on each navigation press
+    """
+    message = '{}\nDistance: <b>{}</b>\nDuration: <b>{}</b>'.format(legacy_process_instructions(current_step),
+                                                                    current_step["distance"]["text"],
+                                                                    current_step["duration"]["text"])
+    if 'steps' in current_step:
+        message += '\n' + '\n'.join(['{} (<b>{}</b>)'.format(legacy_process_instructions(step),
+                                                            step["distance"]["text"])
+                                     for step in current_step['steps']])
+    if 'transit_details' in current_step:
+        transit_details_all = current_step['transit_details']
+        message += '\n' + 'From: <b>{}</b>\nTo: <b>{}</b>\nBus: <b>{}</b>'.format(
+            transit_details_all['departure_stop']['name'],
+            transit_details_all['arrival_stop']['name'],
+            transit_details_all['line']['short_name'])
+    return message
+
+
+def report(name, function, number):
+    # Best of 5 rounds, so other load of machine affects result less
+    seconds = min(timeit.repeat(function, number=number, repeat=5))
+    print('{:<45} {:>10.2f} us/call'.format(name, seconds / number * 1e6))
+
+
+def main():
+    number = int(sys.argv[1]) if len(sys.argv) > 1 else 20000
+    steps = [{'html_instructions': instructions} for instructions in INSTRUCTIONS]
+    record = routes.compact_step(STEP)
+
+    report('legacy instructions (4 strings)', lambda: [legacy_process_instructions(step) for step in steps], number)
+    report('table lookup instructions (4 strings)',
+           lambda: [messages.process_instructions(step['html_instructions']) for step in steps], number)
+    report('legacy per-press rendering', lambda: legacy_reply_message(STEP), number)
+    report('build stage rendering (every step of route)', lambda: routes.compact_step(STEP), number)
+    report('per-press lookup of rendered message', lambda: record['m'], number)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,135 @@
+"""
+Benchmark of offline routing: OSM extract preprocessing, memory-mapped graph startup and route queries
+by travel mode. Without --osm a synthetic city is generated: square grid of streets ~100 m apart
+with avenues, oneway streets, a toll motorway and a ferry
+
+Usage:
+    python benchmarks/bench_local_routing.py [--osm EXTRACT.osm] [--grid 250] [--queries 50] [--seed 1]
+"""
+import argparse
+import os
+import random
+import sys
+import tempfile
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import routing  # noqa: E402
+
+ORIGIN = (55.70, 37.50)
+SPACING = 0.0009  # degrees, ~100 m of latitude
+PERCENTILES = (50, 95, 99)
+
+
+def write_grid_city(path, size):
+    """
+    Writes synthetic OSM XML city: size x size junctions, each block edge has one intermediate node
+    """
+    lng_spacing = SPACING / 0.56  # ~100 m of longitude at 56 degrees of latitude
+    step = 2 * size - 1  # nodes per street including intermediate ones
+
+    def node_id(row, column):
+        # Row and column in half-block units
+        return row * step + column + 1
+
+    with open(path, 'w') as file:
+        file.write('<?xml version="1.0" encoding="UTF-8"?>\n<osm version="0.6">\n')
+        for row in range(step):
+            for column in range(step):
+                if row % 2 and column % 2:
+                    continue
+                file.write('<node id="{}" lat="{:.7f}" lon="{:.7f}"/>\n'.format(
+                    node_id(row, column), ORIGIN[0] + row * SPACING / 2, ORIGIN[1] + column * lng_spacing / 2))
+
+        way = 0
+        for number in range(size):
+            for horizontal in (True, False):
+                way += 1
+                if horizontal:
+                    refs = [node_id(2 * number, column) for column in range(step)]
+                    name = 'Street {}'.format(number + 1)
+                else:
+                    refs = [node_id(row, 2 * number) for row in range(step)]
+                    name = 'Avenue {}'.format(number + 1)
+                tags = {'name': name, 'highway': 'primary' if number % 10 == 0 else 'residential'}
+                if number == size // 2 and horizontal:
+                    tags.update(highway='motorway', toll='yes', oneway='no')
+                elif number % 3 == 1:
+                    tags['oneway'] = 'yes' if number % 2 else '-1'
+                file.write('<way id="{}">{}{}</way>\n'.format(
+                    way, ''.join('<nd ref="{}"/>'.format(ref) for ref in refs),
+                    ''.join('<tag k="{}" v="{}"/>'.format(key, value) for key, value in tags.items())))
+
+        file.write('<way id="{}"><nd ref="{}"/><nd ref="{}"/><tag k="route" v="ferry"/>'
+                   '<tag k="name" v="River ferry"/></way>\n'.format(way + 1, node_id(0, 0),
+                                                                    node_id(step - 1, step - 1)))
+        file.write('</osm>\n')
+
+
+def percentile(values, rank):
+    values = sorted(values)
+    return values[min(len(values) - 1, max(0, int(round(rank / 100 * len(values))) - 1))]
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Offline routing benchmark')
+    parser.add_argument('--osm', help='OSM XML extract (synthetic grid city if not set)')
+    parser.add_argument('--grid', type=int, default=250, help='synthetic city size in blocks')
+    parser.add_argument('--queries', type=int, default=50, help='routes per travel mode')
+    parser.add_argument('--seed', type=int, default=1)
+    args = parser.parse_args()
+    random.seed(args.seed)
+
+    with tempfile.TemporaryDirectory(prefix='bench_local_routing_') as directory:
+        osm_path = args.osm
+        if osm_path is None:
+            osm_path = os.path.join(directory, 'city.osm')
+            started = time.perf_counter()
+            write_grid_city(osm_path, args.grid)
+            print('Synthetic city {0}x{0} written in {1:.1f} s ({2:.1f} MB)'.format(
+                args.grid, time.perf_counter() - started, os.path.getsize(osm_path) / 2 ** 20))
+
+        started = time.perf_counter()
+        ways, coords = routing.read_osm(osm_path)
+        parsed = time.perf_counter()
+        arrays, names = routing.build_graph(ways, coords)
+        built = time.perf_counter()
+        graph_path = os.path.join(directory, 'graph')
+        routing.save_graph(graph_path, arrays, names)
+        size = sum(os.path.getsize(os.path.join(graph_path, name)) for name in os.listdir(graph_path))
+        print('Parsed {} ways, {} nodes in {:.1f} s, graph built in {:.1f} s: {} vertices, {} edges, {:.1f} MB'.format(
+            len(ways), len(coords), parsed - started, built - parsed, len(arrays['vertex_lat']),
+            len(arrays['targets']), size / 2 ** 20))
+        del ways, coords, arrays
+
+        started = time.perf_counter()
+        router = routing.LocalRouter(graph_path, workers=1)
+        print('Memory-mapped graph loaded in {:.1f} ms'.format((time.perf_counter() - started) * 1000))
+
+        lat, lng = router.graph.arrays['vertex_lat'], router.graph.arrays['vertex_lng']
+        print('{:<24} {:>8} {:>9} {:>9} {:>9} {:>7}'.format('mode', 'found', 'p50 ms', 'p95 ms', 'p99 ms', 'steps'))
+        for mode, avoid in (('driving', ''), ('driving', 'tolls|highways|ferries'), ('walking', ''),
+                            ('bicycling', '')):
+            # First query of each mode also finds vertices open to it
+            router.graph.mode_vertices(routing.MODE_ACCESS[mode])
+            timings, found, steps = [], 0, 0
+            for _ in range(args.queries):
+                source, target = random.randrange(len(lat)), random.randrange(len(lat))
+                payload = {'origin': '{},{}'.format(lat[source], lng[source]),
+                           'destination': '{},{}'.format(lat[target], lng[target]),
+                           'mode': mode, 'avoid': avoid, 'units': 'metric'}
+                started = time.perf_counter()
+                result = router.route(payload)
+                timings.append(time.perf_counter() - started)
+                if result['status'] == 'OK':
+                    found += 1
+                    steps += len(result['routes'][0]['legs'][0]['steps'])
+            print('{:<24} {:>8} {:>9.1f} {:>9.1f} {:>9.1f} {:>7.1f}'.format(
+                mode + (' avoid' if avoid else ''), '{}/{}'.format(found, args.queries),
+                *[percentile(timings, rank) * 1000 for rank in PERCENTILES], steps / max(found, 1)))
+        router.close()
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,91 @@
+"""
+Benchmark of many-waypoint routes: local waypoint ordering (NumPy distance matrix, nearest neighbour + 2-opt)
+and chunked Directions requests made concurrently against one after another.
+Directions API is simulated by recorded response returned after fixed delay
+
+Usage: python benchmarks/bench_waypoints.py [--sizes 10 25 100] [--delay 0.1] [--repeat 5] [--seed 1]
+"""
+import argparse
+import asyncio
+import json
+import os
+import random
+import sys
+import time
+
+BENCHMARKS_DIR = os.path.dirname(os.path.abspath(__file__))
+sys.path.insert(0, os.path.dirname(BENCHMARKS_DIR))
+
+import geo  # noqa: E402
+import planner  # noqa: E402
+
+# Moscow within the Garden Ring and around
+BOUNDS = ((55.70, 37.50), (55.80, 37.72))
+
+
+def random_point():
+    return (random.uniform(BOUNDS[0][0], BOUNDS[1][0]), random.uniform(BOUNDS[0][1], BOUNDS[1][1]))
+
+
+def path_length(points):
+    return float(geo.distances(points[:-1], points[1:]).sum())
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Many-waypoint routes benchmark')
+    parser.add_argument('--sizes', type=int, nargs='+', default=[10, 25, 100], help='numbers of waypoints')
+    parser.add_argument('--delay', type=float, default=0.1, help='simulated Directions API delay, seconds')
+    parser.add_argument('--repeat', type=int, default=5, help='routes per size')
+    parser.add_argument('--seed', type=int, default=1)
+    args = parser.parse_args()
+    random.seed(args.seed)
+
+    with open(os.path.join(BENCHMARKS_DIR, 'fixtures', 'directions.json')) as file:
+        fixture = json.load(file)
+
+    async def directions(payload):
+        await asyncio.sleep(args.delay)
+        return fixture
+
+    async def sequential(payload):
+        # Chunks requested one after another: what concurrent requests are compared to
+        waypoints = payload['waypoints'].split('|')
+        chunks = planner.split_stops([payload['origin']] + waypoints + [payload['destination']])
+        return planner.merge_directions([await directions(dict(payload, origin=chunk[0], destination=chunk[-1],
+                                                                waypoints='|'.join(chunk[1:-1])))
+                                         for chunk in chunks])
+
+    loop = asyncio.get_event_loop()
+    print('{:>9} {:>12} {:>13} {:>13} {:>7} {:>14} {:>14}'.format(
+        'waypoints', 'ordering ms', 'typed km', 'ordered km', 'chunks', 'sequential ms', 'concurrent ms'))
+    for size in args.sizes:
+        ordering, typed, ordered, sequential_time, concurrent_time = 0, 0, 0, 0, 0
+        for _ in range(args.repeat):
+            origin, destination = random_point(), random_point()
+            waypoints = [random_point() for _ in range(size)]
+
+            started = time.perf_counter()
+            order = planner.order_waypoints(origin, destination, waypoints)
+            ordering += time.perf_counter() - started
+            typed += path_length([origin] + waypoints + [destination])
+            ordered += path_length([origin] + [waypoints[index] for index in order] + [destination])
+
+            payload = {'origin': '{},{}'.format(*origin), 'destination': '{},{}'.format(*destination),
+                       'waypoints': '|'.join('{},{}'.format(*waypoints[index]) for index in order),
+                       'mode': 'driving'}
+            started = time.perf_counter()
+            result = loop.run_until_complete(sequential(payload))
+            sequential_time += time.perf_counter() - started
+            started = time.perf_counter()
+            result = loop.run_until_complete(planner.chunked_directions(payload, directions))
+            concurrent_time += time.perf_counter() - started
+            assert result['status'] == 'OK'
+
+        print('{:>9} {:>12.2f} {:>13.1f} {:>13.1f} {:>7} {:>14.0f} {:>14.0f}'.format(
+            size, ordering / args.repeat * 1000, typed / args.repeat / 1000, ordered / args.repeat / 1000,
+            len(planner.split_stops([None] * (size + 2))), sequential_time / args.repeat * 1000,
+            concurrent_time / args.repeat * 1000))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,126 @@
+"""
+Local stand-ins of Telegram Bot API and Google Maps used by load tests.
+Both answer after configurable delay and count calls by method
+"""
+import asyncio
+import collections
+import hashlib
+import itertools
+import json
+import os
+import time
+
+from aiohttp import web
+
+FIXTURES_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'fixtures')
+
+# Smallest valid JPEG: Street View responses only have to be non-empty bytes
+FAKE_IMAGE = bytes.fromhex('ffd8ffe000104a46494600010100000100010000ffdb004300') + bytes(64) + bytes.fromhex('ffd9')
+
+
+class FakeTelegram:
+    """
+    Bot API endpoint answering every method with plausible result
+    """
+
+    def __init__(self, delay=0.0):
+        """
+        :param delay: response delay in seconds
+        """
+        self.delay = delay
+        self.calls = collections.Counter()
+        self._message_ids = itertools.count(1)
+        self._file_ids = itertools.count(1)
+
+    def _message(self, chat, **fields):
+        return dict({'message_id': next(self._message_ids),
+                     'date': int(time.time()),
+                     'chat': {'id': chat, 'type': 'private'},
+                     'from': {'id': 1, 'is_bot': True, 'first_name': 'Ivan Susanin'}},
+                    **fields)
+
+    async def handle(self, request: web.Request):
+        method = request.match_info['method']
+        data = await request.post()
+        self.calls[method] += 1
+        if self.delay:
+            await asyncio.sleep(self.delay)
+
+        chat = int(data.get('chat_id') or 0)
+        if method in ('sendMessage', 'editMessageText'):
+            result = self._message(chat, text=data.get('text', ''))
+        elif method == 'sendPhoto':
+            file_id = 'fake-photo-{}'.format(next(self._file_ids))
+            result = self._message(chat, photo=[{'file_id': file_id, 'file_unique_id': file_id,
+                                                 'width': 600, 'height': 400}])
+        elif method == 'getMe':
+            result = {'id': 1, 'is_bot': True, 'first_name': 'Ivan Susanin', 'username': 'fake_bot'}
+        else:
+            result = True
+        return web.json_response({'ok': True, 'result': result})
+
+    def create_app(self):
+        app = web.Application()
+        app.router.add_post('/bot{token}/{method}', self.handle)
+        return app
+
+
+class FakeGoogleMaps:
+    """
+    Directions, Geocoding and Street View endpoints serving recorded or synthetic responses
+    """
+
+    def __init__(self, delay=0.0, directions_fixture='directions.json'):
+        """
+        :param delay: response delay in seconds
+        :param directions_fixture: file name of recorded Directions response in fixtures directory
+        """
+        self.delay = delay
+        self.calls = collections.Counter()
+        with open(os.path.join(FIXTURES_DIR, directions_fixture), 'rb') as file:
+            self.directions_body = file.read()
+        json.loads(self.directions_body)  # fixture must be valid JSON
+
+    async def directions(self, request: web.Request):
+        self.calls['directions'] += 1
+        if self.delay:
+            await asyncio.sleep(self.delay)
+        return web.Response(body=self.directions_body, content_type='application/json')
+
+    async def geocode(self, request: web.Request):
+        self.calls['geocoding'] += 1
+        if self.delay:
+            await asyncio.sleep(self.delay)
+        # Different addresses resolve to different points around Moscow center
+        digest = hashlib.sha1(request.query.get('address', '').encode()).digest()
+        location = {'lat': 55.70 + digest[0] / 2560, 'lng': 37.50 + digest[1] / 1280}
+        return web.json_response({'status': 'OK', 'results': [{'geometry': {'location': location}}]})
+
+    async def street_view(self, request: web.Request):
+        self.calls['street_view'] += 1
+        if self.delay:
+            await asyncio.sleep(self.delay)
+        return web.Response(body=FAKE_IMAGE, content_type='image/jpeg')
+
+    def create_app(self):
+        app = web.Application()
+        app.router.add_get('/maps/api/directions/json', self.directions)
+        app.router.add_get('/maps/api/geocode/json', self.geocode)
+        app.router.add_get('/maps/api/streetview', self.street_view)
+        return app
+
+
+async def start_server(app, host='127.0.0.1', port=0):
+    """
+    Starts application in running event loop
+    :param app: aiohttp application
+    :param host: listening host
+    :param port: listening port (0 - any free port)
+    :return: tuple (runner to be cleaned up, base url)
+    """
+    runner = web.AppRunner(app, access_log=None)
+    await runner.setup()
+    site = web.TCPSite(runner, host, port)
+    await site.start()
+    port = site._server.sockets[0].getsockname()[1]
+    return runner, 'http://{}:{}'.format(host, port)
@@ -0,0 +1,279 @@
+"""
+Load test of the bot: synthetic chats go through /start -> /go -> origin -> destination -> waypoint -> skip ->
+start -> next x N against real dispatcher and handlers ("next" is reply keyboard button unless --navigation inline).
+Telegram and Google Maps are replaced with local fake servers (see fake_servers.py), state is kept in local Redis
+(REDIS_URL) or in fakeredis.
+
+Reports throughput, p50/p95/p99 latency per handler and Redis commands per update. Results are saved as JSON
+named after current commit, so runs of different commits can be compared
+
+Usage:
+    python benchmarks/load_test.py [--chats 100] [--steps 10] [--concurrency 100]
+                                   [--telegram-delay 0.03] [--google-delay 0.1] [--fake-redis] [--flush]
+                                   [--navigation reply|inline]
+    python benchmarks/load_test.py --compare results/OLD.json results/NEW.json
+"""
+import argparse
+import asyncio
+import collections
+import importlib
+import json
+import os
+import random
+import subprocess
+import sys
+import tempfile
+import time
+
+BENCHMARKS_DIR = os.path.dirname(os.path.abspath(__file__))
+sys.path.insert(0, os.path.dirname(BENCHMARKS_DIR))
+
+import fake_servers  # noqa: E402
+
+RESULTS_DIR = os.path.join(BENCHMARKS_DIR, 'results')
+FAKE_TOKEN = '123456789:AAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAA'
+PERCENTILES = (50, 95, 99)
+
+
+def percentile(values, rank):
+    """
+    :param values: sorted list of values
+    :param rank: percentile rank (0-100)
+    :return: nearest-rank percentile
+    """
+    if not values:
+        return 0
+    return values[min(len(values) - 1, max(0, int(round(rank / 100 * len(values))) - 1))]
+
+
+def chat_script(chat, steps):
+    """
+    Texts sent by single chat during load test
+    """
+    return ['/start', '/go', 'Origin {}'.format(chat), 'Destination {}'.format(chat), 'Waypoint {}'.format(chat),
+            'skip', 'start'] + ['next'] * steps
+
+
+def make_update(update_id, chat, text):
+    from aiogram import types
+
+    return types.Update(**{'update_id': update_id,
+                           'message': {'message_id': update_id,
+                                       'date': int(time.time()),
+                                       'chat': {'id': chat, 'type': 'private'},
+                                       'from': {'id': chat, 'is_bot': False, 'first_name': 'Load test'},
+                                       'text': text}})
+
+
+def make_button_update(update_id, chat, data, message_id=1):
+    """
+    Inline button pressed under bot message
+    """
+    from aiogram import types
+
+    return types.Update(**{'update_id': update_id,
+                           'callback_query': {'id': str(update_id),
+                                              'chat_instance': str(chat),
+                                              'from': {'id': chat, 'is_bot': False, 'first_name': 'Load test'},
+                                              'data': data,
+                                              'message': {'message_id': message_id,
+                                                          'date': int(time.time()),
+                                                          'chat': {'id': chat, 'type': 'private'},
+                                                          'from': {'id': 1, 'is_bot': True,
+                                                                   'first_name': 'Ivan Susanin'},
+                                                          'text': 'step'}}})
+
+
+async def redis_command_calls(redis):
+    """
+    :return: total number of commands processed by Redis server (None if server does not report it)
+    """
+    try:
+        info = await redis.execute(b'INFO', b'commandstats', encoding='utf8')
+    except Exception:
+        return None
+    return sum(int(line.split('calls=')[1].split(',')[0]) for line in info.splitlines() if 'calls=' in line)
+
+
+def git_revision():
+    try:
+        revision = subprocess.check_output(['git', 'rev-parse', '--short', 'HEAD'], cwd=BENCHMARKS_DIR,
+                                           stderr=subprocess.DEVNULL).decode().strip()
+        dirty = subprocess.call(['git', 'diff', '--quiet', 'HEAD'], cwd=BENCHMARKS_DIR) != 0
+    except (OSError, subprocess.CalledProcessError):
+        return 'unknown'
+    return revision + ('-dirty' if dirty else '')
+
+
+async def run(args):
+    telegram = fake_servers.FakeTelegram(delay=args.telegram_delay)
+    google = fake_servers.FakeGoogleMaps(delay=args.google_delay)
+    telegram_runner, telegram_url = await fake_servers.start_server(telegram.create_app())
+    google_runner, google_url = await fake_servers.start_server(google.create_app())
+
+    # Bot reads configuration on import
+    os.environ.update(TG_TOKEN=FAKE_TOKEN,
+                      TG_API_SERVER=telegram_url,
+                      GMAPS_TOKEN='fake',
+                      GMAPS_API_BASE=google_url,
+                      STREET_VIEW_CACHE_DIR=tempfile.mkdtemp(prefix='load_test_street_view_'),
+                      NAVIGATION_KEYBOARD=args.navigation)
+    # Fake Bot API has no flood control: outgoing messages are not throttled unless limits are given
+    os.environ.setdefault('TELEGRAM_RATE', '0')
+    os.environ.setdefault('TELEGRAM_CHAT_RATE', '0')
+    from aiogram import Bot
+    from aiogram.dispatcher import Dispatcher
+    from aiogram.dispatcher.middlewares import BaseMiddleware
+    bot_module = importlib.import_module('ivan_susanin_bot')
+    import router
+    dp = bot_module.dp
+
+    if args.fake_redis:
+        import fakeredis.aioredis
+        bot_module.redis_storage._redis = await fakeredis.aioredis.create_redis_pool()
+    redis = await bot_module.redis_storage.redis()
+    if args.flush:
+        await redis.flushdb()
+
+    handlers = {}
+
+    class HandlerProbe(BaseMiddleware):
+        # Remembers handler chosen for each update
+        async def on_process_message(self, message, data):
+            handlers[message.message_id] = router.handler_name(data)
+
+        async def on_process_callback_query(self, query, data):
+            handlers[int(query.id)] = router.handler_name(data)
+
+    dp.middleware.setup(HandlerProbe())
+    Bot.set_current(dp.bot)
+    Dispatcher.set_current(dp)
+
+    update_ids = iter(range(1, 10 ** 9))
+    chat_offset = random.randrange(10 ** 6, 10 ** 9)
+    latencies = collections.defaultdict(list)
+    semaphore = asyncio.Semaphore(args.concurrency)
+
+    import keyboard
+
+    async def run_chat(chat):
+        async with semaphore:
+            for text in chat_script(chat, args.steps):
+                if text == 'next' and bot_module.inline_navigation:
+                    update = make_button_update(next(update_ids), chat, keyboard.callback_data('navigation', text))
+                else:
+                    update = make_update(next(update_ids), chat, text)
+                started = time.perf_counter()
+                await dp.updates_handler.notify(update)
+                latencies[handlers.pop(update.update_id, 'unhandled')].append(time.perf_counter() - started)
+
+    redis_calls_before = await redis_command_calls(redis)
+    started = time.perf_counter()
+    await asyncio.gather(*[run_chat(chat_offset + number) for number in range(args.chats)])
+    # Replies are sent by scheduler after handlers return
+    bot_module.message_editor.flush()
+    await bot_module.send_scheduler.drain()
+    elapsed = time.perf_counter() - started
+    redis_calls_after = await redis_command_calls(redis)
+
+    updates = sum(len(values) for values in latencies.values())
+    result = {'revision': git_revision(),
+              'time': time.strftime('%Y-%m-%dT%H:%M:%S'),
+              'parameters': vars(args),
+              'updates': updates,
+              'elapsed': elapsed,
+              'throughput': updates / elapsed,
+              'redis_commands_per_update': ((redis_calls_after - redis_calls_before - 1) / updates
+                                            if redis_calls_before is not None and redis_calls_after is not None
+                                            else None),
+              'state_round_trips_per_update': bot_module.session_middleware.stats['round_trips_per_update'],
+              'telegram_calls': dict(telegram.calls),
+              'google_calls': dict(google.calls),
+              'handlers': {}}
+    for name, values in sorted(latencies.items()):
+        values.sort()
+        result['handlers'][name] = dict({'count': len(values)},
+                                        **{'p{}'.format(rank): percentile(values, rank) * 1000 for rank in PERCENTILES})
+
+    # Prefetch started by last steps is of no interest
+    for number in range(args.chats):
+        bot_module.street_view_prefetcher.cancel(chat_offset + number)
+    await bot_module.shutdown(dp)
+    await dp.bot.session.close()
+    await telegram_runner.cleanup()
+    await google_runner.cleanup()
+    return result
+
+
+def report(result):
+    print('Revision: {}'.format(result['revision']))
+    print('Updates: {updates}, elapsed: {elapsed:.2f} s, throughput: {throughput:.1f} updates/s'.format(**result))
+    if result['redis_commands_per_update'] is not None:
+        print('Redis commands per update: {:.2f}'.format(result['redis_commands_per_update']))
+    print('State round trips per update: {:.2f}'.format(result['state_round_trips_per_update']))
+    print('Telegram calls: {}, Google calls: {}'.format(result['telegram_calls'], result['google_calls']))
+    print('{:<36} {:>7} {:>9} {:>9} {:>9}'.format('handler', 'count', 'p50 ms', 'p95 ms', 'p99 ms'))
+    for name, stats in result['handlers'].items():
+        print('{:<36} {count:>7} {p50:>9.2f} {p95:>9.2f} {p99:>9.2f}'.format(name, **stats))
+
+
+def compare(old_path, new_path):
+    with open(old_path) as file:
+        old = json.load(file)
+    with open(new_path) as file:
+        new = json.load(file)
+
+    def change(old_value, new_value):
+        return '{:+.1f}%'.format((new_value - old_value) / old_value * 100) if old_value else 'n/a'
+
+    print('{} -> {}'.format(old['revision'], new['revision']))
+    print('throughput: {:.1f} -> {:.1f} updates/s ({})'.format(old['throughput'], new['throughput'],
+                                                               change(old['throughput'], new['throughput'])))
+    if old['redis_commands_per_update'] is not None and new['redis_commands_per_update'] is not None:
+        print('Redis commands per update: {:.2f} -> {:.2f}'.format(old['redis_commands_per_update'],
+                                                                   new['redis_commands_per_update']))
+    print('{:<36} {:>22} {:>22}'.format('handler', 'p50 ms', 'p99 ms'))
+    for name in sorted(set(old['handlers']) | set(new['handlers'])):
+        old_stats, new_stats = old['handlers'].get(name), new['handlers'].get(name)
+        if old_stats is None or new_stats is None:
+            print('{:<36} {:>22}'.format(name, 'only in ' + (old['revision'] if new_stats is None
+                                                             else new['revision'])))
+            continue
+        print('{:<36} {:>22} {:>22}'.format(
+            name,
+            '{:.2f}->{:.2f} {}'.format(old_stats['p50'], new_stats['p50'], change(old_stats['p50'], new_stats['p50'])),
+            '{:.2f}->{:.2f} {}'.format(old_stats['p99'], new_stats['p99'], change(old_stats['p99'], new_stats['p99']))))
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Bot load test')
+    parser.add_argument('--chats', type=int, default=100, help='number of simulated chats')
+    parser.add_argument('--steps', type=int, default=10, help='"next" presses per chat')
+    parser.add_argument('--concurrency', type=int, default=100, help='chats active at the same time')
+    parser.add_argument('--telegram-delay', type=float, default=0.03, help='fake Bot API delay, seconds')
+    parser.add_argument('--google-delay', type=float, default=0.1, help='fake Google Maps delay, seconds')
+    parser.add_argument('--fake-redis', action='store_true', help='use fakeredis instead of REDIS_URL')
+    parser.add_argument('--flush', action='store_true', help='flush Redis database before test')
+    parser.add_argument('--navigation', choices=['reply', 'inline'], default='reply', help='navigation keyboard')
+    parser.add_argument('--output', default=RESULTS_DIR, help='directory of results')
+    parser.add_argument('--compare', nargs=2, metavar=('OLD', 'NEW'), help='compare two saved results')
+    args = parser.parse_args()
+
+    if args.compare:
+        compare(*args.compare)
+        return
+
+    output = args.output
+    del args.output, args.compare
+    result = asyncio.get_event_loop().run_until_complete(run(args))
+    report(result)
+
+    os.makedirs(output, exist_ok=True)
+    path = os.path.join(output, '{}-{}.json'.format(result['revision'], time.strftime('%Y%m%d%H%M%S')))
+    with open(path, 'w') as file:
+        json.dump(result, file, indent=2)
+    print('Saved to {}'.format(path))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,631 @@
+import asyncio
+import collections
+import hashlib
+import json
+import os
+import re
+import threading
+import time
+import unicodedata
+import uuid
+
+import config
+
+COORDINATES_REGEXP = re.compile(r'^\s*(-?\d+(?:\.\d+)?)\s*,\s*(-?\d+(?:\.\d+)?)\s*$')
+WHITESPACE_REGEXP = re.compile(r'\s+')
+SEPARATOR_REGEXP = re.compile(r'\s*[,;]\s*')
+
+# Directions parameters holding '|'-separated lists
+LIST_PARAMETERS = {'avoid', 'transit_mode'}
+
+
+class LRUCache:
+    """
+    In-process least recently used cache with per-entry expiration time
+    """
+
+    def __init__(self, max_size):
+        """
+        :param max_size: maximum number of stored entries
+        """
+        self.max_size = max_size
+        self._entries = collections.OrderedDict()
+
+    def get(self, key):
+        """
+        :param key: entry key
+        :return: stored value or None if entry is absent or expired
+        """
+        try:
+            expires, value = self._entries[key]
+        except KeyError:
+            return None
+        if expires < time.monotonic():
+            del self._entries[key]
+            return None
+        self._entries.move_to_end(key)
+        return value
+
+    def set(self, key, value, ttl):
+        """
+        :param key: entry key
+        :param value: value to store
+        :param ttl: entry lifetime in seconds
+        """
+        self._entries[key] = (time.monotonic() + ttl, value)
+        self._entries.move_to_end(key)
+        while len(self._entries) > self.max_size:
+            self._entries.popitem(last=False)
+
+    def pop(self, key):
+        """
+        Removes entry from cache
+        :param key: entry key
+        :return: removed value or None
+        """
+        return self._entries.pop(key, (None, None))[1]
+
+    def __len__(self):
+        return len(self._entries)
+
+
+def format_location(lat, lng, precision=None):
+    """
+    Snaps coordinates to grid
+    :param lat: latitude in degrees
+    :param lng: longitude in degrees
+    :param precision: number of decimal digits kept (config.LOCATION_PRECISION by default)
+    :return: str, 'lat,lng'
+    """
+    precision = config.LOCATION_PRECISION if precision is None else precision
+    return '{:.{precision}f},{:.{precision}f}'.format(float(lat), float(lng), precision=precision)
+
+
+def normalize_address(address):
+    """
+    Canonical form of place typed as text: case, Unicode forms, whitespace and separators spacing do not matter
+    :param address: place as typed by user
+    :return: str, normalized address
+    """
+    address = unicodedata.normalize('NFKC', address).casefold()
+    address = WHITESPACE_REGEXP.sub(' ', SEPARATOR_REGEXP.sub(', ', address))
+    return address.strip(' ,.;')
+
+
+def normalize_location(location, precision=None):
+    """
+    Canonical form of location: rounded coordinates or normalized address
+    :param location: location as text or 'lat,lng' string
+    :param precision: number of decimal digits kept in coordinates
+    :return: str, normalized location
+    """
+    precision = config.DIRECTIONS_CACHE_PRECISION if precision is None else precision
+    match = COORDINATES_REGEXP.match(location)
+    if match:
+        return format_location(match.group(1), match.group(2), precision)
+    return normalize_address(location)
+
+
+def normalize_directions_payload(payload):
+    """
+    Canonical form of Directions API parameters. Equal routes produce equal results
+    :param payload: dictionary of Directions API parameters
+    :return: dict, normalized parameters
+    """
+    normalized = {}
+    for name, value in payload.items():
+        if value is None or value == '':
+            continue
+        if name in ('origin', 'destination'):
+            value = normalize_location(value)
+        elif name == 'waypoints':
+            # Waypoints order matters, so they are normalized one by one
+            value = '|'.join(normalize_location(waypoint) for waypoint in value.split('|'))
+        elif name in LIST_PARAMETERS:
+            value = '|'.join(sorted(value.lower().split('|')))
+        elif isinstance(value, str):
+            value = value.strip().lower()
+        normalized[name] = value
+    return normalized
+
+
+def directions_key(payload):
+    """
+    Cache key of Directions request
+    :param payload: dictionary of Directions API parameters
+    :return: str, cache key
+    """
+    canonical = json.dumps(normalize_directions_payload(payload), sort_keys=True, separators=(',', ':'))
+    return 'directions:' + hashlib.sha1(canonical.encode()).hexdigest()
+
+
+def directions_ttl(payload):
+    """
+    Cache lifetime of Directions response. Traffic-aware driving routes become stale quickly,
+    walking and bicycling routes hardly change at all
+    :param payload: dictionary of Directions API parameters
+    :return: int, lifetime in seconds
+    """
+    mode = payload.get('mode', 'driving')
+    if mode == 'driving' and payload.get('traffic_model') and payload.get('departure_time'):
+        return config.DIRECTIONS_CACHE_TTL['driving_traffic']
+    return config.DIRECTIONS_CACHE_TTL.get(mode, config.DIRECTIONS_CACHE_TTL['driving'])
+
+
+class DirectionsCache:
+    """
+    Two-tier Directions responses cache: in-process LRU in front of Redis shared by all workers
+    """
+
+    def __init__(self, redis, max_size=None):
+        """
+        :param redis: coroutine function returning aioredis connection (e.g. RedisStorage2.redis)
+        :param max_size: maximum number of responses kept in process memory
+        """
+        self._redis = redis
+        self._local = LRUCache(max_size or config.DIRECTIONS_CACHE_SIZE)
+        self.counters = collections.Counter(local_hits=0, redis_hits=0, misses=0)
+
+    async def get(self, payload):
+        """
+        :param payload: dictionary of Directions API parameters
+        :return: cached Directions response or None
+        """
+        key = directions_key(payload)
+        result = self._local.get(key)
+        if result is not None:
+            self.counters['local_hits'] += 1
+            return result
+
+        redis = await self._redis()
+        pipe = redis.pipeline()
+        pipe.get(key, encoding='utf8')
+        pipe.ttl(key)
+        raw_result, ttl = await pipe.execute()
+        if raw_result:
+            result = json.loads(raw_result)
+            self._local.set(key, result, max(ttl, 1))
+            self.counters['redis_hits'] += 1
+            return result
+
+        self.counters['misses'] += 1
+        return None
+
+    async def set(self, payload, result):
+        """
+        Stores successful Directions response in both tiers
+        :param payload: dictionary of Directions API parameters
+        :param result: Directions response
+        """
+        if result.get('status') != 'OK':
+            return
+        key, ttl = directions_key(payload), directions_ttl(payload)
+        self._local.set(key, result, ttl)
+        redis = await self._redis()
+        await redis.set(key, json.dumps(result), expire=ttl)
+
+    @property
+    def stats(self):
+        """
+        Cache hit/miss counters and hit ratio
+        """
+        requests_number = sum(self.counters.values())
+        hits = self.counters['local_hits'] + self.counters['redis_hits']
+        return dict(self.counters, size=len(self._local), hit_ratio=hits / requests_number if requests_number else 0)
+
+
+def geocode_key(address):
+    """
+    Cache key of place typed as text
+    :param address: place as typed by user
+    :return: str, cache key
+    """
+    return 'geocode:v1:' + hashlib.sha1(normalize_address(address).encode()).hexdigest()
+
+
+class GeocodeCache:
+    """
+    Two-tier cache of places resolved to coordinates: in-process LRU in front of Redis shared by all workers.
+    Places Google does not know are remembered too, for shorter time
+    """
+
+    def __init__(self, redis, max_size=None):
+        """
+        :param redis: coroutine function returning aioredis connection (e.g. RedisStorage2.redis)
+        :param max_size: maximum number of places kept in process memory
+        """
+        self._redis = redis
+        self._local = LRUCache(max_size or config.GEOCODE_CACHE_SIZE)
+        self.counters = collections.Counter(local_hits=0, redis_hits=0, misses=0)
+
+    async def get(self, address):
+        """
+        :param address: place as typed by user
+        :return: 'lat,lng' string, empty string if place is known to be not found or None if place is not cached
+        """
+        key = geocode_key(address)
+        location = self._local.get(key)
+        if location is not None:
+            self.counters['local_hits'] += 1
+            return location
+
+        redis = await self._redis()
+        pipe = redis.pipeline()
+        pipe.get(key, encoding='utf8')
+        pipe.ttl(key)
+        location, ttl = await pipe.execute()
+        if location is not None:
+            self._local.set(key, location, max(ttl, 1))
+            self.counters['redis_hits'] += 1
+            return location
+
+        self.counters['misses'] += 1
+        return None
+
+    async def set(self, address, location):
+        """
+        Stores resolved place in both tiers
+        :param address: place as typed by user
+        :param location: 'lat,lng' string or empty string if place is not found
+        """
+        key = geocode_key(address)
+        ttl = config.GEOCODE_CACHE_TTL if location else config.GEOCODE_NEGATIVE_TTL
+        self._local.set(key, location, ttl)
+        redis = await self._redis()
+        await redis.set(key, location, expire=ttl)
+
+    @property
+    def stats(self):
+        """
+        Cache hit/miss counters and hit ratio
+        """
+        requests_number = sum(self.counters.values())
+        hits = self.counters['local_hits'] + self.counters['redis_hits']
+        return dict(self.counters, size=len(self._local), hit_ratio=hits / requests_number if requests_number else 0)
+
+
+class MemoryCache:
+    """
+    In-process byte cache bounded by total size. Least recently used entries are evicted first
+    """
+
+    def __init__(self, max_bytes):
+        """
+        :param max_bytes: maximum total size of stored values
+        """
+        self.max_bytes = max_bytes
+        self._entries = collections.OrderedDict()
+        self._total = 0
+
+    def get(self, key):
+        """
+        :param key: entry key
+        :return: stored bytes or None
+        """
+        content = self._entries.get(key)
+        if content is not None:
+            self._entries.move_to_end(key)
+        return content
+
+    def set(self, key, content):
+        """
+        :param key: entry key
+        :param content: bytes to store
+        """
+        self._total += len(content) - len(self._entries.pop(key, b''))
+        self._entries[key] = content
+        while self._total > self.max_bytes and self._entries:
+            _, evicted = self._entries.popitem(last=False)
+            self._total -= len(evicted)
+
+    def pop(self, key):
+        """
+        :param key: entry key
+        :return: removed bytes or None
+        """
+        content = self._entries.pop(key, None)
+        if content is not None:
+            self._total -= len(content)
+        return content
+
+    def __contains__(self, key):
+        return key in self._entries
+
+
+class DiskCache:
+    """
+    On-disk byte cache bounded by total size. Least recently used files are evicted first.
+    Directory may be shared by several bot processes: files written by others are indexed when they are read
+    """
+
+    def __init__(self, directory, max_bytes):
+        """
+        :param directory: cache directory (created if absent)
+        :param max_bytes: maximum total size of stored files
+        """
+        self.directory = directory
+        self.max_bytes = max_bytes
+        os.makedirs(directory, exist_ok=True)
+        self._sizes = collections.OrderedDict(
+            (entry.name, entry.stat().st_size)
+            for entry in sorted(os.scandir(directory), key=lambda entry: entry.stat().st_mtime))
+        self._total = sum(self._sizes.values())
+        # Reads and writes run in executor threads
+        self._lock = threading.Lock()
+
+    def _path(self, key):
+        return os.path.join(self.directory, hashlib.sha1(key.encode()).hexdigest())
+
+    def __contains__(self, key):
+        return os.path.basename(self._path(key)) in self._sizes
+
+    def _read(self, key):
+        path = self._path(key)
+        try:
+            with open(path, 'rb') as file:
+                content = file.read()
+        except FileNotFoundError:
+            return None
+        os.utime(path)
+        name = os.path.basename(path)
+        with self._lock:
+            if name in self._sizes:
+                self._sizes.move_to_end(name, last=True)
+            else:
+                self._sizes[name] = len(content)
+                self._total += len(content)
+        return content
+
+    def _write(self, key, content):
+        path = self._path(key)
+        name = os.path.basename(path)
+        with open(path, 'wb') as file:
+            file.write(content)
+        evicted = []
+        with self._lock:
+            self._total += len(content) - self._sizes.pop(name, 0)
+            self._sizes[name] = len(content)
+            while self._total > self.max_bytes and len(self._sizes) > 1:
+                evicted_name, size = self._sizes.popitem(last=False)
+                self._total -= size
+                evicted.append(evicted_name)
+
+        for evicted_name in evicted:
+            try:
+                os.remove(os.path.join(self.directory, evicted_name))
+            except FileNotFoundError:
+                pass
+
+    async def get(self, key):
+        """
+        :param key: entry key
+        :return: stored bytes or None
+        """
+        return await asyncio.get_event_loop().run_in_executor(None, self._read, key)
+
+    async def set(self, key, content):
+        """
+        :param key: entry key
+        :param content: bytes to store
+        """
+        await asyncio.get_event_loop().run_in_executor(None, self._write, key, content)
+
+
+def street_view_key(payload):
+    """
+    Cache key of Street View image: rounded location and heading bucket
+    :param payload: dictionary of Street View API parameters
+    :return: str, cache key
+    """
+    # v2: headings computed before bearing was fixed (degrees were used as radians) are not reused
+    return 'street_view:v2:{}:{}:{}'.format(normalize_location(payload['location'], config.STREET_VIEW_CACHE_PRECISION),
+                                            int(payload['heading']) // config.STREET_VIEW_HEADING_BUCKET,
+                                            payload.get('size', ''))
+
+
+class StreetViewCache:
+    """
+    Street View images cache. Keeps Telegram file_id of already uploaded images in Redis,
+    so they can be resent without downloading and uploading again. Image bytes are kept on disk as fallback.
+    Prefetched images which were not sent yet are kept in memory
+    """
+
+    def __init__(self, redis, directory=None, max_bytes=None, max_memory_bytes=None):
+        """
+        :param redis: coroutine function returning aioredis connection (e.g. RedisStorage2.redis)
+        :param directory: directory of image bytes cache
+        :param max_bytes: maximum total size of image bytes cache
+        :param max_memory_bytes: maximum total size of prefetched images kept in memory
+        """
+        self._redis = redis
+        self._images = DiskCache(directory or config.STREET_VIEW_CACHE_DIR,
+                                 max_bytes or config.STREET_VIEW_CACHE_BYTES)
+        self._prefetched = MemoryCache(max_memory_bytes or config.STREET_VIEW_PREFETCH_BYTES)
+        self.counters = collections.Counter(file_id_hits=0, prefetch_hits=0, image_hits=0, misses=0)
+
+    async def get_file_id(self, payload):
+        """
+        :param payload: dictionary of Street View API parameters
+        :return: Telegram file_id of image or None
+        """
+        redis = await self._redis()
+        file_id = await redis.get(street_view_key(payload), encoding='utf8')
+        if file_id:
+            self.counters['file_id_hits'] += 1
+        return file_id
+
+    async def set_file_id(self, payload, file_id):
+        """
+        :param payload: dictionary of Street View API parameters
+        :param file_id: Telegram file_id of uploaded image
+        """
+        key = street_view_key(payload)
+        # Image is served by file_id from now on
+        self._prefetched.pop(key)
+        redis = await self._redis()
+        await redis.set(key, file_id, expire=config.STREET_VIEW_FILE_ID_TTL)
+
+    async def delete_file_id(self, payload):
+        """
+        Forgets file_id rejected by Telegram
+        :param payload: dictionary of Street View API parameters
+        """
+        redis = await self._redis()
+        await redis.delete(street_view_key(payload))
+
+    async def get_image(self, payload):
+        """
+        :param payload: dictionary of Street View API parameters
+        :return: image (as byte string) or None
+        """
+        key = street_view_key(payload)
+        image = self._prefetched.get(key)
+        if image is not None:
+            self.counters['prefetch_hits'] += 1
+            return image
+
+        image = await self._images.get(key)
+        self.counters['image_hits' if image else 'misses'] += 1
+        return image
+
+    async def set_image(self, payload, image):
+        """
+        :param payload: dictionary of Street View API parameters
+        :param image: image (as byte string)
+        """
+        await self._images.set(street_view_key(payload), image)
+
+    async def has_image(self, payload):
+        """
+        :param payload: dictionary of Street View API parameters
+        :return: bool, True if image can be sent without requesting Google
+        """
+        key = street_view_key(payload)
+        if key in self._prefetched or key in self._images:
+            return True
+        redis = await self._redis()
+        return bool(await redis.exists(key))
+
+    def set_prefetched_image(self, payload, image):
+        """
+        Keeps prefetched image in memory until it is sent
+        :param payload: dictionary of Street View API parameters
+        :param image: image (as byte string)
+        """
+        self._prefetched.set(street_view_key(payload), image)
+
+    @property
+    def stats(self):
+        """
+        Cache hit/miss counters
+        """
+        return dict(self.counters, size_bytes=self._images._total, prefetched_bytes=self._prefetched._total)
+
+
+# Removes lock only if it is still held by given owner
+RELEASE_LOCK_SCRIPT = """
+if redis.call('get', KEYS[1]) == ARGV[1] then
+    return redis.call('del', KEYS[1])
+end
+return 0
+"""
+
+
+# Result of call shared within process, if caller making it was cancelled
+CANCELLED_CALL = object()
+
+
+class SingleFlight:
+    """
+    Coalesces identical concurrent calls: only one of them is made, others receive its result.
+    Within process callers share one future, across processes they share short-lived Redis lock and result key
+    """
+
+    def __init__(self, redis, prefix, lock_ttl=None, result_ttl=None, poll_interval=None):
+        """
+        :param redis: coroutine function returning aioredis connection (e.g. RedisStorage2.redis)
+        :param prefix: Redis keys prefix
+        :param lock_ttl: maximum duration (seconds) of call, after which other processes stop waiting for it
+        :param result_ttl: lifetime (seconds) of call result kept for waiting processes
+        :param poll_interval: interval (seconds) between checks of result made by other process
+        """
+        self._redis = redis
+        self.prefix = prefix
+        self.lock_ttl = lock_ttl or config.SINGLE_FLIGHT_LOCK_TTL
+        self.result_ttl = result_ttl or config.SINGLE_FLIGHT_RESULT_TTL
+        self.poll_interval = poll_interval or config.SINGLE_FLIGHT_POLL_INTERVAL
+        self._calls = {}
+        self.counters = collections.Counter(calls=0, local_shared=0, remote_shared=0)
+
+    async def do(self, key, function):
+        """
+        :param key: call key: calls with equal keys are considered identical
+        :param function: coroutine function without arguments making the call. Result must be JSON-serializable
+        :return: call result
+        """
+        future = self._calls.get(key)
+        while future is not None:
+            self.counters['local_shared'] += 1
+            result = await asyncio.shield(future)
+            if result is not CANCELLED_CALL:
+                return result
+            # Caller making the call was cancelled: first of waiting callers makes it instead
+            self.counters['local_shared'] -= 1
+            future = self._calls.get(key)
+
+        future = asyncio.get_event_loop().create_future()
+        self._calls[key] = future
+        try:
+            result = await self._do_shared(key, function)
+        except asyncio.CancelledError:
+            # Waiting callers are not cancelled with this one
+            future.set_result(CANCELLED_CALL)
+            raise
+        except Exception as error:
+            future.set_exception(error)
+            # Mark exception as retrieved: there may be no other callers
+            future.exception()
+            raise
+        else:
+            future.set_result(result)
+        finally:
+            del self._calls[key]
+        return result
+
+    async def _do_shared(self, key, function):
+        """
+        Makes call or waits for result of identical call made by other process
+        """
+        redis = await self._redis()
+        lock_key, result_key = '{}:lock:{}'.format(self.prefix, key), '{}:result:{}'.format(self.prefix, key)
+        token = uuid.uuid4().hex
+
+        if not await redis.set(lock_key, token, pexpire=int(self.lock_ttl * 1000), exist=redis.SET_IF_NOT_EXIST):
+            deadline = time.monotonic() + self.lock_ttl
+            while time.monotonic() < deadline:
+                await asyncio.sleep(self.poll_interval)
+                pipe = redis.pipeline()
+                pipe.get(result_key, encoding='utf8')
+                pipe.exists(lock_key)
+                raw_result, locked = await pipe.execute()
+                if raw_result:
+                    self.counters['remote_shared'] += 1
+                    return json.loads(raw_result)
+                if not locked:
+                    # Call of other process failed without result
+                    break
+
+        self.counters['calls'] += 1
+        try:
+            result = await function()
+            await redis.set(result_key, json.dumps(result), pexpire=int(self.result_ttl * 1000))
+            return result
+        finally:
+            await redis.eval(RELEASE_LOCK_SCRIPT, keys=[lock_key], args=[token])
+
+    @property
+    def stats(self):
+        """
+        Calls made and calls saved by coalescing
+        """
+        return dict(self.counters, saved=self.counters['local_shared'] + self.counters['remote_shared'])
@@ -1,4 +1,5 @@
 import os
+import tempfile
 from urllib.parse import urlparse
 
 TG_TOKEN = os.getenv('TG_TOKEN')
@@ -21,15 +22,16 @@ DEFAULT_USER_DATA = {'mode': 'driving',
                                       'tram': False,
                                       'rail': False},
                      'transit_routing_preference': '',
+                     'waypoints_order': 'as_typed',
                      'step': 0,
-                     'directions': None
+                     'route': None
                      }
 
 DEFAULT_GEO_DATA = {'origin': None,
                     'destination': None,
                     'waypoints': [],
                     'step': 0,
-                    'directions': None
+                    'route': None
                     }
 
 redis_url = os.getenv('REDIS_URL', '127.0.0.1:6379')
@@ -40,5 +42,155 @@ try:
 except ValueError:
     redis_user, redis_password = '', ''
 
-GMAPS_DIRECTIONS_URL = 'https://maps.googleapis.com/maps/api/directions/json?'
-GMAPS_IMAGE_URL = 'https://maps.googleapis.com/maps/api/streetview?'
+# Local Bot API server or fake endpoint (e.g. for load tests), official Bot API if not set
+TG_API_SERVER = os.getenv('TG_API_SERVER')
+
+GMAPS_API_BASE = os.getenv('GMAPS_API_BASE', 'https://maps.googleapis.com').rstrip('/')
+GMAPS_DIRECTIONS_URL = GMAPS_API_BASE + '/maps/api/directions/json?'
+GMAPS_IMAGE_URL = GMAPS_API_BASE + '/maps/api/streetview?'
+GMAPS_GEOCODE_URL = GMAPS_API_BASE + '/maps/api/geocode/json?'
+
+# Google Maps client settings
+GMAPS_POOL_SIZE = int(os.getenv('GMAPS_POOL_SIZE', 20))
+GMAPS_KEEPALIVE_TIMEOUT = float(os.getenv('GMAPS_KEEPALIVE_TIMEOUT', 30))
+GMAPS_DIRECTIONS_TIMEOUT = float(os.getenv('GMAPS_DIRECTIONS_TIMEOUT', 10))
+GMAPS_IMAGE_TIMEOUT = float(os.getenv('GMAPS_IMAGE_TIMEOUT', 15))
+GMAPS_RETRIES = int(os.getenv('GMAPS_RETRIES', 2))
+GMAPS_BACKOFF = float(os.getenv('GMAPS_BACKOFF', 0.3))
+
+# Directions cache settings
+DIRECTIONS_CACHE_SIZE = int(os.getenv('DIRECTIONS_CACHE_SIZE', 256))
+DIRECTIONS_CACHE_PRECISION = int(os.getenv('DIRECTIONS_CACHE_PRECISION', 4))  # ~10 m
+DIRECTIONS_CACHE_TTL = {'driving_traffic': int(os.getenv('DIRECTIONS_CACHE_TTL_TRAFFIC', 300)),
+                        'driving': int(os.getenv('DIRECTIONS_CACHE_TTL_DRIVING', 3600)),
+                        'transit': int(os.getenv('DIRECTIONS_CACHE_TTL_TRANSIT', 600)),
+                        'walking': int(os.getenv('DIRECTIONS_CACHE_TTL_WALKING', 86400)),
+                        'bicycling': int(os.getenv('DIRECTIONS_CACHE_TTL_BICYCLING', 86400))}
+
+# Maximum number of waypoints in one Directions request, longer routes are requested in chunks
+GMAPS_MAX_WAYPOINTS = int(os.getenv('GMAPS_MAX_WAYPOINTS', 25))
+
+# Geocoding cache settings: places typed as text are resolved to coordinates once
+GEOCODE_CACHE_SIZE = int(os.getenv('GEOCODE_CACHE_SIZE', 1024))
+GEOCODE_CACHE_TTL = int(os.getenv('GEOCODE_CACHE_TTL', 30 * 24 * 3600))
+GEOCODE_NEGATIVE_TTL = int(os.getenv('GEOCODE_NEGATIVE_TTL', 3600))  # places Google does not know
+LOCATION_PRECISION = int(os.getenv('LOCATION_PRECISION', 4))  # shared and resolved coordinates grid, ~10 m
+
+# Street View cache settings
+STREET_VIEW_CACHE_DIR = os.getenv('STREET_VIEW_CACHE_DIR',
+                                  os.path.join(tempfile.gettempdir(), 'ivan_susanin_street_view'))
+STREET_VIEW_CACHE_BYTES = int(os.getenv('STREET_VIEW_CACHE_BYTES', 64 * 1024 * 1024))
+STREET_VIEW_CACHE_PRECISION = int(os.getenv('STREET_VIEW_CACHE_PRECISION', 4))
+STREET_VIEW_HEADING_BUCKET = int(os.getenv('STREET_VIEW_HEADING_BUCKET', 15))  # degrees
+STREET_VIEW_FILE_ID_TTL = int(os.getenv('STREET_VIEW_FILE_ID_TTL', 30 * 24 * 3600))
+
+# Route storage settings
+ROUTE_TTL = int(os.getenv('ROUTE_TTL', 24 * 3600))
+
+# User state lifetimes since last change: abandoned sessions expire
+FSM_NAVIGATION_TTL = int(os.getenv('FSM_NAVIGATION_TTL', 7 * 24 * 3600))  # origin, destination, waypoints, route
+FSM_PREFERENCES_TTL = int(os.getenv('FSM_PREFERENCES_TTL', 180 * 24 * 3600))  # route options and state
+
+# In-process user state cache: number of users (0 - off), size limit, entry lifetime and invalidation channel
+FSM_CACHE_SIZE = int(os.getenv('FSM_CACHE_SIZE', 0))
+FSM_CACHE_BYTES = int(os.getenv('FSM_CACHE_BYTES', 16 * 2 ** 20))
+FSM_CACHE_TTL = float(os.getenv('FSM_CACHE_TTL', 60))
+FSM_CACHE_CHANNEL = os.getenv('FSM_CACHE_CHANNEL', 'fsm:invalidate')
+
+# Live navigation settings: steps follow live location shared by user
+LIVE_MIN_MOVE = float(os.getenv('LIVE_MIN_MOVE', 15))  # meters user moves before location update is processed
+LIVE_POSITION_TTL = int(os.getenv('LIVE_POSITION_TTL', 600))  # seconds last processed location is remembered
+LIVE_CACHE_SIZE = int(os.getenv('LIVE_CACHE_SIZE', 1024))  # chats with route geometry kept in memory
+LIVE_OFF_ROUTE_DISTANCE = float(os.getenv('LIVE_OFF_ROUTE_DISTANCE', 50))  # meters, farther location is off route
+LIVE_BACKTRACK_PENALTY = float(os.getenv('LIVE_BACKTRACK_PENALTY', 30))  # meters added to steps already passed
+LIVE_ARRIVAL_DISTANCE = float(os.getenv('LIVE_ARRIVAL_DISTANCE', 20))  # meters to destination it is reached at
+REROUTE_INTERVAL = float(os.getenv('REROUTE_INTERVAL', 30))  # seconds between off-route reroutes of one chat
+
+# Navigation keyboard: 'reply' - new message for every step, 'inline' - single route message edited in place
+NAVIGATION_KEYBOARD = os.getenv('NAVIGATION_KEYBOARD', 'reply')
+NAVIGATION_EDIT_DELAY = float(os.getenv('NAVIGATION_EDIT_DELAY', 0.3))  # seconds button presses are merged within
+NAVIGATION_MESSAGES_CACHE_SIZE = int(os.getenv('NAVIGATION_MESSAGES_CACHE_SIZE', 4096))  # messages content is kept for
+
+# Bot mode: 'polling' (local development) or 'webhook'
+BOT_MODE = os.getenv('BOT_MODE', 'polling')
+
+# Webhook settings
+WEBHOOK_HOST = os.getenv('WEBHOOK_HOST', '')  # public base url, e.g. https://example.com
+WEBHOOK_PATH = os.getenv('WEBHOOK_PATH', '/webhook')
+WEBHOOK_SECRET = os.getenv('WEBHOOK_SECRET', '')  # random secret is generated if empty
+WEBHOOK_MAX_CONNECTIONS = int(os.getenv('WEBHOOK_MAX_CONNECTIONS', 40))  # simultaneous Telegram connections
+WEBHOOK_CONCURRENCY = int(os.getenv('WEBHOOK_CONCURRENCY', 100))  # updates processed at once by one process
+WEBHOOK_MAX_BODY_SIZE = int(os.getenv('WEBHOOK_MAX_BODY_SIZE', 1024 * 1024))
+WEBAPP_HOST = os.getenv('WEBAPP_HOST', '0.0.0.0')
+WEBAPP_PORT = int(os.getenv('PORT', 8080))
+
+# Multi-worker mode settings (0 workers: updates are processed by receiving process itself)
+SHARD_WORKERS = int(os.getenv('SHARD_WORKERS', 0))  # number of worker processes
+SHARD_COUNT = int(os.getenv('SHARD_COUNT', 16))  # number of chat shards, should not be less than workers number
+SHARD_LEASE_TTL = float(os.getenv('SHARD_LEASE_TTL', 10))  # seconds
+SHARD_BATCH_SIZE = int(os.getenv('SHARD_BATCH_SIZE', 100))  # maximum number of read updates not processed yet
+SHARD_BLOCK_TIMEOUT = int(os.getenv('SHARD_BLOCK_TIMEOUT', 1000))  # milliseconds
+SHARD_STREAM_MAX_LEN = int(os.getenv('SHARD_STREAM_MAX_LEN', 10000))
+
+# Outgoing messages limits: Telegram allows about 30 messages per second to all chats and 1 per second to one chat.
+# Global limit is shared by shard workers equally, 0 - unlimited
+TELEGRAM_RATE = float(os.getenv('TELEGRAM_RATE', 30))
+TELEGRAM_BURST = int(os.getenv('TELEGRAM_BURST', 30))
+TELEGRAM_CHAT_RATE = float(os.getenv('TELEGRAM_CHAT_RATE', 1))
+TELEGRAM_CHAT_BURST = int(os.getenv('TELEGRAM_CHAT_BURST', 3))
+TELEGRAM_MAX_RETRIES = int(os.getenv('TELEGRAM_MAX_RETRIES', 3))  # flood control retries of one message
+TELEGRAM_DRAIN_TIMEOUT = float(os.getenv('TELEGRAM_DRAIN_TIMEOUT', 10))  # seconds queued messages are sent on exit
+
+# Google Maps rate limits shared by all workers: endpoint -> (requests per second, burst size)
+GMAPS_RATE_LIMITS = {'directions': (float(os.getenv('GMAPS_DIRECTIONS_RATE', 40)),
+                                    int(os.getenv('GMAPS_DIRECTIONS_BURST', 50))),
+                     'street_view': (float(os.getenv('GMAPS_IMAGE_RATE', 40)),
+                                     int(os.getenv('GMAPS_IMAGE_BURST', 50))),
+                     'geocoding': (float(os.getenv('GMAPS_GEOCODE_RATE', 40)),
+                                   int(os.getenv('GMAPS_GEOCODE_BURST', 50)))}
+# Daily requests quotas (0 - unlimited)
+GMAPS_DAILY_QUOTAS = {'directions': int(os.getenv('GMAPS_DIRECTIONS_DAILY_QUOTA', 0)),
+                      'street_view': int(os.getenv('GMAPS_IMAGE_DAILY_QUOTA', 0)),
+                      'geocoding': int(os.getenv('GMAPS_GEOCODE_DAILY_QUOTA', 0))}
+GMAPS_QUEUE_TIMEOUT = float(os.getenv('GMAPS_QUEUE_TIMEOUT', 20))  # seconds request may wait for rate limit
+
+# Coalescing of identical concurrent Directions requests
+SINGLE_FLIGHT_LOCK_TTL = float(os.getenv('SINGLE_FLIGHT_LOCK_TTL', 30))  # seconds
+SINGLE_FLIGHT_RESULT_TTL = float(os.getenv('SINGLE_FLIGHT_RESULT_TTL', 10))  # seconds
+SINGLE_FLIGHT_POLL_INTERVAL = float(os.getenv('SINGLE_FLIGHT_POLL_INTERVAL', 0.05))  # seconds
+
+# Street View prefetch settings
+STREET_VIEW_PREFETCH_STEPS = int(os.getenv('STREET_VIEW_PREFETCH_STEPS', 2))  # current step and following ones
+STREET_VIEW_PREFETCH_BUDGET = int(os.getenv('STREET_VIEW_PREFETCH_BUDGET', 30))  # images per chat route
+STREET_VIEW_PREFETCH_CHATS = int(os.getenv('STREET_VIEW_PREFETCH_CHATS', 4096))  # chats spent budget is kept for
+STREET_VIEW_PREFETCH_CONCURRENCY = int(os.getenv('STREET_VIEW_PREFETCH_CONCURRENCY', 10))
+STREET_VIEW_PREFETCH_BYTES = int(os.getenv('STREET_VIEW_PREFETCH_BYTES', 32 * 1024 * 1024))
+
+# Prometheus metrics endpoint (0 - off). Multi-worker mode workers listen on following ports
+METRICS_PORT = int(os.getenv('METRICS_PORT', 9100))
+METRICS_HOST = os.getenv('METRICS_HOST', '127.0.0.1')
+METRICS_NAVIGATION_WINDOW = int(os.getenv('METRICS_NAVIGATION_WINDOW', 30 * 60))  # seconds
+
+# Telegram user ids allowed to use admin commands (comma separated)
+ADMIN_IDS = [int(user_id) for user_id in os.getenv('ADMIN_IDS', '').split(',') if user_id.strip()]
+
+# Update profiler: 1 of PROFILER_SAMPLE_RATE updates (0 - off) and updates slower than PROFILER_SLOW_THRESHOLD
+# (0 - off) are profiled. Chats can be profiled on demand with /profile admin command
+PROFILER_SAMPLE_RATE = int(os.getenv('PROFILER_SAMPLE_RATE', 0))
+PROFILER_SLOW_THRESHOLD = float(os.getenv('PROFILER_SLOW_THRESHOLD', 0))  # seconds
+PROFILER_INTERVAL = float(os.getenv('PROFILER_INTERVAL', 0.005))  # seconds between stack samples
+PROFILER_DIR = os.getenv('PROFILER_DIR', os.path.join(tempfile.gettempdir(), 'ivan_susanin_profiles'))
+PROFILER_MAX_FILES = int(os.getenv('PROFILER_MAX_FILES', 200))
+PROFILER_CHAT_TTL = int(os.getenv('PROFILER_CHAT_TTL', 3600))  # seconds chat stays profiled after /profile
+PROFILER_REFRESH_INTERVAL = float(os.getenv('PROFILER_REFRESH_INTERVAL', 10))  # seconds between profiled chats reloads
+
+# Routing backends: "google" - Google Directions with offline fallback (if graph is set), "local" - offline only
+ROUTING_BACKEND = os.getenv('ROUTING_BACKEND', 'google')
+LOCAL_ROUTING_GRAPH = os.getenv('LOCAL_ROUTING_GRAPH', '')  # directory of graph built by "python routing.py build"
+LOCAL_ROUTING_WORKERS = int(os.getenv('LOCAL_ROUTING_WORKERS', 2))  # threads searching routes
+LOCAL_ROUTING_MAX_SNAP = float(os.getenv('LOCAL_ROUTING_MAX_SNAP', 1000))  # meters from point to nearest road
+if ROUTING_BACKEND not in ('google', 'local'):
+    raise ValueError('ROUTING_BACKEND must be "google" or "local", not "{}"'.format(ROUTING_BACKEND))
+if ROUTING_BACKEND == 'local' and not LOCAL_ROUTING_GRAPH:
+    raise ValueError('ROUTING_BACKEND is "local", but LOCAL_ROUTING_GRAPH is not set: build graph with '
+                     '"python routing.py build" and set LOCAL_ROUTING_GRAPH to its directory')
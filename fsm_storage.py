@@ -0,0 +1,465 @@
+import asyncio
+import collections
+import copy
+import json
+import logging
+import struct
+import sys
+import time
+import uuid
+
+import aioredis
+from aiogram.contrib.fsm_storage.redis import RedisStorage2
+
+import config
+
+logger = logging.getLogger(__name__)
+
+STATE_KEY = 'state'
+STATE_DATA_KEY = 'data'
+PREFERENCES_KEY = 'preferences'
+
+# Binary format version, the first byte of encoded value. JSON values start with '{'
+FORMAT_VERSION = 1
+
+# Encoded option values: position in tuple is stored, so values may only be appended
+ENUM_OPTIONS = (('mode', ('driving', 'walking', 'bicycling', 'transit')),
+                ('units', ('metric', 'imperial')),
+                ('traffic_model', ('best_guess', 'optimistic', 'pessimistic')),
+                ('transit_routing_preference', ('', 'less_walking', 'fewer_transfers')),
+                ('waypoints_order', ('as_typed', 'optimized')),
+                ('departure_time', ('now',)))
+FLAG_OPTIONS = (('avoid', ('tolls', 'highways', 'ferries', 'indoor')),
+                ('transit_mode', ('bus', 'subway', 'train', 'tram', 'rail')))
+PREFERENCE_FIELDS = frozenset(name for name, _ in ENUM_OPTIONS + FLAG_OPTIONS)
+NAVIGATION_FIELDS = frozenset(('origin', 'destination', 'waypoints', 'route', 'step'))
+# Fields of storage before split which are not kept anymore: whole Directions response replaced by route id
+LEGACY_FIELDS = ('directions',)
+
+PREFERENCES_FORMAT = struct.Struct('<B{}B{}B'.format(len(ENUM_OPTIONS), len(FLAG_OPTIONS)))
+NAVIGATION_HEADER = struct.Struct('<BIH')  # version, step, number of waypoints
+STRING_LENGTH = struct.Struct('<H')
+NONE_LENGTH = 0xffff
+
+
+def encode_preferences(preferences):
+    """
+    Packs route options into one byte per option: index of enum value or bitfield of flags
+    :param preferences: dictionary of route options
+    :return: bytes or None if options are not representable in binary format
+    """
+    if set(preferences) != PREFERENCE_FIELDS:
+        return None
+    values = []
+    try:
+        for name, options in ENUM_OPTIONS:
+            values.append(options.index(preferences[name]))
+        for name, flags in FLAG_OPTIONS:
+            if set(preferences[name]) != set(flags):
+                return None
+            values.append(sum(1 << bit for bit, flag in enumerate(flags) if preferences[name][flag]))
+    except (ValueError, TypeError):
+        return None
+    return PREFERENCES_FORMAT.pack(FORMAT_VERSION, *values)
+
+
+def decode_preferences(raw):
+    """
+    :param raw: bytes made by encode_preferences
+    :return: dictionary of route options
+    """
+    version, *values = PREFERENCES_FORMAT.unpack(raw)
+    preferences = {name: options[value] for (name, options), value in zip(ENUM_OPTIONS, values)}
+    for (name, flags), value in zip(FLAG_OPTIONS, values[len(ENUM_OPTIONS):]):
+        preferences[name] = {flag: bool(value & 1 << bit) for bit, flag in enumerate(flags)}
+    return preferences
+
+
+def encode_navigation(navigation):
+    """
+    Packs route being built or navigated: step index and length-prefixed UTF-8 strings
+    of route id, origin, destination and waypoints
+    :param navigation: dictionary of navigation fields
+    :return: bytes or None if data is not representable in binary format
+    """
+    if set(navigation) != NAVIGATION_FIELDS:
+        return None
+    waypoints, step = navigation['waypoints'], navigation['step']
+    if not isinstance(step, int) or not 0 <= step < 2 ** 32 or not isinstance(waypoints, list) \
+            or len(waypoints) >= 2 ** 16:
+        return None
+    parts = [NAVIGATION_HEADER.pack(FORMAT_VERSION, step, len(waypoints))]
+    for string in [navigation['route'], navigation['origin'], navigation['destination']] + waypoints:
+        if string is None:
+            parts.append(STRING_LENGTH.pack(NONE_LENGTH))
+            continue
+        if not isinstance(string, str):
+            return None
+        encoded = string.encode('utf8')
+        if len(encoded) >= NONE_LENGTH:
+            return None
+        parts.append(STRING_LENGTH.pack(len(encoded)))
+        parts.append(encoded)
+    return b''.join(parts)
+
+
+def decode_navigation(raw):
+    """
+    :param raw: bytes made by encode_navigation
+    :return: dictionary of navigation fields
+    """
+    _, step, waypoints_number = NAVIGATION_HEADER.unpack_from(raw)
+    offset, strings = NAVIGATION_HEADER.size, []
+    for _ in range(3 + waypoints_number):
+        length, = STRING_LENGTH.unpack_from(raw, offset)
+        offset += STRING_LENGTH.size
+        if length == NONE_LENGTH:
+            strings.append(None)
+        else:
+            strings.append(raw[offset:offset + length].decode('utf8'))
+            offset += length
+    route, origin, destination, *waypoints = strings
+    return {'origin': origin, 'destination': destination, 'waypoints': waypoints, 'route': route, 'step': step}
+
+
+def encode_data(data):
+    """
+    Splits user data into route options and navigation data kept under separate keys.
+    Each part is encoded in binary format if possible and as JSON otherwise
+    :param data: user data
+    :return: tuple (preferences, navigation) of bytes, None if there is nothing to keep
+    """
+    parts = []
+    for encode, part in ((encode_preferences, {name: value for name, value in data.items()
+                                               if name in PREFERENCE_FIELDS}),
+                         (encode_navigation, {name: value for name, value in data.items()
+                                              if name not in PREFERENCE_FIELDS})):
+        parts.append((encode(part) or json.dumps(part).encode('utf8')) if part else None)
+    return tuple(parts)
+
+
+def decode_data(raw_preferences, raw_navigation):
+    """
+    :param raw_preferences: stored route options (bytes or None)
+    :param raw_navigation: stored navigation data (bytes or None). Data of storage before split is a JSON
+    of all user data
+    :return: user data. Part which has expired and fields missing in JSON are taken from defaults
+    """
+    if not raw_preferences and not raw_navigation:
+        return {}
+    data = {}
+    for raw, decode, fields in ((raw_preferences, decode_preferences, PREFERENCE_FIELDS),
+                                (raw_navigation, decode_navigation, NAVIGATION_FIELDS)):
+        if raw and raw[:1] != b'{':
+            data.update(decode(raw))
+            continue
+        data.update(copy.deepcopy({name: value for name, value in config.DEFAULT_USER_DATA.items()
+                                   if name in fields}))
+        if raw:
+            # Data of storage before split has no route id: route of such user is expired
+            data.update(json.loads(raw))
+            for name in LEGACY_FIELDS:
+                data.pop(name, None)
+    return data
+
+
+class StateCache:
+    """
+    In-process LRU cache of raw user state and data bounded by number of entries and bytes.
+    Every change is published to invalidation channel and other workers drop their copies.
+    Entries are served only while invalidation channel is listened to
+    """
+
+    # Approximate memory taken by entry besides raw values
+    ENTRY_OVERHEAD = 200
+
+    def __init__(self, redis, max_entries=None, max_bytes=None, ttl=None, channel=None):
+        """
+        :param redis: coroutine function returning aioredis connection (e.g. RedisStorage2.redis)
+        :param max_entries: maximum number of cached users
+        :param max_bytes: maximum size of cached values
+        :param ttl: entry lifetime in seconds, bounds staleness if invalidation is lost
+        :param channel: invalidation channel name
+        """
+        self._redis = redis
+        self.max_entries = max_entries or config.FSM_CACHE_SIZE
+        self.max_bytes = max_bytes or config.FSM_CACHE_BYTES
+        self.ttl = ttl or config.FSM_CACHE_TTL
+        self.channel = channel or config.FSM_CACHE_CHANNEL
+        self.origin = uuid.uuid4().hex[:12]
+        self._entries = collections.OrderedDict()  # (chat, user) -> (expires, size, values)
+        self.bytes = 0
+        # Invalidations seen per user and for the whole cache, so values loaded meanwhile are not cached
+        self._generations = {}  # (chat, user) -> number of invalidations
+        self._epoch = 0
+        self._listener = None
+        self._subscribed = False
+        self._retry_at = 0
+        self.counters = collections.Counter(hits=0, misses=0, evictions=0, expirations=0, invalidations=0,
+                                            stale_loads=0)
+
+    def generation(self, chat, user):
+        """
+        Generation of user entry, read before loading values from Redis and passed to set()
+        :param chat: chat id
+        :param user: user id
+        :return: hashable value, changes when user is invalidated
+        """
+        return self._epoch, self._generations.get((chat, user), 0)
+
+    def get(self, chat, user):
+        """
+        :param chat: chat id
+        :param user: user id
+        :return: tuple of raw state, preferences and data or None on cache miss
+        """
+        if (self._listener is None or self._listener.done()) and time.monotonic() >= self._retry_at:
+            self._listener = asyncio.ensure_future(self.listen())
+        entry = self._entries.get((chat, user)) if self._subscribed else None
+        if entry is not None and entry[0] < time.monotonic():
+            self.pop(chat, user)
+            self.counters['expirations'] += 1
+            entry = None
+        if entry is None:
+            self.counters['misses'] += 1
+            return None
+        self._entries.move_to_end((chat, user))
+        self.counters['hits'] += 1
+        return entry[2]
+
+    def set(self, chat, user, values, generation=None):
+        """
+        :param chat: chat id
+        :param user: user id
+        :param values: tuple of raw state, preferences and data
+        :param generation: generation of entry values were loaded at (None for values just written by this worker).
+        Values are not cached if user was invalidated while they were loaded
+        """
+        if not self._subscribed:
+            return
+        if generation is not None and generation != self.generation(chat, user):
+            self.counters['stale_loads'] += 1
+            return
+        self.pop(chat, user)
+        size = self.ENTRY_OVERHEAD + sum(len(value) for value in values if value)
+        self._entries[(chat, user)] = (time.monotonic() + self.ttl, size, values)
+        self.bytes += size
+        while len(self._entries) > self.max_entries or self.bytes > self.max_bytes:
+            _, (_, evicted_size, _) = self._entries.popitem(last=False)
+            self.bytes -= evicted_size
+            self.counters['evictions'] += 1
+
+    def pop(self, chat, user):
+        """
+        Drops entry of user
+        """
+        entry = self._entries.pop((chat, user), None)
+        if entry is not None:
+            self.bytes -= entry[1]
+
+    def invalidate(self, chat, user):
+        """
+        Drops entry of user changed elsewhere, values of user being loaded are not cached either
+        """
+        self.pop(chat, user)
+        self._generations[(chat, user)] = self._generations.get((chat, user), 0) + 1
+        if len(self._generations) > self.max_entries:
+            # Bounded like entries: new epoch invalidates every load in progress
+            self._generations.clear()
+            self._epoch += 1
+
+    def publish(self, transaction, chat, user):
+        """
+        Adds invalidation of user entry in other workers to transaction or pipeline
+        """
+        transaction.publish(self.channel, '{}:{}:{}'.format(self.origin, chat, user))
+
+    async def listen(self):
+        """
+        Drops entries changed by other workers. Cache is emptied and not used while channel is not listened to
+        """
+        redis = await self._redis()
+        try:
+            channel, = await redis.subscribe(self.channel)
+            self._subscribed = True
+            while await channel.wait_message():
+                origin, chat, user = (await channel.get(encoding='utf8')).split(':')
+                if origin != self.origin:
+                    self.invalidate(int(chat), int(user))
+                    self.counters['invalidations'] += 1
+        except asyncio.CancelledError:
+            raise
+        except Exception:
+            logger.exception('State cache invalidation channel failed')
+        finally:
+            self._subscribed = False
+            self._entries.clear()
+            self.bytes = 0
+            self._generations.clear()
+            self._epoch += 1
+            # Listening is restarted by lookups after a pause
+            self._retry_at = time.monotonic() + 1
+
+    def close(self):
+        if self._listener is not None:
+            self._listener.cancel()
+
+    @property
+    def stats(self):
+        """
+        Hit ratio, evictions, invalidations and size of cache
+        """
+        lookups = self.counters['hits'] + self.counters['misses']
+        return dict(self.counters, entries=len(self._entries), bytes=self.bytes,
+                    hit_ratio=self.counters['hits'] / lookups if lookups else 0)
+
+
+class CompactRedisStorage(RedisStorage2):
+    """
+    RedisStorage2 keeping user data compact: route options and navigation data are stored in binary format
+    under separate keys with their own idle lifetimes, so abandoned sessions expire.
+    Lifetimes are prolonged by every write
+    """
+
+    def __init__(self, *args, navigation_ttl=None, preferences_ttl=None, cache_size=None, **kwargs):
+        """
+        :param navigation_ttl: lifetime (seconds) of navigation data
+        :param preferences_ttl: lifetime (seconds) of route options and state
+        :param cache_size: number of users kept in in-process cache (0 - cache is off)
+        """
+        self.preferences_ttl = preferences_ttl or config.FSM_PREFERENCES_TTL
+        kwargs.setdefault('state_ttl', self.preferences_ttl)
+        kwargs.setdefault('data_ttl', navigation_ttl or config.FSM_NAVIGATION_TTL)
+        super(CompactRedisStorage, self).__init__(*args, **kwargs)
+        cache_size = config.FSM_CACHE_SIZE if cache_size is None else cache_size
+        self.cache = StateCache(self.redis, max_entries=cache_size) if cache_size else None
+
+    async def set_state(self, *, chat=None, user=None, state=None):
+        await super(CompactRedisStorage, self).set_state(chat=chat, user=user, state=state)
+        await self._invalidate(chat, user)
+
+    async def _invalidate(self, chat, user):
+        if self.cache is not None:
+            chat, user = self.check_address(chat=chat, user=user)
+            self.cache.invalidate(chat, user)
+            redis = await self.redis()
+            pipe = redis.pipeline()
+            self.cache.publish(pipe, chat, user)
+            await pipe.execute()
+
+    async def get_data(self, *, chat=None, user=None, default=None):
+        chat, user = self.check_address(chat=chat, user=user)
+        redis = await self.redis()
+        raw_preferences, raw_navigation = await redis.mget(self.generate_key(chat, user, PREFERENCES_KEY),
+                                                           self.generate_key(chat, user, STATE_DATA_KEY))
+        return decode_data(raw_preferences, raw_navigation) or default or {}
+
+    def write_data(self, transaction, chat, user, data, parts=None):
+        """
+        Adds commands writing user data to transaction or pipeline
+        :param parts: keys of changed parts (PREFERENCES_KEY, STATE_DATA_KEY), lifetime of the others is only
+        prolonged. All parts are written if None
+        :return: tuple (preferences, data) of raw values, None for parts which are not written
+        """
+        written = []
+        for part, raw, ttl in zip((PREFERENCES_KEY, STATE_DATA_KEY), encode_data(data),
+                                  (self.preferences_ttl, self._data_ttl)):
+            key = self.generate_key(chat, user, part)
+            if parts is not None and part not in parts:
+                transaction.expire(key, ttl)
+                written.append(None)
+            elif raw is None:
+                transaction.delete(key)
+                written.append(None)
+            else:
+                transaction.set(key, raw, expire=ttl)
+                written.append(raw)
+        return tuple(written)
+
+    async def set_data(self, *, chat=None, user=None, data=None):
+        chat, user = self.check_address(chat=chat, user=user)
+        redis = await self.redis()
+        transaction = redis.multi_exec()
+        self.write_data(transaction, chat, user, data or {})
+        if self.cache is not None:
+            self.cache.invalidate(chat, user)
+            self.cache.publish(transaction, chat, user)
+        await transaction.execute()
+
+    async def close(self):
+        if self.cache is not None:
+            self.cache.close()
+        await super(CompactRedisStorage, self).close()
+
+
+async def migrate(redis, prefix='fsm', batch=500, navigation_ttl=None, preferences_ttl=None, dry_run=False):
+    """
+    Re-encodes user data stored as JSON by RedisStorage2 into compact keys and sets lifetimes of data and states.
+    Keys are found with SCAN and processed in pipelined batches
+    :param redis: aioredis connection
+    :param prefix: FSM keys prefix
+    :param batch: number of keys processed in one round trip
+    :param navigation_ttl: lifetime (seconds) of navigation data
+    :param preferences_ttl: lifetime (seconds) of route options and state
+    :param dry_run: only count bytes which would be saved
+    :return: dict, numbers of migrated and skipped keys and bytes before and after
+    """
+    navigation_ttl = navigation_ttl or config.FSM_NAVIGATION_TTL
+    preferences_ttl = preferences_ttl or config.FSM_PREFERENCES_TTL
+    result = dict(migrated=0, skipped=0, bytes_before=0, bytes_after=0)
+    cursor = 0
+    while True:
+        cursor, keys = await redis.scan(cursor, match='{}:*:{}'.format(prefix, STATE_DATA_KEY), count=batch)
+        writes = []  # (key, value or None to delete, lifetime)
+        for key, raw in zip(keys, await redis.mget(*keys) if keys else []):
+            if not raw or raw[:1] != b'{':
+                # Expired meanwhile or already compact
+                result['skipped'] += 1
+                continue
+            preferences, navigation = encode_data(decode_data(None, raw))
+            result['migrated'] += 1
+            result['bytes_before'] += len(raw)
+            result['bytes_after'] += len(preferences or b'') + len(navigation or b'')
+            base = key[:-len(STATE_DATA_KEY)]
+            writes += [(base + PREFERENCES_KEY.encode(), preferences, preferences_ttl),
+                       (key, navigation, navigation_ttl)]
+
+        if writes and not dry_run:
+            pipe = redis.pipeline()
+            for key, value, ttl in writes:
+                if value is None:
+                    pipe.delete(key)
+                else:
+                    pipe.set(key, value, expire=ttl)
+            for key, _, _ in writes[1::2]:
+                pipe.expire(key[:-len(STATE_DATA_KEY)] + STATE_KEY.encode(), preferences_ttl)
+            await pipe.execute()
+        if not cursor:
+            break
+    result['bytes_saved'] = result['bytes_before'] - result['bytes_after']
+    return result
+
+
+def main():
+    usage = 'Usage: python fsm_storage.py migrate [--dry-run]\n' \
+            'Re-encodes user data of Redis at REDIS_URL into compact format and sets FSM_NAVIGATION_TTL ' \
+            'and FSM_PREFERENCES_TTL lifetimes'
+    if len(sys.argv) < 2 or sys.argv[1] != 'migrate':
+        sys.exit(usage)
+
+    async def run():
+        redis = await aioredis.create_redis_pool((config.redis_host, config.redis_port),
+                                                 password=config.redis_password or None, db=0)
+        try:
+            return await migrate(redis, dry_run='--dry-run' in sys.argv[2:])
+        finally:
+            redis.close()
+            await redis.wait_closed()
+
+    result = asyncio.get_event_loop().run_until_complete(run())
+    print('{migrated} keys migrated, {skipped} skipped: {bytes_before} -> {bytes_after} bytes, '
+          '{bytes_saved} bytes saved'.format(**result))
+
+
+if __name__ == '__main__':
+    main()
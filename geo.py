@@ -0,0 +1,117 @@
+import math
+
+import numpy as np
+
+# Mean Earth radius in meters
+EARTH_RADIUS = 6371008.8
+
+
+def bearing(start, end):
+    """
+    Initial bearing of path between two points
+    :param start: (lat, lng) of starting point in degrees
+    :param end: (lat, lng) of ending point in degrees
+    :return: float, bearing in degrees clockwise from north (0-360)
+    """
+    lat1, lng1, lat2, lng2 = map(math.radians, (start[0], start[1], end[0], end[1]))
+    delta_lng = lng2 - lng1
+    return (math.degrees(math.atan2(math.sin(delta_lng) * math.cos(lat2),
+                                    math.cos(lat1) * math.sin(lat2) -
+                                    math.sin(lat1) * math.cos(lat2) * math.cos(delta_lng))) + 360) % 360
+
+
+def bearings(starts, ends):
+    """
+    Vectorized bearing: initial bearings of many paths at once
+    :param starts: array-like of shape (n, 2), (lat, lng) of starting points in degrees
+    :param ends: array-like of shape (n, 2), (lat, lng) of ending points in degrees
+    :return: numpy array of n bearings in degrees clockwise from north (0-360)
+    """
+    starts = np.radians(np.asarray(starts, dtype=float).reshape(-1, 2))
+    ends = np.radians(np.asarray(ends, dtype=float).reshape(-1, 2))
+    lat1, lng1 = starts[:, 0], starts[:, 1]
+    lat2, lng2 = ends[:, 0], ends[:, 1]
+    delta_lng = lng2 - lng1
+    return (np.degrees(np.arctan2(np.sin(delta_lng) * np.cos(lat2),
+                                  np.cos(lat1) * np.sin(lat2) - np.sin(lat1) * np.cos(lat2) * np.cos(delta_lng)))
+            + 360) % 360
+
+
+def distance(start, end):
+    """
+    Great-circle (haversine) distance between two points
+    :param start: (lat, lng) of starting point in degrees
+    :param end: (lat, lng) of ending point in degrees
+    :return: float, distance in meters
+    """
+    lat1, lng1, lat2, lng2 = map(math.radians, (start[0], start[1], end[0], end[1]))
+    a = math.sin((lat2 - lat1) / 2) ** 2 + math.cos(lat1) * math.cos(lat2) * math.sin((lng2 - lng1) / 2) ** 2
+    return 2 * EARTH_RADIUS * math.asin(min(1.0, math.sqrt(a)))
+
+
+def distances(starts, ends):
+    """
+    Vectorized distance: great-circle distances between many pairs of points at once
+    :param starts: array-like of shape (n, 2), (lat, lng) of starting points in degrees
+    :param ends: array-like of shape (n, 2), (lat, lng) of ending points in degrees
+    :return: numpy array of n distances in meters
+    """
+    starts = np.radians(np.asarray(starts, dtype=float).reshape(-1, 2))
+    ends = np.radians(np.asarray(ends, dtype=float).reshape(-1, 2))
+    lat1, lng1 = starts[:, 0], starts[:, 1]
+    lat2, lng2 = ends[:, 0], ends[:, 1]
+    a = np.sin((lat2 - lat1) / 2) ** 2 + np.cos(lat1) * np.cos(lat2) * np.sin((lng2 - lng1) / 2) ** 2
+    return 2 * EARTH_RADIUS * np.arcsin(np.minimum(1.0, np.sqrt(a)))
+
+
+def distance_matrix(points):
+    """
+    Vectorized distance between every pair of points
+    :param points: array-like of shape (n, 2), (lat, lng) of points in degrees
+    :return: numpy array of shape (n, n), distances in meters
+    """
+    points = np.radians(np.asarray(points, dtype=float).reshape(-1, 2))
+    lat, lng = points[:, 0], points[:, 1]
+    a = (np.sin((lat[:, None] - lat[None, :]) / 2) ** 2 +
+         np.outer(np.cos(lat), np.cos(lat)) * np.sin((lng[:, None] - lng[None, :]) / 2) ** 2)
+    return 2 * EARTH_RADIUS * np.arcsin(np.minimum(1.0, np.sqrt(a)))
+
+
+def encode_polyline(points):
+    """
+    Encodes points with Google encoded polyline algorithm
+    :param points: iterable of (lat, lng) in degrees
+    :return: str, encoded polyline
+    """
+    chunks = []
+    previous_lat = previous_lng = 0
+    for lat, lng in points:
+        lat, lng = int(round(lat * 1e5)), int(round(lng * 1e5))
+        for delta in (lat - previous_lat, lng - previous_lng):
+            value = ~(delta << 1) if delta < 0 else delta << 1
+            while value >= 0x20:
+                chunks.append(chr((0x20 | (value & 0x1f)) + 63))
+                value >>= 5
+            chunks.append(chr(value + 63))
+        previous_lat, previous_lng = lat, lng
+    return ''.join(chunks)
+
+
+def decode_polyline(encoded):
+    """
+    Decodes Google encoded polyline. All characters are decoded at once: 5-bit chunks are shifted into place
+    and summed per value, values are turned into coordinates by cumulative sums of deltas
+    :param encoded: str, encoded polyline
+    :return: numpy array of shape (n, 2), (lat, lng) of points in degrees
+    """
+    chunks = np.frombuffer(encoded.encode('ascii'), dtype=np.uint8).astype(np.int64) - 63
+    if not len(chunks):
+        return np.empty((0, 2))
+    last = chunks < 0x20
+    # Number of value each chunk belongs to and chunk position inside the value
+    value_ids = np.concatenate(([0], np.cumsum(last)[:-1]))
+    starts = np.flatnonzero(np.concatenate(([True], last[:-1])))
+    positions = np.arange(len(chunks)) - starts[value_ids]
+    values = np.add.reduceat((chunks & 0x1f) << (5 * positions), starts)
+    deltas = (values >> 1) ^ -(values & 1)
+    return np.cumsum(deltas.reshape(-1, 2), axis=0) / 1e5
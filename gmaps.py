@@ -0,0 +1,165 @@
+import asyncio
+import json
+import logging
+import random
+import time
+
+import aiohttp
+
+import config
+import metrics
+import ratelimit
+
+logger = logging.getLogger(__name__)
+
+# Responses worth repeating: Google throttling and transient server errors
+RETRY_STATUSES = {429, 500, 502, 503, 504}
+
+# Endpoint names used in metrics and rate limits
+ENDPOINTS = {config.GMAPS_DIRECTIONS_URL: 'directions', config.GMAPS_IMAGE_URL: 'street_view',
+             config.GMAPS_GEOCODE_URL: 'geocoding'}
+
+
+class ImageNotAvailable(Exception):
+    """
+    Street View API responded with error instead of image
+    """
+
+
+class GoogleMapsClient:
+    """
+    Asynchronous Google Maps client. All requests share single keep-alive connection pool
+    """
+
+    def __init__(self, key=None, pool_size=None, retries=None, backoff=None, limiter=None):
+        """
+        :param key: Google Maps API key (config.GMAPS_TOKEN by default)
+        :param pool_size: maximum number of simultaneous connections
+        :param retries: number of repeated attempts after failed request
+        :param backoff: base delay (seconds) of exponential backoff between attempts
+        :param limiter: ratelimit.RateLimiter shared by workers (requests are not limited if None)
+        """
+        self.key = key or config.GMAPS_TOKEN
+        self.pool_size = pool_size or config.GMAPS_POOL_SIZE
+        self.retries = config.GMAPS_RETRIES if retries is None else retries
+        self.backoff = backoff or config.GMAPS_BACKOFF
+        self.timeouts = {config.GMAPS_DIRECTIONS_URL: aiohttp.ClientTimeout(total=config.GMAPS_DIRECTIONS_TIMEOUT),
+                         config.GMAPS_IMAGE_URL: aiohttp.ClientTimeout(total=config.GMAPS_IMAGE_TIMEOUT),
+                         config.GMAPS_GEOCODE_URL: aiohttp.ClientTimeout(total=config.GMAPS_DIRECTIONS_TIMEOUT)}
+        self.limiter = limiter
+        self._session = None
+
+    @property
+    def session(self):
+        """
+        Shared HTTP session. Created lazily inside running event loop
+        """
+        if self._session is None or self._session.closed:
+            connector = aiohttp.TCPConnector(limit=self.pool_size,
+                                             keepalive_timeout=config.GMAPS_KEEPALIVE_TIMEOUT,
+                                             ttl_dns_cache=300)
+            self._session = aiohttp.ClientSession(connector=connector)
+        return self._session
+
+    async def _request(self, url, params):
+        """
+        Sends GET request with bounded number of retries and jittered exponential backoff
+        :param url: endpoint url
+        :param params: query parameters (API key is added automatically)
+        :return: tuple (response status, response content type, response body as bytes)
+        """
+        params = {key: value for key, value in params.items() if value is not None}
+        params['key'] = self.key
+        timeout = self.timeouts.get(url)
+        endpoint = ENDPOINTS.get(url, url)
+
+        for attempt in range(self.retries + 1):
+            started = time.perf_counter()
+            try:
+                async with self.session.get(url, params=params, timeout=timeout) as response:
+                    body = await response.read()
+                    metrics.GMAPS_LATENCY.labels(endpoint).observe(time.perf_counter() - started)
+                    metrics.GMAPS_RESPONSES.labels(endpoint, response.status).inc()
+                    if response.status not in RETRY_STATUSES or attempt == self.retries:
+                        return response.status, response.content_type, body
+                    logger.warning('Google Maps responded %s, retrying (%s/%s)', response.status, attempt + 1,
+                                   self.retries)
+            except (aiohttp.ClientError, asyncio.TimeoutError) as error:
+                metrics.GMAPS_RESPONSES.labels(endpoint, type(error).__name__).inc()
+                if attempt == self.retries:
+                    raise
+                logger.warning('Google Maps request failed: %r, retrying (%s/%s)', error, attempt + 1, self.retries)
+
+            # Full jitter: random delay up to exponentially growing cap
+            await asyncio.sleep(random.uniform(0, self.backoff * 2 ** attempt))
+
+    async def _acquire(self, endpoint, chat):
+        if self.limiter is not None:
+            await self.limiter.acquire(endpoint, chat)
+
+    async def directions(self, payload, chat=None):
+        """
+        Requests route from Google Directions API
+        :param payload: dictionary of Directions API parameters
+        :param chat: id of chat route is requested for
+        :return: dict, decoded Directions response
+        """
+        try:
+            await self._acquire('directions', chat)
+        except ratelimit.QuotaExceeded as error:
+            logger.warning('Directions request rejected: %s', error)
+            return {'status': 'OVER_QUERY_LIMIT', 'routes': []}
+
+        try:
+            status, _, body = await self._request(config.GMAPS_DIRECTIONS_URL, payload)
+            result = json.loads(body)
+            metrics.GMAPS_DIRECTIONS_STATUSES.labels(result.get('status')).inc()
+            return result
+        except (aiohttp.ClientError, asyncio.TimeoutError, ValueError) as error:
+            logger.error('Directions request failed: %r', error)
+            return {'status': 'UNKNOWN_ERROR', 'routes': []}
+
+    async def geocode(self, address, chat=None):
+        """
+        Resolves address to coordinates with Google Geocoding API
+        :param address: place as typed by user
+        :param chat: id of chat place is resolved for
+        :return: dict, decoded Geocoding response
+        """
+        try:
+            await self._acquire('geocoding', chat)
+        except ratelimit.QuotaExceeded as error:
+            logger.warning('Geocoding request rejected: %s', error)
+            return {'status': 'OVER_QUERY_LIMIT', 'results': []}
+
+        try:
+            status, _, body = await self._request(config.GMAPS_GEOCODE_URL, {'address': address})
+            return json.loads(body)
+        except (aiohttp.ClientError, asyncio.TimeoutError, ValueError) as error:
+            logger.error('Geocoding request failed: %r', error)
+            return {'status': 'UNKNOWN_ERROR', 'results': []}
+
+    async def street_view(self, payload, chat=None):
+        """
+        Requests panorama image from Google Street View API
+        :param payload: dictionary of Street View API parameters
+        :param chat: id of chat image is requested for
+        :return: image (as byte string)
+        :raise ratelimit.QuotaExceeded: daily quota is exhausted or request has waited for too long
+        :raise ImageNotAvailable: response is not an image (e.g. invalid key or over quota)
+        """
+        await self._acquire('street_view', chat)
+        status, content_type, body = await self._request(config.GMAPS_IMAGE_URL, payload)
+        if status != 200 or not content_type.startswith('image/'):
+            raise ImageNotAvailable('Street View responded {} {}: {!r}'.format(status, content_type, body[:200]))
+        return body
+
+    async def close(self):
+        """
+        Closes connection pool. Should be called on bot shutdown
+        """
+        if self._session is not None and not self._session.closed:
+            await self._session.close()
+
+
+client = GoogleMapsClient()
@@ -1,31 +1,76 @@
-from aiogram import Bot, types
+from aiogram import types
+from aiogram.bot.api import TelegramAPIServer
 from aiogram.dispatcher import Dispatcher
 from aiogram.utils import executor
-from aiogram.dispatcher import FSMContext
+from aiogram.utils.exceptions import BadRequest
 from aiogram.dispatcher.filters.state import State, StatesGroup
-from aiogram.contrib.fsm_storage.redis import RedisStorage2
-import requests
+import prometheus_client
+import asyncio
 import logging
-import functools
-import operator
+import os
 
+import cache
 import config
+import gmaps
 import messages
+import metrics
 import keyboard
 import parameters
+import planner
+import prefetch
+import profiler
+import ratelimit
+import router
+import routes
+import routing
+import sender
+import sharding
+import tracking
+import user_session
+import webhook
 
 if config.redis_password:
-    redis_storage = RedisStorage2(host=config.redis_host,
-                                  port=config.redis_port,
-                                  password=config.redis_password,
-                                  db=0)
+    redis_storage = metrics.MetricsRedisStorage(host=config.redis_host,
+                                                port=config.redis_port,
+                                                password=config.redis_password,
+                                                db=0)
 else:
-    redis_storage = RedisStorage2(host=config.redis_host,
-                                  port=config.redis_port,
-                                  db=0)
-
-bot = Bot(token=config.TG_TOKEN)
+    redis_storage = metrics.MetricsRedisStorage(host=config.redis_host,
+                                                port=config.redis_port,
+                                                db=0)
+
+directions_cache = cache.DirectionsCache(redis_storage.redis)
+prometheus_client.REGISTRY.register(metrics.DirectionsCacheCollector(directions_cache))
+street_view_cache = cache.StreetViewCache(redis_storage.redis)
+directions_flight = cache.SingleFlight(redis_storage.redis, prefix='directions_flight')
+geocode_cache = cache.GeocodeCache(redis_storage.redis)
+geocode_flight = cache.SingleFlight(redis_storage.redis, prefix='geocode_flight')
+prometheus_client.REGISTRY.register(metrics.SingleFlightCollector({'directions': directions_flight,
+                                                                   'geocode': geocode_flight}))
+route_storage = routes.RouteStorage(redis_storage.redis)
+gmaps.client.limiter = ratelimit.RateLimiter(redis_storage.redis)
+prometheus_client.REGISTRY.register(metrics.RateLimiterCollector(gmaps.client.limiter))
+street_view_prefetcher = prefetch.StreetViewPrefetcher(route_storage, street_view_cache, gmaps.client)
+# Offline routing from OpenStreetMap graph: fallback when Google cannot answer or the only backend (config
+# requires graph then)
+local_router = routing.LocalRouter() if config.LOCAL_ROUTING_GRAPH else None
+
+if config.TG_API_SERVER:
+    bot = metrics.MetricsBot(token=config.TG_TOKEN, server=TelegramAPIServer.from_base(config.TG_API_SERVER))
+else:
+    bot = metrics.MetricsBot(token=config.TG_TOKEN)
 dp = Dispatcher(bot, storage=redis_storage)
+# Replies are queued within Telegram limits, navigation replies first
+send_scheduler = sender.SendScheduler()
+# Inline navigation: route message is edited in place instead of new message for every step
+message_editor = sender.MessageEditor(send_scheduler)
+inline_navigation = config.NAVIGATION_KEYBOARD == 'inline'
+# Live location updates of users standing still are dropped before user session is loaded
+live_tracker = tracking.LiveTracker(route_storage)
+reroute_cooldown = ratelimit.ChatCooldown(redis_storage.redis, 'reroute', config.REROUTE_INTERVAL)
+dp.middleware.setup(tracking.LiveLocationMiddleware(live_tracker))
+session_middleware = user_session.SessionMiddleware()
+dp.middleware.setup(session_middleware)
 logging.basicConfig(level=logging.INFO)
 
 
@@ -34,8 +79,153 @@ class UserStates(StatesGroup):
     List of all bot states
     """
     START, TRAVEL_MODE, OPTIONS, SET_UNITS, SET_AVOIDANCE, SET_TRAFFIC_MODEL, SET_TRANSIT_MODE, SET_TRANSIT_ROUTING, \
-        SET_ORIGIN, SET_DESTINATION, SET_WAYPOINTS, CONFIRMATION, BUILDING, FINISH = \
-        [State() for _ in range(14)]
+        SET_WAYPOINTS_ORDER, SET_ORIGIN, SET_DESTINATION, SET_WAYPOINTS, CONFIRMATION, BUILDING, FINISH = \
+        [State() for _ in range(15)]
+
+
+# States of choosing parameter value
+PARAMETER_STATES = {'mode': UserStates.TRAVEL_MODE,
+                    'units': UserStates.SET_UNITS,
+                    'avoid': UserStates.SET_AVOIDANCE,
+                    'traffic_model': UserStates.SET_TRAFFIC_MODEL,
+                    'transit_mode': UserStates.SET_TRANSIT_MODE,
+                    'transit_routing_preference': UserStates.SET_TRANSIT_ROUTING,
+                    'waypoints_order': UserStates.SET_WAYPOINTS_ORDER}
+# Keyboard buttons are dispatched by (state, button) table, see process_button
+button_router = router.ButtonRouter(UserStates)
+
+dp.middleware.setup(metrics.MetricsMiddleware(navigation_states=[UserStates.BUILDING.state]))
+profiler_middleware = profiler.ProfilerMiddleware(redis_storage.redis)
+dp.middleware.setup(profiler_middleware)
+
+
+async def get_directions(payload_maps, chat=None):
+    """
+    Gets route from directions cache or from Google Directions API on cache miss.
+    Identical requests made at the same time share single Google Directions call.
+    When Google cannot answer (outage, exhausted quota) route is built offline if road graph is available
+    :param payload_maps: dictionary of Directions API parameters
+    :param chat: id of chat route is requested for
+    :return: dict, Directions response
+    """
+    if config.ROUTING_BACKEND == 'local':
+        return await local_router.directions(payload_maps, chat=chat)
+
+    async def request_directions():
+        result = await gmaps.client.directions(payload_maps, chat=chat)
+        await directions_cache.set(payload_maps, result)
+        return result
+
+    gmaps_data = await directions_cache.get(payload_maps)
+    if gmaps_data is None:
+        gmaps_data = await directions_flight.do(cache.directions_key(payload_maps), request_directions)
+    logging.debug('Directions cache: %s, coalescing: %s', directions_cache.stats, directions_flight.stats)
+
+    if gmaps_data['status'] in routing.FALLBACK_STATUSES and local_router is not None:
+        # Offline route is not cached: Google is asked again as soon as it is back
+        local_data = await local_router.directions(payload_maps, chat=chat)
+        if local_data['status'] == 'OK':
+            return local_data
+
+    return gmaps_data
+
+
+def directions_payload(user_data, origin, destination, waypoints):
+    """
+    :param user_data: user data with route options
+    :param origin: origin location
+    :param destination: destination location
+    :param waypoints: list of waypoint locations
+    :return: dictionary of Directions API parameters
+    """
+    return {
+        'origin': origin,
+        'destination': destination,
+        'mode': user_data['mode'],
+        'waypoints': '|'.join(waypoints),
+        'units': user_data['units'],
+        'avoid': '|'.join(messages.multi_selection_setting_format(user_data, 'avoid')),
+        'traffic_model': user_data['traffic_model'],
+        'transit_mode': '|'.join(messages.multi_selection_setting_format(user_data, 'transit_mode')),
+        'departure_time': user_data['departure_time'],
+        'transit_routing_preference': user_data['transit_routing_preference']
+    }
+
+
+async def resolve_location(location, chat=None):
+    """
+    Resolves place typed as text to coordinates with geocoding cache or Google Geocoding API on cache miss,
+    so Directions requests for the same place are equal whatever way it was typed
+    :param location: location as text or 'lat,lng' string
+    :param chat: id of chat location is resolved for
+    :return: str, 'lat,lng' or location as is if it can not be resolved
+    """
+    if cache.COORDINATES_REGEXP.match(location):
+        return location
+
+    async def request_geocode():
+        result = await gmaps.client.geocode(location, chat=chat)
+        if result['status'] == 'OK':
+            coordinates = result['results'][0]['geometry']['location']
+            resolved = cache.format_location(coordinates['lat'], coordinates['lng'])
+        elif result['status'] == 'ZERO_RESULTS':
+            resolved = ''
+        else:
+            # Google could not answer now: not remembered
+            return None
+        await geocode_cache.set(location, resolved)
+        return resolved
+
+    resolved = await geocode_cache.get(location)
+    if resolved is None:
+        resolved = await geocode_flight.do(cache.geocode_key(location), request_geocode)
+    # Unknown places are left to Directions API, which reports them as not found
+    return resolved or location
+
+
+async def send_street_view(message: types.Message, payload_view, **kwargs):
+    """
+    Sends Street View image. Already uploaded images are resent by Telegram file_id,
+    new images are taken from image cache or Google Street View API and their file_id is remembered
+    :param message: incoming message
+    :param payload_view: dictionary of Street View API parameters
+    :param kwargs: answer_photo arguments
+    """
+    file_id = await street_view_cache.get_file_id(payload_view)
+    if file_id:
+        try:
+            return await send_scheduler.send(message.chat.id, lambda: message.answer_photo(file_id, **kwargs),
+                                             sender.INTERACTIVE)
+        except BadRequest:
+            # Telegram does not know this file anymore
+            await street_view_cache.delete_file_id(payload_view)
+
+    image = await street_view_cache.get_image(payload_view)
+    if image is None:
+        image = await gmaps.client.street_view(payload_view, chat=message.chat.id)
+        await street_view_cache.set_image(payload_view, image)
+
+    sent = await send_scheduler.send(message.chat.id, lambda: message.answer_photo(image, **kwargs),
+                                     sender.INTERACTIVE)
+    await street_view_cache.set_file_id(payload_view, sent.photo[-1].file_id)
+    return sent
+
+
+def send_step(message: types.Message, text):
+    """
+    Sends route step with navigation keyboard. Step still queued is replaced with newer one
+    :param message: incoming message
+    :param text: step message text
+    """
+    if inline_navigation:
+        message_editor.send(message, text, collapse='step',
+                            reply_markup=keyboard.INLINE_KEYBOARDS['navigation'],
+                            parse_mode='HTML')
+    else:
+        send_scheduler.answer(message, text,
+                              reply_markup=keyboard.KEYBOARDS['navigation'],
+                              parse_mode='HTML',
+                              priority=sender.INTERACTIVE, collapse='step')
 
 
 def process_location(message: types.Message):
@@ -45,8 +235,8 @@ def process_location(message: types.Message):
     :return: str: message text or geographical coordinates
     """
     try:
-        # Processing location as geopoint
-        location = '{},{}'.format(message.location.latitude, message.location.longitude)
+        # Processing location as geopoint: nearby points share cache entries
+        location = cache.format_location(message.location.latitude, message.location.longitude)
     except AttributeError:
         # Processing location as text
         location = message.text
@@ -54,71 +244,80 @@ def process_location(message: types.Message):
     return location
 
 
+async def process_route_expired(message: types.Message, session: user_session.UserSession):
+    """
+    Route steps are not stored anymore: return to main menu
+    """
+    send_scheduler.answer(message, messages.ROUTE_EXPIRED_MESSAGE,
+                          reply_markup=keyboard.KEYBOARDS['commands'],
+                          parse_mode='HTML',
+                          priority=sender.INTERACTIVE)
+    session.set_state(UserStates.START)
+
+
 async def process_selection(message: types.Message,
-                            state: FSMContext,
+                            session: user_session.UserSession,
                             parameter_name):
     """
     Changing selection parameter (e.g. travel mode) processing
     :param message: incoming message
-    :param state: current state context
+    :param session: current user session
     :param parameter_name: parameter name to be changed
     """
     content = config.DEFAULT_USER_DATA[parameter_name] if message.text == 'clear' else message.text
     if content != 'back':
-        await state.update_data(**{parameter_name: content})
-        await message.answer(messages.CHANGED_PARAMETER_MESSAGE.format(parameters.PARAMETER_NAMES[parameter_name],
-                                                                       content),
-                             parse_mode='HTML')
+        session.update_data(**{parameter_name: content})
+        send_scheduler.answer(message,
+                              messages.CHANGED_PARAMETER_MESSAGE.format(parameters.PARAMETER_NAMES[parameter_name],
+                                                                        content),
+                              parse_mode='HTML')
 
 
-async def process_selection_back(message: types.Message, state: FSMContext):
-    user_data = await state.get_data()
+async def process_selection_back(message: types.Message, session: user_session.UserSession):
+    user_data = session.data
 
-    await message.answer(messages.reply_current_options(user_data),
-                         reply_markup=keyboard.create_keyboard(keyboard.OPTION_BUTTONS['options'],
-                                                               one_time_keyboard=False,
-                                                               row_len=3),
-                         parse_mode='HTML')
-    await UserStates.OPTIONS.set()
+    send_scheduler.answer(message, messages.reply_current_options(user_data),
+                          reply_markup=keyboard.KEYBOARDS['options'],
+                          parse_mode='HTML')
+    session.set_state(UserStates.OPTIONS)
 
 
 async def process_multi_selection(message: types.Message,
-                                  state: FSMContext,
+                                  session: user_session.UserSession,
                                   parameter_name):
     """
     Changing multiple selection (e.g. avoidance) parameter
     :param message: incoming message
-    :param state: current state context
+    :param session: current user session
     :param parameter_name: parameter name to be changed
     """
     content = message.text
-    user_data = await state.get_data()
+    user_data = session.data
     if content == 'back':
-        await process_selection_back(message, state)
+        await process_selection_back(message, session)
     else:
         user_data[parameter_name][content] = not user_data[parameter_name][content]
-        await state.update_data(**{parameter_name: user_data[parameter_name]})
+        session.update_data(**{parameter_name: user_data[parameter_name]})
 
         selected = messages.multi_selection_setting_format(user_data, parameter_name)
 
-        await message.answer(messages.CHANGED_PARAMETER_MESSAGE.format(parameters.PARAMETER_NAMES[parameter_name],
-                                                                       ', '.join(selected)),
-                             reply_markup=keyboard.create_keyboard(keyboard.OPTION_BUTTONS[parameter_name],
-                                                                   one_time_keyboard=False,
-                                                                   row_len=3),
-                             parse_mode='HTML')
+        send_scheduler.answer(message,
+                              messages.CHANGED_PARAMETER_MESSAGE.format(parameters.PARAMETER_NAMES[parameter_name],
+                                                                        ', '.join(selected)),
+                              reply_markup=keyboard.KEYBOARDS[parameter_name],
+                              parse_mode='HTML')
 
 
 @dp.message_handler(commands=['start'])
-async def process_start_command(message: types.Message, state: FSMContext):
+async def process_start_command(message: types.Message, session: user_session.UserSession):
     """
     Start command processing: set start state and send welcome message
     """
-    await UserStates.START.set()
-    await state.update_data(**config.DEFAULT_USER_DATA)
-    await message.answer(messages.WELCOME_MESSAGE,
-                         reply_markup=keyboard.create_keyboard(keyboard.COMMANDS, one_time_keyboard=False),
-                         parse_mode='HTML')
+    session.set_state(UserStates.START)
+    session.update_data(**config.DEFAULT_USER_DATA)
+    send_scheduler.answer(message, messages.WELCOME_MESSAGE,
+                          reply_markup=keyboard.KEYBOARDS['commands'],
+                          parse_mode='HTML')
 
 
 @dp.message_handler(commands=['help'],
@@ -127,330 +326,396 @@ async def process_help_command(message: types.Message):
     """
     Help command processing
     """
-    await message.answer(messages.HELP_MESSAGE,
-                         parse_mode='HTML')
+    send_scheduler.answer(message, messages.HELP_MESSAGE,
+                          parse_mode='HTML')
 
 
 @dp.message_handler(commands=['transport'],
                     state=UserStates.START)
-async def process_transport_command(message: types.Message, state: FSMContext):
+async def process_transport_command(message: types.Message, session: user_session.UserSession):
     """
     Setting travel mode command processing
     """
-    user_data = await state.get_data()
-    await message.answer(messages.TRAVEL_MODE_MESSAGE.format(user_data['mode']),
-                         reply_markup=keyboard.create_keyboard(keyboard.OPTION_BUTTONS['mode']),
-                         parse_mode='HTML')
-    await UserStates.TRAVEL_MODE.set()
+    user_data = session.data
+    send_scheduler.answer(message, messages.TRAVEL_MODE_MESSAGE.format(user_data['mode']),
+                          reply_markup=keyboard.KEYBOARDS['mode'],
+                          parse_mode='HTML')
+    session.set_state(UserStates.TRAVEL_MODE)
 
 
-@dp.message_handler(lambda message: message.text in keyboard.OPTION_BUTTONS['mode'],
-                    state=UserStates.TRAVEL_MODE)
-async def process_transport_selection(message: types.Message, state: FSMContext):
+async def process_transport_selection(message: types.Message, session: user_session.UserSession):
     """
     Setting travel mode input processing
     """
     await process_selection(message=message,
-                            state=state,
+                            session=session,
                             parameter_name='mode')
-    await message.answer(messages.WAITING_MESSAGE,
-                         reply_markup=keyboard.create_keyboard(keyboard.COMMANDS, one_time_keyboard=False, row_len=2),
-                         parse_mode='HTML')
-    await UserStates.START.set()
+    send_scheduler.answer(message, messages.WAITING_MESSAGE,
+                          reply_markup=keyboard.KEYBOARDS['commands'],
+                          parse_mode='HTML')
+    session.set_state(UserStates.START)
 
 
 @dp.message_handler(commands=['options'],
                     state=UserStates.START)
-async def process_options_command(message: types.Message, state: FSMContext):
+async def process_options_command(message: types.Message, session: user_session.UserSession):
     """
     Options command processing
     """
-    user_data = await state.get_data()
+    user_data = session.data
 
-    await message.answer(messages.reply_current_options(user_data),
-                         reply_markup=keyboard.create_keyboard(keyboard.OPTION_BUTTONS['options'], row_len=3),
-                         parse_mode='HTML')
-    await UserStates.OPTIONS.set()
+    send_scheduler.answer(message, messages.reply_current_options(user_data),
+                          reply_markup=keyboard.KEYBOARDS['options'],
+                          parse_mode='HTML')
+    session.set_state(UserStates.OPTIONS)
 
 
-@dp.message_handler(lambda message: message.text in keyboard.OPTION_BUTTONS['options'],
-                    state=UserStates.OPTIONS)
-async def process_options_selection(message: types.Message, state: FSMContext):
-    """
-    Options selection processing
+async def process_option_menu(message: types.Message,
+                              session: user_session.UserSession,
+                              parameter_name):
     """
-    content = message.text
-
-    user_data = await state.get_data()
-    
-    if content == 'units':
-        # Setting units
-        await message.answer(messages.UNITS_MESSAGE.format(user_data['units']),
-                             reply_markup=keyboard.create_keyboard(keyboard.OPTION_BUTTONS['units'], row_len=3),
-                             parse_mode='HTML')
-        await UserStates.SET_UNITS.set()
-
-    elif content == 'avoid':
-        # Setting avoidance
-        selected = messages.multi_selection_setting_format(user_data, 'avoid')
-        await message.answer(messages.AVOID_MESSAGE.format(', '.join(selected)),
-                             reply_markup=keyboard.create_keyboard(keyboard.OPTION_BUTTONS['avoid'],
-                                                                   one_time_keyboard=False,
-                                                                   row_len=3),
-                             parse_mode='HTML')
-        await UserStates.SET_AVOIDANCE.set()
-
-    elif content == 'traffic model':
-        # Setting traffic model
-        await message.answer(messages.TRAFFIC_MODEL_MESSAGE.format(user_data['traffic_model']),
-                             reply_markup=keyboard.create_keyboard(keyboard.OPTION_BUTTONS['traffic_model'], row_len=3),
-                             parse_mode='HTML')
-        await UserStates.SET_TRAFFIC_MODEL.set()
-
-    elif content == 'transit mode':
-        # Setting transit mode
-        selected = messages.multi_selection_setting_format(user_data, 'transit_mode')
-        await message.answer(messages.TRANSIT_MODE_MESSAGE.format(', '.join(selected)),
-                             reply_markup=keyboard.create_keyboard(keyboard.OPTION_BUTTONS['transit_mode'],
-                                                                   one_time_keyboard=False,
-                                                                   row_len=3),
-                             parse_mode='HTML')
-        await UserStates.SET_TRANSIT_MODE.set()
-
-    elif content == 'transit routing preference':
-        # Setting transit routing preference
-        await message.answer(messages.TRANSIT_ROUTING_MESSAGE.format(user_data['transit_routing_preference']),
-                             reply_markup=keyboard.create_keyboard(keyboard.OPTION_BUTTONS
-                                                                   ['transit_routing_preference'], row_len=3),
-                             parse_mode='HTML')
-        await UserStates.SET_TRANSIT_ROUTING.set()
-
-    elif content == 'back':
-        # Return to main menu
-        await message.answer(messages.WAITING_MESSAGE,
-                             reply_markup=keyboard.create_keyboard(keyboard.COMMANDS, one_time_keyboard=False),
-                             parse_mode='HTML')
-        await UserStates.START.set()
-
-
-@dp.message_handler(lambda message: message.text in keyboard.OPTION_BUTTONS['units'],
-                    state=UserStates.SET_UNITS)
-async def process_units_selection(message: types.Message, state: FSMContext):
-    """
-    Units selection processing
+    Option chosen in options menu: current value is shown with keyboard of values
+    :param message: incoming message
+    :param session: current user session
+    :param parameter_name: parameter name to be changed
     """
-    await process_selection(message=message,
-                            state=state,
-                            parameter_name='units')
-
-    await process_selection_back(message, state)
+    send_scheduler.answer(message, messages.reply_parameter_prompt(session.data, parameter_name),
+                          reply_markup=keyboard.KEYBOARDS[parameter_name],
+                          parse_mode='HTML')
+    session.set_state(PARAMETER_STATES[parameter_name])
 
 
-@dp.message_handler(lambda message: message.text in keyboard.OPTION_BUTTONS['traffic_model'],
-                    state=UserStates.SET_TRAFFIC_MODEL)
-async def process_traffic_model_selection(message: types.Message, state: FSMContext):
+async def process_options_back(message: types.Message, session: user_session.UserSession):
     """
-    Traffic model selection processing
+    Return from options menu to main menu
     """
+    send_scheduler.answer(message, messages.WAITING_MESSAGE,
+                          reply_markup=keyboard.KEYBOARDS['commands'],
+                          parse_mode='HTML')
+    session.set_state(UserStates.START)
 
-    await process_selection(message=message,
-                            state=state,
-                            parameter_name='traffic_model')
 
-    await process_selection_back(message, state)
-
-
-@dp.message_handler(lambda message: message.text in keyboard.OPTION_BUTTONS['transit_routing_preference'],
-                    state=UserStates.SET_TRANSIT_ROUTING)
-async def process_transit_routing_selection(message: types.Message, state: FSMContext):
+async def process_option_selection(message: types.Message,
+                                   session: user_session.UserSession,
+                                   parameter_name):
     """
-    Transit routing selection processing
+    Single selection option value processing: value is set and options menu is shown again
+    :param message: incoming message
+    :param session: current user session
+    :param parameter_name: parameter name to be changed
     """
     await process_selection(message=message,
-                            state=state,
-                            parameter_name='transit_routing_preference')
+                            session=session,
+                            parameter_name=parameter_name)
 
-    await process_selection_back(message, state)
+    await process_selection_back(message, session)
 
 
-@dp.message_handler(lambda message: message.text in keyboard.OPTION_BUTTONS['avoid'],
-                    state=UserStates.SET_AVOIDANCE)
-async def process_avoid_selection(message: types.Message, state: FSMContext):
-    await process_multi_selection(message, state, 'avoid')
-
-
-@dp.message_handler(lambda message: message.text in keyboard.OPTION_BUTTONS['transit_mode'],
-                    state=UserStates.SET_TRANSIT_MODE)
-async def process_transit_mode_selection(message: types.Message, state: FSMContext):
-    await process_multi_selection(message, state, 'transit_mode')
+@dp.message_handler(button_router.filter,
+                    state='*')
+async def process_button(message: types.Message, session: user_session.UserSession, route: router.Route):
+    """
+    Keyboard button processing: handler of button in current state is found by button_router filter
+    """
+    await route.handler(message, session, **route.kwargs)
 
 
-@dp.message_handler(lambda message: message.text == 'cancel',
-                    state='*')
-async def process_cancel(message: types.Message, state: FSMContext):
-    await state.update_data(**config.DEFAULT_GEO_DATA)
-    await message.answer(messages.CANCEL_MESSAGE,
-                         reply_markup=keyboard.create_keyboard(keyboard.COMMANDS, one_time_keyboard=False),
-                         parse_mode='HTML')
-    await UserStates.START.set()
+async def process_cancel(message: types.Message, session: user_session.UserSession):
+    user_data = session.data
+    street_view_prefetcher.cancel(message.chat.id)
+    live_tracker.forget(message.chat.id)
+    await route_storage.delete(message.chat.id, user_data.get('route'))
+    session.update_data(**config.DEFAULT_GEO_DATA)
+    send_scheduler.answer(message, messages.CANCEL_MESSAGE,
+                          reply_markup=keyboard.KEYBOARDS['commands'],
+                          parse_mode='HTML')
+    session.set_state(UserStates.START)
 
 
 @dp.message_handler(commands=['go'],
                     state=UserStates.START)
-async def process_go_command(message: types.Message):
+async def process_go_command(message: types.Message, session: user_session.UserSession):
     """
     Go command processing
     """
-    await message.answer(messages.ORIGIN_REQUEST_MESSAGE,
-                         reply_markup=keyboard.create_keyboard(keyboard.PATHFINDER_BUTTONS['cancel'],
-                                                               one_time_keyboard=False),
-                         parse_mode='HTML')
-    await UserStates.SET_ORIGIN.set()
+    send_scheduler.answer(message, messages.ORIGIN_REQUEST_MESSAGE,
+                          reply_markup=keyboard.KEYBOARDS['cancel'],
+                          parse_mode='HTML')
+    session.set_state(UserStates.SET_ORIGIN)
 
 
 @dp.message_handler(state=UserStates.SET_ORIGIN,
                     content_types=[types.ContentType.TEXT, types.ContentType.LOCATION])
-async def process_origin(message: types.Message, state: FSMContext):
+async def process_origin(message: types.Message, session: user_session.UserSession):
     """
     Setting origin point processing
     """
 
-    await state.update_data(origin=process_location(message))
+    session.update_data(origin=process_location(message))
 
-    await message.answer(messages.DESTINATION_REQUEST_MESSAGE,
-                         reply_markup=keyboard.create_keyboard(keyboard.PATHFINDER_BUTTONS['cancel'],
-                                                               one_time_keyboard=False),
-                         parse_mode='HTML')
+    send_scheduler.answer(message, messages.DESTINATION_REQUEST_MESSAGE,
+                          reply_markup=keyboard.KEYBOARDS['cancel'],
+                          parse_mode='HTML')
 
-    await UserStates.SET_DESTINATION.set()
+    session.set_state(UserStates.SET_DESTINATION)
 
 
 @dp.message_handler(state=UserStates.SET_DESTINATION,
                     content_types=[types.ContentType.TEXT, types.ContentType.LOCATION])
-async def process_destination(message: types.Message, state: FSMContext):
+async def process_destination(message: types.Message, session: user_session.UserSession):
     """
     Setting destination point processing
     """
 
-    await state.update_data(destination=process_location(message))
+    session.update_data(destination=process_location(message))
 
-    await message.answer(messages.WAYPOINT_REQUEST_MESSAGE,
-                         reply_markup=keyboard.create_keyboard(keyboard.PATHFINDER_BUTTONS['waypoint'], row_len=1),
-                         parse_mode='HTML')
-    await UserStates.SET_WAYPOINTS.set()
+    send_scheduler.answer(message, messages.WAYPOINT_REQUEST_MESSAGE,
+                          reply_markup=keyboard.KEYBOARDS['waypoint'],
+                          parse_mode='HTML')
+    session.set_state(UserStates.SET_WAYPOINTS)
 
 
 @dp.message_handler(state=UserStates.SET_WAYPOINTS,
                     content_types=[types.ContentType.TEXT, types.ContentType.LOCATION])
-async def process_waypoints(message: types.Message, state: FSMContext):
+async def process_waypoints(message: types.Message, session: user_session.UserSession):
     content = message.text
-    user_data = await state.get_data()
+    user_data = session.data
 
     if content == 'skip':
         # Finishing adding waypoints
         waypoints_str = ' through <b>{}</b>'.format(", ".join(user_data['waypoints'])) if user_data['waypoints'] else ''
 
-        await message.answer(messages.CONFIRMATION_MESSAGE.format(user_data['mode'],
-                                                                  user_data['origin'],
-                                                                  user_data['destination'],
-                                                                  waypoints_str),
-                             reply_markup=keyboard.create_keyboard(keyboard.PATHFINDER_BUTTONS['start']),
-                             parse_mode='HTML')
+        send_scheduler.answer(message, messages.CONFIRMATION_MESSAGE.format(user_data['mode'],
+                                                                            user_data['origin'],
+                                                                            user_data['destination'],
+                                                                            waypoints_str),
+                              reply_markup=keyboard.KEYBOARDS['start'],
+                              parse_mode='HTML')
 
-        await UserStates.CONFIRMATION.set()
+        session.set_state(UserStates.CONFIRMATION)
 
     else:
         # Adding waypoint
         user_data['waypoints'].append(process_location(message))
-        await state.update_data(waypoints=user_data['waypoints'])
-        await message.answer(messages.WAYPOINT_REQUEST_MESSAGE,
-                             reply_markup=keyboard.create_keyboard(keyboard.PATHFINDER_BUTTONS['waypoint'], row_len=2),
-                             parse_mode='HTML')
+        session.update_data(waypoints=user_data['waypoints'])
+        send_scheduler.answer(message, messages.WAYPOINT_REQUEST_MESSAGE,
+                              reply_markup=keyboard.KEYBOARDS['waypoint'],
+                              parse_mode='HTML')
 
 
-@dp.message_handler(lambda message: message.text in keyboard.PATHFINDER_BUTTONS['start'],
-                    state=UserStates.CONFIRMATION)
-async def process_confirmation(message: types.Message, state: FSMContext):
+async def process_confirmation(message: types.Message, session: user_session.UserSession):
     """
     Confirmation processing
     """
-    user_data = await state.get_data()
+    user_data = session.data
 
-    payload_maps = {
-        'origin': user_data['origin'],
-        'destination': user_data['destination'],
-        'mode': user_data['mode'],
-        'waypoints': '|'.join(user_data['waypoints']),
-        'units': user_data['units'],
-        'avoid': '|'.join(messages.multi_selection_setting_format(user_data, 'avoid')),
-        'traffic_model': user_data['traffic_model'],
-        'transit_mode': '|'.join(messages.multi_selection_setting_format(user_data, 'transit_mode')),
-        'departure_time': user_data['departure_time'],
-        'transit_routing_preference': user_data['transit_routing_preference'],
-        'key': config.GMAPS_TOKEN
-    }
-    # Getting google maps data
-    gmaps_data = requests.get(config.GMAPS_DIRECTIONS_URL, params=payload_maps).json()
+    origin, destination, *waypoints = await asyncio.gather(
+        *[resolve_location(location, chat=message.chat.id)
+          for location in [user_data['origin'], user_data['destination']] + user_data['waypoints']])
+    if user_data.get('waypoints_order') == 'optimized':
+        waypoints = planner.optimize_waypoints(origin, destination, waypoints)
+    payload_maps = directions_payload(user_data, origin, destination, waypoints)
+    # Getting google maps data: long waypoint lists are requested in concurrent chunks
+    gmaps_data = await planner.chunked_directions(payload_maps,
+                                                  lambda payload: get_directions(payload, chat=message.chat.id))
 
     if gmaps_data['status'] != 'OK':
-        # Path not found
-        await message.answer(messages.NOT_FOUND_MESSAGE,
-                             reply_markup=keyboard.create_keyboard(keyboard.COMMANDS, one_time_keyboard=False),
-                             parse_mode='HTML')
-        await UserStates.START.set()
+        # Path not found or Google refused to build it
+        send_scheduler.answer(message,
+                              messages.DIRECTIONS_STATUS_MESSAGES.get(gmaps_data['status'], messages.NOT_FOUND_MESSAGE),
+                              reply_markup=keyboard.KEYBOARDS['commands'],
+                              parse_mode='HTML',
+                              priority=sender.INTERACTIVE)
+        session.set_state(UserStates.START)
 
     else:
         # Path found
-        await state.update_data(directions=functools.reduce(operator.iconcat, [leg["steps"] for leg in
-                                                                               gmaps_data["routes"][0]["legs"]], []))
-        await message.answer(messages.reply_message(await state.get_data()),
-                             reply_markup=keyboard.create_keyboard(keyboard.PATHFINDER_BUTTONS['navigation']),
-                             parse_mode='HTML')
-        await UserStates.BUILDING.set()
+        steps = routes.build_route(gmaps_data)
+        route_id = await route_storage.save(message.chat.id, steps, previous_route_id=user_data.get('route'),
+                                            geometry=routes.route_geometry(gmaps_data))
+        session.update_data(route=route_id, step=0)
+        street_view_prefetcher.schedule(message.chat.id, route_id, 0)
+        send_step(message, steps[0]['m'])
+        session.set_state(UserStates.BUILDING)
 
 
-@dp.message_handler(lambda message: message.text in keyboard.PATHFINDER_BUTTONS['navigation'],
-                    state=UserStates.BUILDING)
-async def process_path(message: types.Message, state: FSMContext):
+async def process_path(message: types.Message, session: user_session.UserSession):
     """
     Path processing
     """
-    content = message.text
-    user_data = await state.get_data()
-    steps_number = len(user_data['directions'])
+    await navigate(message, session, message.text)
+
+
+@dp.callback_query_handler(lambda query: query.data in keyboard.CALLBACKS,
+                           state=UserStates.BUILDING)
+async def process_path_button(query: types.CallbackQuery, session: user_session.UserSession):
+    """
+    Inline navigation button processing: route message the button is under is edited to the chosen step
+    """
+    await query.answer()
+    button = keyboard.CALLBACKS[query.data][1]
+    if button == 'cancel':
+        await process_cancel(query.message, session)
+    else:
+        await navigate(query.message, session, button, edit=True)
+
+
+@dp.callback_query_handler(state='*')
+async def process_expired_button(query: types.CallbackQuery):
+    """
+    Button of route message pressed after navigation is over
+    """
+    await query.answer(messages.BUTTON_EXPIRED_MESSAGE)
+
+
+async def navigate(message: types.Message, session: user_session.UserSession, content, edit=False):
+    """
+    Moves navigation by button
+    :param message: incoming message or route message to edit
+    :param content: button name
+    :param edit: True if step is shown by editing route message
+    """
+    user_data = session.data
 
     if content == 'target location image':
         # Getting target location image
-        await message.answer_photo(messages.reply_image(await state.get_data()),
-                                   reply_markup=keyboard.create_keyboard(keyboard.PATHFINDER_BUTTONS['navigation']),
+        step = await route_storage.get_step(message.chat.id, user_data.get('route'), user_data['step'])
+        if step is None:
+            await process_route_expired(message, session)
+            return
+        try:
+            # Photo can not be edited to step text, so it never has inline keyboard
+            await send_street_view(message, messages.street_view_payload(step),
+                                   reply_markup=None if inline_navigation else keyboard.KEYBOARDS['navigation'],
                                    parse_mode='HTML')
+        except ratelimit.QuotaExceeded:
+            send_scheduler.answer(message, messages.OVER_QUERY_LIMIT_MESSAGE,
+                                  reply_markup=None if inline_navigation else keyboard.KEYBOARDS['navigation'],
+                                  parse_mode='HTML',
+                                  priority=sender.INTERACTIVE)
+        except gmaps.ImageNotAvailable as error:
+            logging.warning('Street View image is not sent: %s', error)
+            send_scheduler.answer(message, messages.IMAGE_NOT_AVAILABLE_MESSAGE,
+                                  reply_markup=None if inline_navigation else keyboard.KEYBOARDS['navigation'],
+                                  parse_mode='HTML',
+                                  priority=sender.INTERACTIVE)
     else:
+        step_index = user_data['step']
         if content == 'next':
             # Next step
-            await state.update_data(step=user_data['step'] + 1)
-        elif content == 'previous' and user_data['step'] > 0:
+            step_index += 1
+        elif content == 'previous' and step_index > 0:
             # Previous step
-            await state.update_data(step=user_data['step'] - 1)
+            step_index -= 1
 
-        user_data = await state.get_data()
+        step = await route_storage.get_step(message.chat.id, user_data.get('route'), step_index)
+        if step_index != user_data['step']:
+            session.update_data(step=step_index)
 
-        if user_data['step'] >= steps_number:
+        if step is None and not await route_storage.length(message.chat.id, user_data.get('route')):
+            await process_route_expired(message, session)
+
+        elif step is None:
             # Destination reached
-            await message.answer(messages.REACH_MESSAGE,
-                                 reply_markup=keyboard.create_keyboard(keyboard.PATHFINDER_BUTTONS['finish']),
-                                 parse_mode='HTML')
-            await UserStates.FINISH.set()
+            send_scheduler.answer(message, messages.REACH_MESSAGE,
+                                  reply_markup=keyboard.KEYBOARDS['finish'],
+                                  parse_mode='HTML',
+                                  priority=sender.INTERACTIVE)
+            session.set_state(UserStates.FINISH)
 
         else:
             # Still going
-            await message.answer(messages.reply_message(await state.get_data()),
-                                 reply_markup=keyboard.create_keyboard(keyboard.PATHFINDER_BUTTONS['navigation']),
-                                 parse_mode='HTML')
+            street_view_prefetcher.schedule(message.chat.id, user_data.get('route'), step_index)
+            if edit:
+                # Presses within NAVIGATION_EDIT_DELAY end up in single edit, unchanged step is not sent
+                message_editor.edit(message, step['m'],
+                                    reply_markup=keyboard.INLINE_KEYBOARDS['navigation'],
+                                    parse_mode='HTML')
+            else:
+                send_step(message, step['m'])
+
+
+@dp.message_handler(content_types=types.ContentType.LOCATION,
+                    state=UserStates.BUILDING)
+async def process_live_location_start(message: types.Message, session: user_session.UserSession):
+    """
+    Location shared during navigation: live location turns automatic step advance on
+    """
+    live_tracker.debounce(message.chat.id, message.location.latitude, message.location.longitude)
+    if message.location.live_period:
+        send_scheduler.answer(message, messages.LIVE_NAVIGATION_MESSAGE,
+                              parse_mode='HTML',
+                              priority=sender.INTERACTIVE)
+    await process_live_location(message, session)
+
+
+@dp.edited_message_handler(content_types=types.ContentType.LOCATION,
+                           state=UserStates.BUILDING)
+async def process_live_location(message: types.Message, session: user_session.UserSession):
+    """
+    Live location update processing: navigation moves to the step user is on.
+    Step is written and sent only when it changes
+    """
+    user_data = session.data
+    position = await live_tracker.locate(message.chat.id, user_data.get('route'),
+                                         message.location.latitude, message.location.longitude, user_data['step'])
+    if position is None:
+        # Routes built before live navigation existed have no geometry
+        if not await route_storage.length(message.chat.id, user_data.get('route')):
+            await process_route_expired(message, session)
+
+    elif position.off_route:
+        await process_off_route(message, session)
+
+    elif position.arrived:
+        # Destination reached
+        send_scheduler.answer(message, messages.REACH_MESSAGE,
+                              reply_markup=keyboard.KEYBOARDS['finish'],
+                              parse_mode='HTML',
+                              priority=sender.INTERACTIVE)
+        session.set_state(UserStates.FINISH)
+
+    elif position.step != user_data['step']:
+        step = await route_storage.get_step(message.chat.id, user_data.get('route'), position.step)
+        if step is None:
+            await process_route_expired(message, session)
+            return
+        session.update_data(step=position.step)
+        street_view_prefetcher.schedule(message.chat.id, user_data.get('route'), position.step)
+        send_step(message, step['m'])
+
+
+async def process_off_route(message: types.Message, session: user_session.UserSession):
+    """
+    User has left the route: only the way from user location to the end of current leg is requested again
+    and put in place of the rest of current leg, following legs are kept. Reroutes of chat are rate limited
+    """
+    chat, user_data = message.chat.id, session.data
+    if not await reroute_cooldown.take(chat):
+        return
+    index = await live_tracker.index(chat, user_data.get('route'))
+    start = user_data['step']
+    end, leg_end = index.leg_end(start)
+
+    payload_maps = directions_payload(user_data,
+                                      cache.format_location(message.location.latitude, message.location.longitude),
+                                      cache.format_location(*leg_end), [])
+    gmaps_data = await get_directions(payload_maps, chat=chat)
+    if gmaps_data['status'] != 'OK':
+        # Current route is kept, next off-route location tries again
+        return
 
+    steps = routes.build_route(gmaps_data)
+    geometry = routes.splice_geometry(index.geometry, start, end, routes.route_geometry(gmaps_data))
+    await route_storage.splice(chat, user_data.get('route'), start, end, steps, geometry)
+    live_tracker.update(chat, user_data.get('route'), geometry)
+    # Images prefetched for old steps do not match new ones
+    street_view_prefetcher.cancel(chat)
+    street_view_prefetcher.schedule(chat, user_data.get('route'), start)
+    send_step(message, messages.REROUTE_MESSAGE.format(steps[0]['m']))
 
-@dp.message_handler(lambda message: message.text in keyboard.PATHFINDER_BUTTONS['finish'],
-                    state=UserStates.FINISH)
-async def process_restart(message: types.Message, state: FSMContext):
+
+async def process_restart(message: types.Message, session: user_session.UserSession):
     """
     Finish navigation processing
     """
@@ -458,34 +723,150 @@ async def process_restart(message: types.Message, state: FSMContext):
 
     if content == 'finish':
         # Finish pathfinder and go to main
-        await state.update_data(**config.DEFAULT_GEO_DATA)
-        await message.answer(messages.FINISH_MESSAGE,
-                             reply_markup=keyboard.create_keyboard(keyboard.COMMANDS, one_time_keyboard=False),
-                             parse_mode='HTML')
-        await UserStates.START.set()
+        user_data = session.data
+        street_view_prefetcher.cancel(message.chat.id)
+        live_tracker.forget(message.chat.id)
+        await route_storage.delete(message.chat.id, user_data.get('route'))
+        session.update_data(**config.DEFAULT_GEO_DATA)
+        send_scheduler.answer(message, messages.FINISH_MESSAGE,
+                              reply_markup=keyboard.KEYBOARDS['commands'],
+                              parse_mode='HTML',
+                              priority=sender.INTERACTIVE)
+        session.set_state(UserStates.START)
 
     elif content == 'restart':
         # Start pathfinder from beginning
-        await message.answer(messages.RESTART_MESSAGE,
-                             parse_mode='HTML')
-        await state.update_data(step=0)
+        send_scheduler.answer(message, messages.RESTART_MESSAGE,
+                              parse_mode='HTML',
+                              priority=sender.INTERACTIVE)
+        session.update_data(step=0)
+        # Last live location belongs to the end of the route
+        live_tracker.forget(message.chat.id)
+        user_data = session.data
+        step = await route_storage.get_step(message.chat.id, user_data.get('route'), 0)
+        if step is None:
+            await process_route_expired(message, session)
+            return
+
+        street_view_prefetcher.schedule(message.chat.id, user_data.get('route'), 0)
+        send_step(message, step['m'])
+        session.set_state(UserStates.BUILDING)
+
+
+# Dispatch table of keyboard buttons. Route added first wins, so "cancel" is handled the same way in every state
+button_router.add('*', keyboard.PATHFINDER_BUTTONS['cancel'], process_cancel)
+button_router.add(UserStates.TRAVEL_MODE, keyboard.OPTION_BUTTONS['mode'], process_transport_selection)
+for button, name in parameters.OPTION_MENU_BUTTONS.items():
+    button_router.add(UserStates.OPTIONS, [button], process_option_menu, parameter_name=name)
+button_router.add(UserStates.OPTIONS, ['back'], process_options_back)
+for name in parameters.OPTION_MENU_BUTTONS.values():
+    # Multiple selection parameters are dictionaries of flags
+    button_router.add(PARAMETER_STATES[name], keyboard.OPTION_BUTTONS[name],
+                      process_multi_selection if isinstance(config.DEFAULT_USER_DATA[name], dict)
+                      else process_option_selection,
+                      parameter_name=name)
+button_router.add(UserStates.CONFIRMATION, keyboard.PATHFINDER_BUTTONS['start'], process_confirmation)
+button_router.add(UserStates.BUILDING, keyboard.PATHFINDER_BUTTONS['navigation'], process_path)
+button_router.add(UserStates.FINISH, keyboard.PATHFINDER_BUTTONS['finish'], process_restart)
+
+
+@dp.message_handler(commands=['profile'],
+                    user_id=config.ADMIN_IDS,
+                    state='*')
+async def process_profile_command(message: types.Message):
+    """
+    Admin command: "/profile <chat id>" turns profiling of chat updates on, "/profile <chat id> off" turns it off,
+    "/profile" lists profiled chats
+    """
+    arguments = message.get_args().split()
+    if not arguments:
+        chats = await profiler_middleware.profiled_chats()
+        send_scheduler.answer(message,
+                              messages.PROFILED_CHATS_MESSAGE.format(', '.join(map(str, sorted(chats))))
+                              if chats else messages.NO_PROFILED_CHATS_MESSAGE,
+                              parse_mode='HTML')
+        return
 
-        await message.answer(messages.reply_message(await state.get_data()),
-                             reply_markup=keyboard.create_keyboard(keyboard.PATHFINDER_BUTTONS['navigation']),
-                             parse_mode='HTML')
-        await UserStates.BUILDING.set()
+    try:
+        chat = int(arguments[0])
+    except ValueError:
+        send_scheduler.answer(message, messages.PROFILE_USAGE_MESSAGE,
+                              parse_mode='HTML')
+        return
+
+    if arguments[1:] == ['off']:
+        await profiler_middleware.disable_chat(chat)
+        send_scheduler.answer(message, messages.PROFILE_DISABLED_MESSAGE.format(chat),
+                              parse_mode='HTML')
+    else:
+        await profiler_middleware.enable_chat(chat)
+        send_scheduler.answer(message, messages.PROFILE_ENABLED_MESSAGE.format(chat, config.PROFILER_CHAT_TTL // 60),
+                              parse_mode='HTML')
 
 
 @dp.message_handler(state='*')
 async def process_unknown(message: types.Message):
-    await message.answer(messages.UNKNOWN_COMMAND_MESSAGE,
-                         parse_mode='HTML')
+    send_scheduler.answer(message, messages.UNKNOWN_COMMAND_MESSAGE,
+                          parse_mode='HTML')
+
+
+def run_shard_worker(number):
+    """
+    Multi-worker mode worker process
+    :param number: worker number
+    """
+    metrics.start_server(config.METRICS_PORT + number + 1 if config.METRICS_PORT else 0)
+    sharding.ShardWorker(dp, redis_storage.redis, worker_id='{}-{}'.format(number, os.getpid())).run(
+        on_shutdown=shutdown)
+
+
+worker_pool = sharding.WorkerPool(run_shard_worker)
+
+
+async def startup(dispatcher: Dispatcher):
+    metrics.start_server()
+    if config.SHARD_WORKERS:
+        worker_pool.start()
+
+
+async def startup_polling(dispatcher: Dispatcher):
+    # Telegram does not send updates to getUpdates while webhook is set
+    await dispatcher.bot.delete_webhook()
+    await startup(dispatcher)
 
 
 async def shutdown(dispatcher: Dispatcher):
+    await worker_pool.stop()
+    logging.info('Directions cache: %s', directions_cache.stats)
+    logging.info('Directions coalescing: %s', directions_flight.stats)
+    logging.info('Geocoding cache: %s', geocode_cache.stats)
+    logging.info('Street View cache: %s', street_view_cache.stats)
+    logging.info('Street View prefetch: %s', street_view_prefetcher.stats)
+    logging.info('Google Maps rate limits: %s', gmaps.client.limiter.stats)
+    logging.info('User sessions: %s', session_middleware.stats)
+    if redis_storage.cache is not None:
+        logging.info('User state cache: %s', redis_storage.cache.stats)
+    logging.info('Update profiles: %s', profiler_middleware.stats)
+    logging.info('Live locations: %s', live_tracker.stats)
+    logging.info('Reroutes: %s', reroute_cooldown.stats)
+    message_editor.flush()
+    logging.info('Route message edits: %s', message_editor.stats)
+    await send_scheduler.close()
+    logging.info('Outgoing messages: %s', send_scheduler.stats)
+    if local_router is not None:
+        logging.info('Offline routes: %s', local_router.stats)
+        local_router.close()
+    await gmaps.client.close()
     await dispatcher.storage.close()
     await dispatcher.storage.wait_closed()
 
 
 if __name__ == '__main__':
-    executor.start_polling(dp, on_shutdown=shutdown)
+    if config.SHARD_WORKERS:
+        # Updates are only put to shard streams here and processed by worker processes
+        dp.middleware.setup(sharding.UpdatePublisher(redis_storage.redis))
+
+    if config.BOT_MODE == 'webhook':
+        webhook.start_webhook(dp, on_startup=startup, on_shutdown=shutdown)
+    else:
+        executor.start_polling(dp, on_startup=startup_polling, on_shutdown=shutdown)
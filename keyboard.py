@@ -1,16 +1,21 @@
-from aiogram.types import ReplyKeyboardMarkup, KeyboardButton
+from types import MappingProxyType
+
+from aiogram.types import InlineKeyboardButton, InlineKeyboardMarkup, ReplyKeyboardMarkup, KeyboardButton
+from aiogram.utils import json
 
 # Commands
 COMMANDS = ['/go', '/transport', '/options', '/help']
 
 # Options
-OPTION_BUTTONS = {'options': ['units', 'avoid', 'traffic model', 'transit mode', 'transit routing preference', 'back'],
+OPTION_BUTTONS = {'options': ['units', 'avoid', 'traffic model', 'transit mode', 'transit routing preference',
+                              'waypoints order', 'back'],
                   'mode': ['driving', 'walking', 'bicycling', 'transit', 'back'],
                   'units': ['metric', 'imperial', 'back'],
                   'traffic_model': ['best_guess', 'optimistic', 'pessimistic', 'back'],
                   'transit_routing_preference': ['less_walking', 'fewer_transfers', 'clear', 'back'],
                   'avoid': ['tolls', 'highways', 'ferries', 'indoor', 'back'],
-                  'transit_mode': ['bus', 'subway', 'train', 'tram', 'rail', 'back']}
+                  'transit_mode': ['bus', 'subway', 'train', 'tram', 'rail', 'back'],
+                  'waypoints_order': ['as_typed', 'optimized', 'back']}
 
 # Navigation
 PATHFINDER_BUTTONS = {'start': ['start', 'cancel'],
@@ -19,6 +24,9 @@ PATHFINDER_BUTTONS = {'start': ['start', 'cancel'],
                       'waypoint': ['skip', 'cancel'],
                       'cancel': ['cancel']}
 
+# Buttons under route message, pressing them edits the message in place
+INLINE_BUTTONS = {'navigation': ['previous', 'next', 'target location image', 'cancel']}
+
 
 def create_keyboard(functions, one_time_keyboard=True, row_len=2):
     """
@@ -35,3 +43,70 @@ def create_keyboard(functions, one_time_keyboard=True, row_len=2):
         keyboard = keyboard.row(*buttons[i:i + row_len if row_len + i <= len(buttons) else len(buttons)])
 
     return keyboard
+
+
+# Layout of every keyboard used by bot: name -> (button names, row length, one time keyboard)
+KEYBOARD_LAYOUTS = {'commands': (COMMANDS, 2, False),
+                    'options': (OPTION_BUTTONS['options'], 3, False),
+                    'mode': (OPTION_BUTTONS['mode'], 2, True),
+                    'units': (OPTION_BUTTONS['units'], 3, True),
+                    'traffic_model': (OPTION_BUTTONS['traffic_model'], 3, True),
+                    'transit_routing_preference': (OPTION_BUTTONS['transit_routing_preference'], 3, True),
+                    'avoid': (OPTION_BUTTONS['avoid'], 3, False),
+                    'transit_mode': (OPTION_BUTTONS['transit_mode'], 3, False),
+                    'waypoints_order': (OPTION_BUTTONS['waypoints_order'], 3, True),
+                    'start': (PATHFINDER_BUTTONS['start'], 2, True),
+                    'navigation': (PATHFINDER_BUTTONS['navigation'], 2, True),
+                    'finish': (PATHFINDER_BUTTONS['finish'], 2, True),
+                    'waypoint': (PATHFINDER_BUTTONS['waypoint'], 2, True),
+                    'cancel': (PATHFINDER_BUTTONS['cancel'], 2, False)}
+
+
+def build_keyboards(layouts):
+    """
+    Builds and serializes keyboards once. Bot API accepts reply_markup as JSON string,
+    so ready strings are passed to handlers and no markup objects are created or serialized per message
+    :param layouts: dictionary of keyboard layouts (see KEYBOARD_LAYOUTS)
+    :return: read-only mapping of keyboard name to serialized keyboard
+    """
+    return MappingProxyType({name: json.dumps(create_keyboard(buttons, one_time_keyboard=one_time_keyboard,
+                                                                    row_len=row_len).to_python())
+                                   for name, (buttons, row_len, one_time_keyboard) in layouts.items()})
+
+
+# Keyboards registry: handlers reference keyboards by name, e.g. KEYBOARDS['navigation']
+KEYBOARDS = build_keyboards(KEYBOARD_LAYOUTS)
+
+
+def callback_data(keyboard_name, button):
+    """
+    :param keyboard_name: inline keyboard name
+    :param button: button name
+    :return: str, callback data of inline button
+    """
+    return '{}:{}'.format(keyboard_name, button)
+
+
+def create_inline_keyboard(keyboard_name, functions, row_len=2):
+    """
+    Creates inline keyboard with required button names
+    :param keyboard_name: inline keyboard name, callback data of buttons starts with it
+    :param functions: iterable object. Consists of required button names
+    :param row_len: integer. Length of row of buttons
+    :return: inline keyboard with button names
+    """
+    keyboard = InlineKeyboardMarkup(row_width=row_len)
+    return keyboard.add(*[InlineKeyboardButton(function, callback_data=callback_data(keyboard_name, function))
+                          for function in functions])
+
+
+# Layout of inline keyboards: name -> (button names, row length)
+INLINE_KEYBOARD_LAYOUTS = {'navigation': (INLINE_BUTTONS['navigation'], 2)}
+
+# Inline keyboards registry, serialized once like KEYBOARDS
+INLINE_KEYBOARDS = MappingProxyType({name: json.dumps(create_inline_keyboard(name, buttons, row_len).to_python())
+                                     for name, (buttons, row_len) in INLINE_KEYBOARD_LAYOUTS.items()})
+
+# Callback data of every inline button -> (keyboard name, button name)
+CALLBACKS = MappingProxyType({callback_data(name, button): (name, button)
+                              for name, (buttons, _) in INLINE_KEYBOARD_LAYOUTS.items() for button in buttons})
@@ -1,8 +1,8 @@
+import functools
 import re
-import math
-import requests
 
 import config
+import geo
 import parameters
 
 # Welcoming messages
@@ -19,13 +19,16 @@ HELP_MESSAGE = 'Commands:\n' \
                'traffic model: how model calculates traffic time (best_guess, optimistic, pessimistic)\n' \
                'transit mode: (multiple) preferable transit modes (bus, subway, train, tram, rail)\n' \
                'transit routing_preference: biases routes as selected (none (default), less_walking, ' \
-               'fewer_transfers)\n\n' \
+               'fewer_transfers)\n' \
+               'waypoints order: order waypoints are visited in (as_typed (default) or optimized)\n\n' \
                'Navigation:\n' \
                'This bot uses Google Maps Directions to build routes from point to point using given parameters. ' \
                'Set starting location, target location, waypoints (optional) and press start. Each location can be ' \
                'set as text or location\n' \
                'At each step you can look at target step location by choosing image (if it is available on ' \
-               'Google Street View) as been seen from current step starting point'
+               'Google Street View) as been seen from current step starting point\n' \
+               'Share your live location during navigation and steps will change as you go. If you leave the route, ' \
+               'it is rebuilt from your location'
 
 # Options messages
 OPTIONS_MESSAGE = 'Options: \n' \
@@ -34,7 +37,8 @@ OPTIONS_MESSAGE = 'Options: \n' \
                   '<b>Avoid</b>: {}\n' \
                   '<b>Traffic model</b>: {}\n' \
                   '<b>Transit mode</b>: {}\n' \
-                  '<b>Transit routing</b>: {}'
+                  '<b>Transit routing</b>: {}\n' \
+                  '<b>Waypoints order</b>: {}'
 
 CHANGED_PARAMETER_MESSAGE = '<b>{}</b> changed to <b>{}</b>'
 
@@ -78,6 +82,20 @@ TRANSIT_ROUTING_MESSAGE = 'Choose transit routing preference (affects only trans
                           '<b>clear</b>: calculate routes as usual\n' \
                           'Current: <b>{}</b>'
 
+WAYPOINTS_ORDER_MESSAGE = 'Choose order waypoints are visited in\n' \
+                          '<b>as_typed</b>: visit waypoints in order they were set\n' \
+                          '<b>optimized</b>: reorder waypoints to make route shorter\n' \
+                          'Current: <b>{}</b>'
+
+# Prompts of parameter values keyboards, formatted with current value
+PARAMETER_MESSAGES = {'mode': TRAVEL_MODE_MESSAGE,
+                      'units': UNITS_MESSAGE,
+                      'avoid': AVOID_MESSAGE,
+                      'traffic_model': TRAFFIC_MODEL_MESSAGE,
+                      'transit_mode': TRANSIT_MODE_MESSAGE,
+                      'transit_routing_preference': TRANSIT_ROUTING_MESSAGE,
+                      'waypoints_order': WAYPOINTS_ORDER_MESSAGE}
+
 # Set navigation messages
 ORIGIN_REQUEST_MESSAGE = 'Set origin point'
 DESTINATION_REQUEST_MESSAGE = 'Set destination point'
@@ -89,71 +107,94 @@ UNKNOWN_COMMAND_MESSAGE = 'Unknown command. Please try again'
 WAITING_MESSAGE = 'Waiting for your commands'
 CANCEL_MESSAGE = 'Navigation cancelled'
 NOT_FOUND_MESSAGE = 'Path not found'
+OVER_QUERY_LIMIT_MESSAGE = 'Too many requests to Google Maps right now. Please try again in a minute'
+SERVICE_UNAVAILABLE_MESSAGE = 'Google Maps is unavailable right now. Please try again later'
+IMAGE_NOT_AVAILABLE_MESSAGE = 'Street View image of this location is not available'
+ROUTE_EXPIRED_MESSAGE = 'Route has expired. Please build it again'
 REACH_MESSAGE = 'You have reached your destination'
 FINISH_MESSAGE = 'Navigation finished'
 RESTART_MESSAGE = 'Starting path from beginning'
-
-
-def reply_message(user_data):
+REROUTE_MESSAGE = 'You are off the route. Route from your location:\n{}'
+LIVE_NAVIGATION_MESSAGE = 'Following your live location: next steps will be sent as you reach them'
+BUTTON_EXPIRED_MESSAGE = 'This route is not navigated anymore'
+
+# Admin messages
+PROFILE_USAGE_MESSAGE = 'Usage: /profile &lt;chat id&gt; [off]'
+PROFILE_ENABLED_MESSAGE = 'Updates of chat <b>{}</b> are profiled for {} minutes'
+PROFILE_DISABLED_MESSAGE = 'Profiling of chat <b>{}</b> is turned off'
+PROFILED_CHATS_MESSAGE = 'Profiled chats: {}'
+NO_PROFILED_CHATS_MESSAGE = 'No chats are profiled'
+
+# Messages of Directions statuses other than OK (ZERO_RESULTS, NOT_FOUND etc. mean route does not exist)
+DIRECTIONS_STATUS_MESSAGES = {'OVER_QUERY_LIMIT': OVER_QUERY_LIMIT_MESSAGE,
+                              'OVER_DAILY_LIMIT': OVER_QUERY_LIMIT_MESSAGE,
+                              'REQUEST_DENIED': SERVICE_UNAVAILABLE_MESSAGE,
+                              'UNKNOWN_ERROR': SERVICE_UNAVAILABLE_MESSAGE}
+
+# Google instructions html tags and their Telegram replacements
+INSTRUCTION_TAG_REGEXP = re.compile(r'<(/?)([a-zA-Z]+)[^>]*>')
+INSTRUCTION_TAGS = {'div': 'b', 'span': 'i', 'b': 'b', 'strong': 'b', 'i': 'i', 'em': 'i', 'u': 'u', 's': 's',
+                    'code': 'code'}
+INSTRUCTION_TAG_PREFIXES = {'div': '. '}  # text added before opening tag
+# Tag name ("/" first for closing tag) -> replacement, used when tags are balanced. Unknown tags are dropped
+INSTRUCTION_TAG_REPLACEMENTS = dict([(name, INSTRUCTION_TAG_PREFIXES.get(name, '') + '<' + tag + '>')
+                                     for name, tag in INSTRUCTION_TAGS.items()] +
+                                    [('/' + name, '</' + tag + '>') for name, tag in INSTRUCTION_TAGS.items()])
+INSTRUCTION_SPLIT_REGEXP = re.compile(r'<(/?[a-zA-Z]+)[^>]*>')
+
+
+def reply_message(step):
     """
-    Creates reply message about current navigation step
-    :param: user data dictionary
+    Creates reply message about navigation step. Called for every step when route is built, see routes.compact_step
+    :param: step: Google Directions step
     :return: message
     """
 
-    current_step = user_data['directions'][user_data['step']]
-
-    message = '{}\nDistance: <b>{}</b>\nDuration: <b>{}</b>'.format(process_instructions(current_step),
-                                                                    current_step["distance"]["text"],
-                                                                    current_step["duration"]["text"])
+    instructions = process_instructions(step.get('html_instructions', 'Go'))
+    message = '{}\nDistance: <b>{}</b>\nDuration: <b>{}</b>'.format(instructions,
+                                                                    step['distance']['text'],
+                                                                    step['duration']['text'])
 
     # For transit routes walking steps includes a list of sub-steps. This condition processes them
-    if 'steps' in current_step:
-        step_details = '\n'.join(['{} (<b>{}</b>)'.format(process_instructions(step),
-                                                          step["distance"]["text"])
-                                  for step in current_step['steps']])
+    if 'steps' in step:
+        step_details = '\n'.join(['{} (<b>{}</b>)'.format(process_instructions(sub_step.get('html_instructions', 'Go')),
+                                                          sub_step['distance']['text'])
+                                  for sub_step in step['steps']])
         message += '\n' + step_details
 
     # Add transit details to message
-    if 'transit_details' in current_step:
-        transit_details_all = current_step['transit_details']
+    if 'transit_details' in step:
+        transit_details_all = step['transit_details']
         transit_details = 'From: <b>{}</b>\nTo: <b>{}</b>\nBus: <b>{}</b>'.\
             format(transit_details_all['departure_stop']['name'],
                    transit_details_all['arrival_stop']['name'],
-                   transit_details_all['line']['short_name'])
+                   transit_details_all['line'].get('short_name') or transit_details_all['line'].get('name', ''))
         message += '\n' + transit_details
 
     return message
 
 
-def reply_image(user_data):
+def street_view_payload(step):
     """
-    Requests panorama image of target location on current step from Google StreetView API
-    :param: user data dictionary
-    :return: image (as byte string)
+    Creates Street View API request for panorama image of target location on current step
+    :param: step: compact step record (see routes.compact_step)
+    :return: dictionary of Street View API parameters
     """
 
-    start_coords = {key: float(value) for key, value in
-                    user_data["directions"][user_data["step"]]["start_location"].items()}
-    end_coords = {key: float(value) for key, value in
-                  user_data["directions"][user_data["step"]]["end_location"].items()}
-
-    # Calculate panorama angle as being seen from starting point to ending point
-    bearing = (math.atan2(math.sin(end_coords['lng'] - start_coords['lng']) * math.cos(end_coords['lat']),
-                          math.cos(start_coords['lat']) * math.sin(end_coords['lat']) -
-                          math.sin(start_coords['lat']) * math.cos(end_coords['lat']) *
-                          math.cos(end_coords['lng'] - start_coords['lng'])
-                          ) * 180 / math.pi + 360) % 360
+    # Panorama is seen from starting point to ending point. Heading is computed when route is built,
+    # routes stored before that are handled here
+    heading = step['h'] if 'h' in step else geo.bearing(step['s'], step['e'])
 
+    # Heading is snapped to the middle of its bucket and location is rounded, so cached images can be reused
+    bucket = config.STREET_VIEW_HEADING_BUCKET
+    precision = config.STREET_VIEW_CACHE_PRECISION
     payload_view = {
-        'location': '{},{}'.format(end_coords['lat'], end_coords['lng']),
+        'location': '{:.{precision}f},{:.{precision}f}'.format(step['e'][0], step['e'][1], precision=precision),
         'size': '600x400',
-        'heading': bearing,
-        'source': 'outdoor',
-        'key': config.GMAPS_TOKEN
+        'heading': int(heading) // bucket * bucket + bucket / 2,
+        'source': 'outdoor'
     }
-    street_view = requests.get(config.GMAPS_IMAGE_URL, params=payload_view)
-    return street_view.content
+    return payload_view
 
 
 def multi_selection_setting_format(user_data, option):
@@ -166,12 +207,29 @@ def multi_selection_setting_format(user_data, option):
     return [value for value in user_data[option] if user_data[option][value]]
 
 
+def reply_parameter_prompt(user_data, parameter_name):
+    """
+    Getting prompt of parameter values keyboard
+    :param user_data: dictionary of current user data
+    :param parameter_name: parameter name
+    :return: prompt message with current parameter value
+    """
+    # Options added later are absent in data of users started before
+    user_data = dict(config.DEFAULT_USER_DATA, **user_data)
+    value = user_data[parameter_name]
+    if isinstance(value, dict):
+        value = ', '.join(multi_selection_setting_format(user_data, parameter_name))
+    return PARAMETER_MESSAGES[parameter_name].format(value)
+
+
 def reply_current_options(user_data):
     """
     Getting current options message
     :param user_data: dictionary of current user data
     :return: options message
     """
+    # Options added later are absent in data of users started before
+    user_data = dict(config.DEFAULT_USER_DATA, **user_data)
     return OPTIONS_MESSAGE.format(*[', '.join(multi_selection_setting_format(user_data, opt))
                                     if isinstance(user_data[opt], dict) and multi_selection_setting_format(user_data,
                                                                                                            opt)
@@ -180,18 +238,78 @@ def reply_current_options(user_data):
                                     for opt in parameters.PARAMETER_NAMES.keys()])
 
 
-def process_instructions(current_step):
+def translate_tag(match, open_tags):
+    """
+    Translates single html tag of Google instructions to Telegram-supported tag
+    :param match: tag regular expression match
+    :param open_tags: stack of currently open Telegram tags (changed in place)
+    :return: str, replacement of tag
+    """
+    closing, name = match.group(1), match.group(2).lower()
+    tag = INSTRUCTION_TAGS.get(name)
+    if tag is None:
+        # Unsupported tag without replacement: dropped
+        return ''
+
+    if not closing:
+        if tag in open_tags:
+            # Telegram does not accept tag nested in itself, so inner tag is skipped
+            open_tags.append(None)
+            return INSTRUCTION_TAG_PREFIXES.get(name, '')
+        open_tags.append(tag)
+        return INSTRUCTION_TAG_PREFIXES.get(name, '') + '<' + tag + '>'
+
+    if not open_tags:
+        # Closing tag without opening one
+        return ''
+    tag = open_tags.pop()
+    return '</' + tag + '>' if tag else ''
+
+
+@functools.lru_cache(maxsize=1024)
+def tag_replacements(names):
     """
-    Remove unsupported tags from path instructions
-    :param current_step: current step instructions
+    Replacements of instructions tags, if translated tags are nested properly and none is nested in itself.
+    Google steps have few distinct tag sequences, so they are looked up in cache rather than checked
+    :param names: tuple of tag names, names of closing tags start with "/"
+    :return: tuple of replacements of tags or None if tags are unbalanced
+    """
+    open_tags = []
+    for name in names:
+        tag = INSTRUCTION_TAGS.get(name.lstrip('/'))
+        if tag is None:
+            if name.lower() != name:
+                # Upper case tags are translated one by one
+                return None
+            continue
+        if name[0] != '/':
+            if tag in open_tags:
+                return None
+            open_tags.append(tag)
+        elif not open_tags or open_tags.pop() != tag:
+            return None
+    return None if open_tags else tuple(INSTRUCTION_TAG_REPLACEMENTS.get(name, '') for name in names)
+
+
+def process_instructions(instructions):
+    """
+    Translates tags of path instructions to Telegram-supported ones
+    (div is replaced with <b>, span with <i>, unknown tags are removed).
+    Balanced tags are replaced from table, only unbalanced ones are closed or skipped one by one by translate_tag
+    :param instructions: step instructions (html)
     :return: str, processed instructions
     """
-    # Replace unsupported div tag with <b> tag
-    div_tag_regexp = '<div.*?>'  # Regular expression to filter out unsupported div tag
-    instructions = re.sub(div_tag_regexp, '. <b>', current_step.get("html_instructions", 'Go').replace('/div', '/b'))
-
-    # Replace unsupported span tag with <i> tag
-    span_tag_regexp = '<span.*?>'  # Regular expression to filter out unsupported span tag
-    instructions = re.sub(span_tag_regexp, '<i>', instructions.replace('/span', '/i'))
-
-    return instructions
+    if '<' not in instructions:
+        return instructions
+    # Text and tag names alternate: [text, name, text, name, ..., text]
+    parts = INSTRUCTION_SPLIT_REGEXP.split(instructions)
+    replacements = tag_replacements(tuple(parts[1::2]))
+    if replacements is not None:
+        parts[1::2] = replacements
+        return ''.join(parts)
+
+    open_tags = []
+    instructions = INSTRUCTION_TAG_REGEXP.sub(lambda match: translate_tag(match, open_tags), instructions)
+
+    # Close tags left open
+    return instructions + ''.join('</' + tag + '>' for tag in reversed(open_tags) if tag)
@@ -0,0 +1,334 @@
+import contextvars
+import logging
+import time
+
+import prometheus_client
+from prometheus_client.core import CounterMetricFamily, GaugeMetricFamily
+from aiogram import Bot
+from aiogram.dispatcher.middlewares import BaseMiddleware
+
+import config
+import fsm_storage
+import router
+
+logger = logging.getLogger(__name__)
+
+HANDLER_LATENCY = prometheus_client.Histogram('bot_handler_latency_seconds',
+                                              'Update processing time by handler and state it was handled in',
+                                              ['handler', 'state'])
+GMAPS_LATENCY = prometheus_client.Histogram('gmaps_request_latency_seconds',
+                                            'Google Maps request time by endpoint', ['endpoint'])
+GMAPS_RESPONSES = prometheus_client.Counter('gmaps_responses_total',
+                                            'Google Maps responses by endpoint and HTTP status code',
+                                            ['endpoint', 'code'])
+GMAPS_DIRECTIONS_STATUSES = prometheus_client.Counter('gmaps_directions_status_total',
+                                                      'Directions API response statuses', ['status'])
+REDIS_ROUND_TRIPS = prometheus_client.Histogram('redis_round_trips_per_update', 'Redis round trips per update',
+                                                buckets=(0, 1, 2, 3, 4, 5, 6, 8, 10, 15, 20, 30))
+REDIS_PAYLOAD = prometheus_client.Histogram('redis_payload_bytes_per_update',
+                                            'Bytes sent to and received from Redis per update',
+                                            buckets=(0, 128, 512, 1024, 4096, 16384, 65536, 262144))
+FSM_DATA_SIZE = prometheus_client.Histogram('fsm_data_bytes', 'Size of user FSM data',
+                                            buckets=(64, 128, 256, 512, 1024, 2048, 4096, 16384, 65536))
+NAVIGATION_SESSIONS = prometheus_client.Gauge('navigation_sessions_active',
+                                              'Chats navigating a route recently (per process)')
+TELEGRAM_LATENCY = prometheus_client.Histogram('telegram_request_latency_seconds',
+                                               'Bot API request time by method', ['method'])
+TELEGRAM_ERRORS = prometheus_client.Counter('telegram_request_errors_total',
+                                            'Failed Bot API requests by method and error', ['method', 'error'])
+
+# Redis usage of update being processed
+current_update = contextvars.ContextVar('current_update', default=None)
+
+
+class UpdateProbe:
+    """
+    Measurements of single update
+    """
+    __slots__ = ('started', 'handler', 'state', 'round_trips', 'payload_bytes')
+
+    def __init__(self):
+        self.started = time.perf_counter()
+        self.handler = 'unhandled'
+        self.state = 'none'
+        self.round_trips = 0
+        self.payload_bytes = 0
+
+
+def payload_size(value):
+    """
+    :return: int, approximate size of Redis command arguments or reply in bytes
+    """
+    if isinstance(value, (bytes, str)):
+        return len(value)
+    if isinstance(value, (list, tuple)):
+        return sum(payload_size(item) for item in value)
+    return 0
+
+
+class PipelineProbe:
+    """
+    Pipeline (or MULTI/EXEC transaction) wrapper counting it as single round trip
+    """
+
+    def __init__(self, pipeline):
+        self._pipeline = pipeline
+        self._bytes = 0
+
+    def __getattr__(self, name):
+        attr = getattr(self._pipeline, name)
+        if not callable(attr):
+            return attr
+
+        def command(*args, **kwargs):
+            self._bytes += payload_size(args)
+            return attr(*args, **kwargs)
+        return command
+
+    async def execute(self, **kwargs):
+        results = await self._pipeline.execute(**kwargs)
+        probe = current_update.get()
+        if probe is not None:
+            probe.round_trips += 1
+            probe.payload_bytes += self._bytes + payload_size(results)
+        return results
+
+
+def instrument_redis(redis):
+    """
+    Makes Redis connection count round trips and payload of update being processed
+    :param redis: aioredis.Redis
+    :return: the same connection
+    """
+    if getattr(redis, 'metrics_instrumented', False):
+        return redis
+    execute, pipeline, multi_exec = redis.execute, redis.pipeline, redis.multi_exec
+
+    async def counted_execute(command, *args, **kwargs):
+        result = await execute(command, *args, **kwargs)
+        probe = current_update.get()
+        if probe is not None:
+            probe.round_trips += 1
+            probe.payload_bytes += payload_size(args) + payload_size(result)
+        return result
+
+    redis.execute = counted_execute
+    redis.pipeline = lambda: PipelineProbe(pipeline())
+    redis.multi_exec = lambda: PipelineProbe(multi_exec())
+    redis.metrics_instrumented = True
+    return redis
+
+
+class StateCacheCollector:
+    """
+    Exposes counters and size of in-process user state cache
+    """
+
+    def __init__(self, cache):
+        self.cache = cache
+
+    def collect(self):
+        stats = self.cache.stats
+        lookups = CounterMetricFamily('fsm_cache_lookups', 'User state cache lookups by result', labels=['result'])
+        lookups.add_metric(['hit'], stats['hits'])
+        lookups.add_metric(['miss'], stats['misses'])
+        yield lookups
+        removals = CounterMetricFamily('fsm_cache_removals', 'User state cache entries removed by reason',
+                                       labels=['reason'])
+        for reason in ('evictions', 'expirations', 'invalidations'):
+            removals.add_metric([reason], stats[reason])
+        yield removals
+        yield GaugeMetricFamily('fsm_cache_hit_ratio', 'User state cache hit ratio since start', stats['hit_ratio'])
+        yield GaugeMetricFamily('fsm_cache_entries', 'Users in state cache', stats['entries'])
+        yield GaugeMetricFamily('fsm_cache_bytes', 'Size of state cache values', stats['bytes'])
+
+
+
+class DirectionsCacheCollector:
+    """
+    Exposes counters and size of Directions responses cache
+    """
+
+    def __init__(self, cache):
+        self.cache = cache
+
+    def collect(self):
+        stats = self.cache.stats
+        lookups = CounterMetricFamily('directions_cache_lookups', 'Directions cache lookups by result',
+                                      labels=['result'])
+        for result in ('local_hits', 'redis_hits', 'misses'):
+            lookups.add_metric([result], stats[result])
+        yield lookups
+        yield GaugeMetricFamily('directions_cache_hit_ratio', 'Directions cache hit ratio since start',
+                                stats['hit_ratio'])
+        yield GaugeMetricFamily('directions_cache_entries', 'Directions responses kept in process memory',
+                                stats['size'])
+
+
+class SingleFlightCollector:
+    """
+    Exposes calls made and shared by coalescing of identical requests
+    """
+
+    def __init__(self, flights):
+        """
+        :param flights: dictionary name -> cache.SingleFlight
+        """
+        self.flights = flights
+
+    def collect(self):
+        requests = CounterMetricFamily('single_flight_requests',
+                                       'Coalesced requests by kind: made or shared with identical request of this '
+                                       'or other process', labels=['flight', 'result'])
+        for name, flight in self.flights.items():
+            stats = flight.stats
+            for result in ('calls', 'local_shared', 'remote_shared'):
+                requests.add_metric([name, result], stats[result])
+        yield requests
+
+
+class RateLimiterCollector:
+    """
+    Exposes requests, waiting time and queue depth of Google Maps rate limiter by endpoint
+    """
+
+    def __init__(self, limiter):
+        self.limiter = limiter
+
+    def collect(self):
+        requests = CounterMetricFamily('gmaps_ratelimit_requests', 'Rate limited requests by endpoint and result',
+                                       labels=['endpoint', 'result'])
+        wait_time = CounterMetricFamily('gmaps_ratelimit_wait_seconds', 'Time requests waited for token',
+                                        labels=['endpoint'])
+        max_wait_time = GaugeMetricFamily('gmaps_ratelimit_max_wait_seconds',
+                                          'Longest time request waited for token since start', labels=['endpoint'])
+        queue_depth = GaugeMetricFamily('gmaps_ratelimit_queue_depth', 'Requests waiting for token',
+                                        labels=['endpoint'])
+        for endpoint, stats in self.limiter.stats.items():
+            for result in ('granted', 'waited', 'rejected'):
+                requests.add_metric([endpoint, result], stats[result])
+            wait_time.add_metric([endpoint], stats['wait_time'])
+            max_wait_time.add_metric([endpoint], stats['max_wait_time'])
+            queue_depth.add_metric([endpoint], stats['queue_depth'])
+        yield requests
+        yield wait_time
+        yield max_wait_time
+        yield queue_depth
+
+class MetricsRedisStorage(fsm_storage.CompactRedisStorage):
+    """
+    Compact FSM storage with connection instrumented for metrics
+    """
+
+    def __init__(self, *args, **kwargs):
+        super(MetricsRedisStorage, self).__init__(*args, **kwargs)
+        if self.cache is not None:
+            prometheus_client.REGISTRY.register(StateCacheCollector(self.cache))
+
+    async def redis(self):
+        return instrument_redis(await super(MetricsRedisStorage, self).redis())
+
+
+class MetricsBot(Bot):
+    """
+    Bot measuring Bot API requests
+    """
+
+    async def request(self, method, data=None, files=None, **kwargs):
+        started = time.perf_counter()
+        try:
+            return await super(MetricsBot, self).request(method, data, files, **kwargs)
+        except Exception as error:
+            TELEGRAM_ERRORS.labels(method, type(error).__name__).inc()
+            raise
+        finally:
+            TELEGRAM_LATENCY.labels(method).observe(time.perf_counter() - started)
+
+
+class NavigationTracker:
+    """
+    Chats which were navigating a route recently
+    """
+
+    def __init__(self, window=None):
+        """
+        :param window: time (seconds) since last navigation update chat is considered active
+        """
+        self.window = window or config.METRICS_NAVIGATION_WINDOW
+        self._chats = {}
+
+    def touch(self, chat, navigating):
+        if navigating:
+            self._chats[chat] = time.monotonic()
+        else:
+            self._chats.pop(chat, None)
+
+    def count(self):
+        deadline = time.monotonic() - self.window
+        for chat in [chat for chat, seen in self._chats.items() if seen < deadline]:
+            del self._chats[chat]
+        return len(self._chats)
+
+
+class MetricsMiddleware(BaseMiddleware):
+    """
+    Measures update processing time by handler and state and Redis usage per update
+    """
+
+    def __init__(self, navigation_states=()):
+        """
+        :param navigation_states: names of states user is navigating route in
+        """
+        super(MetricsMiddleware, self).__init__()
+        self.navigation_states = frozenset(navigation_states)
+        self.navigation = NavigationTracker()
+        NAVIGATION_SESSIONS.set_function(self.navigation.count)
+
+    async def on_pre_process_update(self, update, data):
+        data['metrics'] = probe = UpdateProbe()
+        current_update.set(probe)
+
+    async def on_process_message(self, message, data):
+        probe = current_update.get()
+        if probe is None:
+            return
+        probe.handler = router.handler_name(data)
+        session = data.get('session')
+        if session is not None and session.state:
+            probe.state = session.state
+
+    async def on_post_process_message(self, message, results, data):
+        session = data.get('session')
+        if session is None:
+            return
+        if session.data_bytes:
+            FSM_DATA_SIZE.observe(session.data_bytes)
+        self.navigation.touch(message.chat.id, session.state in self.navigation_states)
+
+    async def on_post_process_callback_query(self, query, results, data):
+        if query.message is not None:
+            await self.on_post_process_message(query.message, results, data)
+
+    on_process_edited_message = on_process_message
+    on_post_process_edited_message = on_post_process_message
+    on_process_callback_query = on_process_message
+
+    async def on_post_process_update(self, update, results, data):
+        probe = data.get('metrics')
+        if probe is None:
+            return
+        HANDLER_LATENCY.labels(probe.handler, probe.state).observe(time.perf_counter() - probe.started)
+        REDIS_ROUND_TRIPS.observe(probe.round_trips)
+        REDIS_PAYLOAD.observe(probe.payload_bytes)
+
+
+def start_server(port=None, host=None):
+    """
+    Starts /metrics HTTP endpoint in background thread
+    :param port: listening port (config.METRICS_PORT by default, 0 - endpoint is off)
+    :param host: listening host
+    """
+    port = config.METRICS_PORT if port is None else port
+    if port:
+        prometheus_client.start_http_server(port, addr=host or config.METRICS_HOST)
+        logger.info('Metrics are served on %s:%s/metrics', host or config.METRICS_HOST, port)
@@ -3,5 +3,15 @@ PARAMETER_NAMES = {'mode': 'Travel mode',
                    'avoid': 'Avoidance',
                    'traffic_model': 'Traffic model',
                    'transit_mode': 'Transit mode',
-                   'transit_routing_preference': 'Transit routing'
+                   'transit_routing_preference': 'Transit routing',
+                   'waypoints_order': 'Waypoints order'
                    }
+
+# Options menu: button -> parameter chosen by it. Values of parameter are buttons of keyboard of the same name
+OPTION_MENU_BUTTONS = {'units': 'units',
+                       'avoid': 'avoid',
+                       'traffic model': 'traffic_model',
+                       'transit mode': 'transit_mode',
+                       'transit routing preference': 'transit_routing_preference',
+                       'waypoints order': 'waypoints_order'
+                       }
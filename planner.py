@@ -0,0 +1,133 @@
+import asyncio
+
+import numpy as np
+
+import cache
+import config
+import geo
+
+
+def nearest_neighbour_path(matrix):
+    """
+    Greedy open path from first point to last one visiting every other point
+    :param matrix: distance matrix of shape (n, n)
+    :return: list of point indices
+    """
+    last = len(matrix) - 1
+    visited = np.zeros(len(matrix), dtype=bool)
+    visited[[0, last]] = True
+    path = [0]
+    for _ in range(last - 1):
+        distances = np.where(visited, np.inf, matrix[path[-1]])
+        point = int(np.argmin(distances))
+        visited[point] = True
+        path.append(point)
+    return path + [last]
+
+
+def two_opt(matrix, path):
+    """
+    2-opt improvement of open path with fixed ends: path segments are reversed while it makes path shorter.
+    Gains of all segments starting at the same point are computed at once
+    :param matrix: symmetric distance matrix
+    :param path: list of point indices
+    :return: list of point indices
+    """
+    path = np.array(path)
+    improved = True
+    while improved:
+        improved = False
+        for start in range(1, len(path) - 2):
+            # Reversing path[start:end + 1] replaces edges (start - 1, start) and (end, end + 1)
+            # with (start - 1, end) and (start, end + 1)
+            before, first = path[start - 1], path[start]
+            ends, afters = path[start + 1:-1], path[start + 2:]
+            gains = matrix[before, ends] + matrix[first, afters] - matrix[before, first] - matrix[ends, afters]
+            best = int(np.argmin(gains))
+            if gains[best] < -1e-6:
+                end = start + 1 + best
+                path[start:end + 1] = path[start:end + 1][::-1].copy()
+                improved = True
+    return path.tolist()
+
+
+def order_waypoints(origin, destination, waypoints):
+    """
+    Orders waypoints to shorten route from origin to destination: nearest neighbour path improved by 2-opt
+    on great-circle distances
+    :param origin: (lat, lng)
+    :param destination: (lat, lng)
+    :param waypoints: list of (lat, lng)
+    :return: list of waypoint indices in visiting order
+    """
+    if len(waypoints) < 2:
+        return list(range(len(waypoints)))
+    matrix = geo.distance_matrix([origin] + list(waypoints) + [destination])
+    path = two_opt(matrix, nearest_neighbour_path(matrix))
+    return [point - 1 for point in path[1:-1]]
+
+
+def optimize_waypoints(origin, destination, waypoints):
+    """
+    Reorders waypoints given as 'lat,lng' strings. Waypoints are kept as typed if any stop is not coordinates
+    :param origin: origin location
+    :param destination: destination location
+    :param waypoints: list of waypoint locations
+    :return: list of waypoint locations
+    """
+    matches = [cache.COORDINATES_REGEXP.match(location) for location in [origin, destination] + waypoints]
+    if len(waypoints) < 2 or not all(matches):
+        return waypoints
+    points = [(float(match.group(1)), float(match.group(2))) for match in matches]
+    return [waypoints[index] for index in order_waypoints(points[0], points[1], points[2:])]
+
+
+def split_stops(stops, max_waypoints=None):
+    """
+    Splits route stops into consecutive chunks with at most max_waypoints intermediate stops each.
+    Neighbouring chunks share boundary stop
+    :param stops: list of origin, waypoints and destination
+    :param max_waypoints: maximum number of waypoints in one Directions request
+    :return: list of lists of stops
+    """
+    legs = (max_waypoints or config.GMAPS_MAX_WAYPOINTS) + 1
+    return [stops[start:start + legs + 1] for start in range(0, len(stops) - 1, legs)]
+
+
+def merge_directions(results):
+    """
+    Stitches Directions responses of consecutive route chunks into one response
+    :param results: list of Directions responses
+    :return: dict, Directions response (first failed response if any chunk failed)
+    """
+    for result in results:
+        if result['status'] != 'OK':
+            return result
+    routes = [result['routes'][0] for result in results]
+    route = dict(routes[0],
+                 legs=[leg for chunk in routes for leg in chunk['legs']],
+                 warnings=sorted({warning for chunk in routes for warning in chunk.get('warnings', [])}))
+    route['waypoint_order'] = list(range(len(route['legs']) - 1))
+    # Overview and bounds describe single chunk only
+    route.pop('overview_polyline', None)
+    route.pop('bounds', None)
+    return dict(results[0], routes=[route])
+
+
+async def chunked_directions(payload, directions, max_waypoints=None):
+    """
+    Requests route with any number of waypoints: waypoints beyond Directions API limit are split into chunks
+    requested concurrently and stitched into one route
+    :param payload: dictionary of Directions API parameters
+    :param directions: coroutine function taking chunk payload and returning Directions response
+    :param max_waypoints: maximum number of waypoints in one Directions request
+    :return: dict, Directions response
+    """
+    waypoints = [waypoint for waypoint in (payload.get('waypoints') or '').split('|') if waypoint]
+    chunks = split_stops([payload['origin']] + waypoints + [payload['destination']], max_waypoints)
+    if len(chunks) == 1:
+        return await directions(payload)
+    results = await asyncio.gather(*[directions(dict(payload, origin=chunk[0], destination=chunk[-1],
+                                                     waypoints='|'.join(chunk[1:-1])))
+                                     for chunk in chunks])
+    return merge_directions(results)
@@ -0,0 +1,134 @@
+import asyncio
+import collections
+import functools
+import logging
+
+import cache
+import config
+import gmaps
+import messages
+import ratelimit
+
+logger = logging.getLogger(__name__)
+
+
+class StreetViewPrefetcher:
+    """
+    Fetches Street View images of upcoming route steps in background while user reads current step,
+    so "target location image" is answered from memory. Each chat has bounded number of prefetched images per route
+    """
+
+    def __init__(self, route_storage, street_view_cache, client, steps=None, budget=None, concurrency=None,
+                 cache_size=None):
+        """
+        :param route_storage: routes.RouteStorage
+        :param street_view_cache: cache.StreetViewCache
+        :param client: gmaps.GoogleMapsClient
+        :param steps: number of steps prefetched starting with current one (0 - prefetching is off)
+        :param budget: maximum number of images fetched per chat route
+        :param concurrency: maximum number of images fetched at once by all chats
+        :param cache_size: number of chats spent budget is kept for, budget of the least recent chat is forgotten
+        """
+        self.route_storage = route_storage
+        self.street_view_cache = street_view_cache
+        self.client = client
+        self.steps = config.STREET_VIEW_PREFETCH_STEPS if steps is None else steps
+        self.budget = budget or config.STREET_VIEW_PREFETCH_BUDGET
+        self.concurrency = concurrency or config.STREET_VIEW_PREFETCH_CONCURRENCY
+        self._semaphore = None
+        self._tasks = {}  # chat -> step index -> prefetch task
+        # Chats that leave navigation without cancelling it would otherwise stay here forever
+        self._spent = cache.LRUCache(cache_size or config.STREET_VIEW_PREFETCH_CHATS)  # chat -> (route id, fetched)
+        self.counters = collections.Counter(scheduled=0, fetched=0, cached=0, cancelled=0, failed=0,
+                                            over_budget=0)
+
+    def schedule(self, chat, route_id, step_index):
+        """
+        Starts prefetching images of current and following steps. Prefetching of steps left behind is cancelled
+        :param chat: chat id
+        :param route_id: route id
+        :param step_index: index of step shown to user
+        """
+        if not self.steps or not route_id:
+            return
+        if self._semaphore is None:
+            self._semaphore = asyncio.Semaphore(self.concurrency)
+
+        tasks = self._tasks.setdefault(chat, {})
+        wanted = range(step_index, step_index + self.steps)
+        for index in list(tasks):
+            if index not in wanted:
+                tasks.pop(index).cancel()
+                self.counters['cancelled'] += 1
+
+        for index in wanted:
+            if index not in tasks:
+                task = asyncio.ensure_future(self._prefetch(chat, route_id, index))
+                task.add_done_callback(functools.partial(self._forget, chat, index))
+                tasks[index] = task
+                self.counters['scheduled'] += 1
+
+    def _forget(self, chat, index, task):
+        tasks = self._tasks.get(chat, {})
+        if tasks.get(index) is task:
+            del tasks[index]
+            if not tasks:
+                del self._tasks[chat]
+
+    def _spend(self, chat, route_id):
+        """
+        Takes one image from chat budget
+        :return: bool, False if budget of current route is spent
+        """
+        spent_route, spent = self._spent.get(chat) or (route_id, 0)
+        if spent_route != route_id:
+            spent = 0
+        if spent >= self.budget:
+            return False
+        self._spent.set(chat, (route_id, spent + 1), config.ROUTE_TTL)
+        return True
+
+    async def _prefetch(self, chat, route_id, index):
+        try:
+            async with self._semaphore:
+                step = await self.route_storage.get_step(chat, route_id, index)
+                if step is None:
+                    return
+                payload = messages.street_view_payload(step)
+                if await self.street_view_cache.has_image(payload):
+                    self.counters['cached'] += 1
+                    return
+                if not self._spend(chat, route_id):
+                    self.counters['over_budget'] += 1
+                    return
+
+                image = await self.client.street_view(payload, chat=chat)
+                self.street_view_cache.set_prefetched_image(payload, image)
+                self.counters['fetched'] += 1
+        except asyncio.CancelledError:
+            raise
+        except ratelimit.QuotaExceeded:
+            self.counters['failed'] += 1
+        except gmaps.ImageNotAvailable as error:
+            self.counters['failed'] += 1
+            logger.warning('Street View prefetch of chat %s step %s failed: %s', chat, index, error)
+        except Exception:
+            self.counters['failed'] += 1
+            logger.exception('Street View prefetch of chat %s step %s failed', chat, index)
+
+    def cancel(self, chat):
+        """
+        Stops prefetching for chat (navigation cancelled or finished)
+        :param chat: chat id
+        """
+        for task in self._tasks.pop(chat, {}).values():
+            task.cancel()
+            self.counters['cancelled'] += 1
+        self._spent.pop(chat)
+
+    @property
+    def stats(self):
+        """
+        Prefetch counters and number of chats being prefetched for
+        """
+        return dict(self.counters, active_chats=len(self._tasks))
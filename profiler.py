@@ -0,0 +1,316 @@
+import asyncio
+import collections
+import contextvars
+import json
+import logging
+import os
+import random
+import sys
+import threading
+import time
+
+from aiogram import types
+from aiogram.dispatcher.middlewares import BaseMiddleware
+
+import config
+import router
+import sharding
+
+logger = logging.getLogger(__name__)
+
+# Sorted set of profiled chats scored by time profiling expires at
+CHATS_KEY = 'profiler:chats'
+
+# Profile of update being processed (None if update is not profiled)
+current_profile = contextvars.ContextVar('current_profile', default=None)
+
+
+def frame_label(frame):
+    code = frame.f_code
+    return '{} ({}:{})'.format(code.co_name, os.path.basename(code.co_filename), frame.f_lineno)
+
+
+def coroutine_frames(coroutine):
+    """
+    :param coroutine: suspended coroutine
+    :return: list of frames of coroutine and coroutines it awaits, outermost first
+    """
+    frames = []
+    while coroutine is not None:
+        frame = getattr(coroutine, 'cr_frame', None) or getattr(coroutine, 'gi_frame', None)
+        if frame is None:
+            break
+        frames.append(frame)
+        coroutine = getattr(coroutine, 'cr_await', None) or getattr(coroutine, 'gi_yieldfrom', None)
+    return frames
+
+
+def running_frames(thread_frame, coroutine_frame):
+    """
+    :param thread_frame: innermost frame of thread coroutine is running in
+    :param coroutine_frame: frame of running coroutine
+    :return: list of frames from coroutine frame to innermost one (empty if coroutine is not on thread stack)
+    """
+    frames = []
+    frame = thread_frame
+    while frame is not None:
+        frames.append(frame)
+        if frame is coroutine_frame:
+            return frames[::-1]
+        frame = frame.f_back
+    return []
+
+
+class StackSampler:
+    """
+    Background thread periodically recording stacks of tracked asyncio tasks: code being run
+    or awaited when task is suspended. Thread sleeps while nothing is tracked
+    """
+
+    def __init__(self, interval=None):
+        """
+        :param interval: time (seconds) between samples
+        """
+        self.interval = interval or config.PROFILER_INTERVAL
+        self._recordings = {}
+        self._lock = threading.Lock()
+        self._active = threading.Event()
+        self._thread = None
+        self._loop_thread = None
+
+    def track(self, task):
+        """
+        Starts recording stacks of task (until untrack is called or task is done)
+        :param task: asyncio task
+        :return: collections.Counter of collapsed stacks ("outer;...;inner" frame labels) filled in by sampling
+        """
+        coroutine = task.get_coro() if hasattr(task, 'get_coro') else task._coro
+        stacks = collections.Counter()
+        with self._lock:
+            self._recordings[task] = (coroutine, stacks)
+            self._active.set()
+        if self._thread is None:
+            self._loop_thread = threading.get_ident()
+            self._thread = threading.Thread(target=self._run, name='stack-sampler', daemon=True)
+            self._thread.start()
+        return stacks
+
+    def untrack(self, task):
+        """
+        Stops recording stacks of task, its stacks are not changed after this call
+        """
+        with self._lock:
+            self._recordings.pop(task, None)
+
+    def _run(self):
+        while True:
+            self._active.wait()
+            time.sleep(self.interval)
+            with self._lock:
+                for task in [task for task in self._recordings if task.done()]:
+                    del self._recordings[task]
+                if not self._recordings:
+                    self._active.clear()
+                    continue
+                self._sample()
+
+    def _sample(self):
+        thread_frame = sys._current_frames().get(self._loop_thread)
+        for coroutine, stacks in self._recordings.values():
+            if getattr(coroutine, 'cr_running', False) or getattr(coroutine, 'gi_running', False):
+                frame = getattr(coroutine, 'cr_frame', None) or getattr(coroutine, 'gi_frame', None)
+                frames = running_frames(thread_frame, frame)
+            else:
+                frames = coroutine_frames(coroutine)
+            if frames:
+                stacks[';'.join(frame_label(frame) for frame in frames)] += 1
+
+
+class UpdateProfile:
+    """
+    Profile of single update
+    """
+    __slots__ = ('update_id', 'chat', 'reason', 'started', 'task', 'stacks', 'handler', 'state')
+
+    def __init__(self, update_id, chat, reason, task, stacks):
+        self.update_id = update_id
+        self.chat = chat
+        self.reason = reason
+        self.started = time.perf_counter()
+        self.task = task
+        self.stacks = stacks
+        self.handler = 'unhandled'
+        self.state = 'none'
+
+
+def write_profile(directory, max_files, profile):
+    """
+    Writes profile to directory keeping only max_files newest profiles
+    :param directory: profiles directory (created if absent)
+    :param max_files: maximum number of stored profiles
+    :param profile: JSON serializable profile with "update_id" field
+    :return: path of written file
+    """
+    os.makedirs(directory, exist_ok=True)
+    path = os.path.join(directory, '{}-{}.json'.format(time.strftime('%Y%m%d-%H%M%S'), profile['update_id']))
+    with open(path + '.tmp', 'w') as file:
+        json.dump(profile, file, indent=1)
+    os.replace(path + '.tmp', path)
+
+    names = sorted(name for name in os.listdir(directory) if name.endswith('.json'))
+    for name in names[:max(0, len(names) - max_files)]:
+        try:
+            os.remove(os.path.join(directory, name))
+        except FileNotFoundError:
+            pass
+    return path
+
+
+class ProfilerMiddleware(BaseMiddleware):
+    """
+    Samples where processing time of chosen updates goes: random 1-in-N updates, updates slower than threshold
+    and all updates of chats profiling was turned on for. Profiles annotated with handler, state and update id
+    are written to rotating directory. With sampling and threshold off and no profiled chats
+    only a periodic reload of profiled chats is done
+    """
+
+    def __init__(self, redis, sample_rate=None, slow_threshold=None, directory=None, max_files=None):
+        """
+        :param redis: coroutine function returning aioredis connection (e.g. RedisStorage2.redis)
+        :param sample_rate: profile 1 of sample_rate updates (0 - off)
+        :param slow_threshold: updates processed longer (seconds) are profiled (0 - off)
+        :param directory: profiles directory
+        :param max_files: maximum number of stored profiles
+        """
+        super(ProfilerMiddleware, self).__init__()
+        self._redis = redis
+        self.sample_rate = config.PROFILER_SAMPLE_RATE if sample_rate is None else sample_rate
+        self.slow_threshold = config.PROFILER_SLOW_THRESHOLD if slow_threshold is None else slow_threshold
+        self.directory = directory or config.PROFILER_DIR
+        self.max_files = max_files or config.PROFILER_MAX_FILES
+        self.sampler = StackSampler()
+        self.counters = collections.Counter()
+        self._chats = frozenset()
+        self._chats_expire = 0
+
+    async def enable_chat(self, chat, ttl=None):
+        """
+        Turns profiling of all chat updates on
+        :param chat: chat id
+        :param ttl: time (seconds) chat stays profiled
+        """
+        redis = await self._redis()
+        await redis.zadd(CHATS_KEY, time.time() + (ttl or config.PROFILER_CHAT_TTL), chat)
+        self._chats_expire = 0
+
+    async def disable_chat(self, chat):
+        """
+        Turns profiling of chat updates off
+        :param chat: chat id
+        """
+        redis = await self._redis()
+        await redis.zrem(CHATS_KEY, chat)
+        self._chats_expire = 0
+
+    async def profiled_chats(self):
+        """
+        :return: dict, ids of profiled chats with time (seconds since epoch) profiling expires at
+        """
+        redis = await self._redis()
+        now = time.time()
+        pipeline = redis.pipeline()
+        pipeline.zremrangebyscore(CHATS_KEY, max=now)
+        chats = pipeline.zrangebyscore(CHATS_KEY, min=now, withscores=True)
+        await pipeline.execute()
+        return {int(chat): expires for chat, expires in await chats}
+
+    async def _chat_profiled(self, chat):
+        # Profiled chats are shared by all processes through Redis and reloaded periodically
+        now = time.monotonic()
+        if now >= self._chats_expire:
+            self._chats_expire = now + config.PROFILER_REFRESH_INTERVAL
+            try:
+                self._chats = frozenset(await self.profiled_chats())
+            except asyncio.CancelledError:
+                raise
+            except Exception:
+                logger.exception('Profiled chats reload failed')
+        return chat in self._chats
+
+    async def on_pre_process_update(self, update: types.Update, data):
+        chat = sharding.update_chat_id(update)
+        if await self._chat_profiled(chat):
+            reason = 'chat'
+        elif self.sample_rate and random.randrange(self.sample_rate) == 0:
+            reason = 'sample'
+        elif self.slow_threshold:
+            reason = 'slow'
+        else:
+            current_profile.set(None)
+            return
+
+        task = asyncio.current_task()
+        profile = UpdateProfile(update.update_id, chat, reason, task, self.sampler.track(task))
+        current_profile.set(profile)
+        data['profile'] = profile
+
+    async def on_process_message(self, message: types.Message, data):
+        profile = current_profile.get()
+        if profile is None:
+            return
+        profile.handler = router.handler_name(data)
+        session = data.get('session')
+        if session is not None and session.state:
+            profile.state = session.state
+
+    on_process_edited_message = on_process_message
+    on_process_callback_query = on_process_message
+
+    async def on_post_process_update(self, update: types.Update, results, data):
+        profile = data.get('profile')
+        if profile is None:
+            return
+        self.sampler.untrack(profile.task)
+        current_profile.set(None)
+        duration = time.perf_counter() - profile.started
+        if profile.reason == 'slow' and duration < self.slow_threshold:
+            return
+
+        self.counters[profile.reason] += 1
+        dump = {'update_id': profile.update_id,
+                'chat': profile.chat,
+                'handler': profile.handler,
+                'state': profile.state,
+                'reason': profile.reason,
+                'duration': duration,
+                'interval': self.sampler.interval,
+                'samples': sum(profile.stacks.values()),
+                'stacks': profile.stacks.most_common()}
+        try:
+            path = await asyncio.get_event_loop().run_in_executor(None, write_profile,
+                                                                  self.directory, self.max_files, dump)
+        except OSError:
+            logger.exception('Profile of update %s was not written', profile.update_id)
+            return
+        logger.info('Update %s (%s, %.3f s) profiled to %s', profile.update_id, profile.handler, duration, path)
+
+    @property
+    def stats(self):
+        """
+        Number of written profiles by reason
+        """
+        return dict(self.counters)
+
+
+def main():
+    # Prints profile as collapsed stacks for flame graph tools (flamegraph.pl, speedscope)
+    if len(sys.argv) != 2:
+        sys.exit('Usage: python profiler.py PROFILE.json > stacks.txt')
+    with open(sys.argv[1]) as file:
+        profile = json.load(file)
+    for stack, count in profile['stacks']:
+        print(stack, count)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,217 @@
+import asyncio
+import collections
+import datetime
+import logging
+import math
+import time
+
+import config
+
+logger = logging.getLogger(__name__)
+
+# Token bucket shared by all workers. Takes one token and counts it against daily quota.
+# Returns 0 if token is taken, time to wait (seconds) if bucket is empty or -1 if daily quota is exhausted
+TAKE_TOKEN_SCRIPT = """
+local rate, capacity, now, quota = tonumber(ARGV[1]), tonumber(ARGV[2]), tonumber(ARGV[3]), tonumber(ARGV[4])
+if quota > 0 and (tonumber(redis.call('get', KEYS[2])) or 0) >= quota then
+    return '-1'
+end
+local bucket = redis.call('hmget', KEYS[1], 'tokens', 'ts')
+local tokens = tonumber(bucket[1]) or capacity
+local ts = tonumber(bucket[2]) or now
+tokens = math.min(capacity, tokens + math.max(0, now - ts) * rate)
+local wait = 0
+if tokens >= 1 then
+    tokens = tokens - 1
+    redis.call('incr', KEYS[2])
+    redis.call('expire', KEYS[2], 172800)
+else
+    wait = (1 - tokens) / rate
+end
+redis.call('hmset', KEYS[1], 'tokens', tokens, 'ts', now)
+redis.call('pexpire', KEYS[1], math.ceil(capacity / rate * 1000) + 1000)
+return tostring(wait)
+"""
+
+
+def quota_day(timestamp):
+    """
+    Google resets daily quotas at midnight Pacific Time, so quota counters are keyed by Pacific date
+    rather than by local date of worker
+
+    :param timestamp: UNIX time
+    :return: str, Pacific date of timestamp in ISO format
+    """
+    utc = datetime.datetime.utcfromtimestamp(timestamp)
+    # Daylight saving time lasts from 2:00 PST of second Sunday of March till 2:00 PDT of first Sunday of November
+    march, november = datetime.datetime(utc.year, 3, 8), datetime.datetime(utc.year, 11, 1)
+    dst_start = march + datetime.timedelta(days=(6 - march.weekday()) % 7, hours=2 + 8)
+    dst_end = november + datetime.timedelta(days=(6 - november.weekday()) % 7, hours=2 + 7)
+    offset = -7 if dst_start <= utc < dst_end else -8
+    return (utc + datetime.timedelta(hours=offset)).date().isoformat()
+
+
+class QuotaExceeded(Exception):
+    """
+    Daily quota of endpoint is exhausted or request waited in queue for too long
+    """
+
+
+class RateLimiter:
+    """
+    Limits request rate of Google Maps endpoints with Redis token buckets shared by all workers.
+    Requests waiting for token are queued per endpoint and served round-robin by chat,
+    so single chat can not hold back all others
+    """
+
+    def __init__(self, redis, rates=None, quotas=None, timeout=None):
+        """
+        :param redis: coroutine function returning aioredis connection (e.g. RedisStorage2.redis)
+        :param rates: dictionary endpoint -> (requests per second, burst size)
+        :param quotas: dictionary endpoint -> requests per day (0 - unlimited)
+        :param timeout: maximum time (seconds) request may wait in queue
+        """
+        self._redis = redis
+        self.rates = rates or config.GMAPS_RATE_LIMITS
+        self.quotas = quotas or config.GMAPS_DAILY_QUOTAS
+        self.timeout = timeout or config.GMAPS_QUEUE_TIMEOUT
+        self._queues = collections.defaultdict(collections.OrderedDict)  # endpoint -> chat -> waiting futures
+        self._schedulers = {}
+        self.counters = collections.defaultdict(lambda: collections.Counter(granted=0, waited=0, rejected=0,
+                                                                            wait_time=0, max_wait_time=0))
+
+    async def _take_token(self, endpoint):
+        """
+        :return: float, 0 if token is taken, time to wait if bucket is empty or -1 if daily quota is exhausted
+        """
+        rate, capacity = self.rates[endpoint]
+        redis = await self._redis()
+        now = time.time()
+        wait = await redis.eval(TAKE_TOKEN_SCRIPT,
+                                keys=['ratelimit:{}'.format(endpoint), 'quota:{}:{}'.format(endpoint, quota_day(now))],
+                                args=[rate, capacity, now, self.quotas.get(endpoint, 0)])
+        return float(wait)
+
+    async def _schedule(self, endpoint):
+        """
+        Hands tokens out to queued requests, one request of each chat in turn
+        """
+        queue = self._queues[endpoint]
+        while queue:
+            chat, waiters = next(iter(queue.items()))
+            future = waiters.popleft()
+            if waiters:
+                queue.move_to_end(chat)
+            else:
+                del queue[chat]
+            if future.done():
+                # Request gave up waiting
+                continue
+
+            try:
+                wait = await self._take_token(endpoint)
+                while wait > 0 and not future.done():
+                    await asyncio.sleep(wait)
+                    wait = await self._take_token(endpoint)
+            except asyncio.CancelledError:
+                raise
+            except Exception as error:
+                if not future.done():
+                    future.set_exception(error)
+                continue
+
+            if future.done():
+                continue
+            if wait < 0:
+                future.set_exception(QuotaExceeded('Daily quota of {} is exhausted'.format(endpoint)))
+            else:
+                future.set_result(None)
+
+    async def acquire(self, endpoint, chat=None):
+        """
+        Waits for permission to send request
+        :param endpoint: endpoint name (e.g. 'directions')
+        :param chat: id of chat request is sent for
+        :raise QuotaExceeded: daily quota is exhausted or request has waited longer than timeout
+        """
+        if endpoint not in self.rates:
+            return
+
+        future = asyncio.get_event_loop().create_future()
+        self._queues[endpoint].setdefault(chat, collections.deque()).append(future)
+        scheduler = self._schedulers.get(endpoint)
+        if scheduler is None or scheduler.done():
+            self._schedulers[endpoint] = asyncio.ensure_future(self._schedule(endpoint))
+
+        counters = self.counters[endpoint]
+        started = time.monotonic()
+        try:
+            await asyncio.wait_for(future, self.timeout)
+        except asyncio.TimeoutError:
+            counters['rejected'] += 1
+            raise QuotaExceeded('Request to {} has waited in queue for too long'.format(endpoint))
+        except QuotaExceeded:
+            counters['rejected'] += 1
+            raise
+        finally:
+            wait_time = time.monotonic() - started
+            counters['wait_time'] += wait_time
+            counters['max_wait_time'] = max(counters['max_wait_time'], wait_time)
+        counters['granted'] += 1
+        if wait_time > 0.01:
+            counters['waited'] += 1
+
+    def queue_depth(self, endpoint):
+        """
+        :param endpoint: endpoint name
+        :return: int, number of requests waiting for token
+        """
+        return sum(len(waiters) for waiters in self._queues[endpoint].values())
+
+    @property
+    def stats(self):
+        """
+        Queue depth, granted, delayed and rejected requests and wait time by endpoint
+        """
+        stats = {}
+        for endpoint, counters in self.counters.items():
+            requests_number = counters['granted'] + counters['rejected']
+            stats[endpoint] = dict(counters,
+                                   queue_depth=self.queue_depth(endpoint),
+                                   average_wait_time=counters['wait_time'] / requests_number if requests_number else 0)
+        return stats
+
+
+class ChatCooldown:
+    """
+    Lets action of each chat happen at most once per interval. Shared by all workers
+    """
+
+    def __init__(self, redis, name, interval):
+        """
+        :param redis: coroutine function returning aioredis connection (e.g. RedisStorage2.redis)
+        :param name: action name, part of Redis keys
+        :param interval: seconds between actions of one chat
+        """
+        self._redis = redis
+        self.name = name
+        self.interval = interval
+        self.counters = collections.Counter(granted=0, rejected=0)
+
+    async def take(self, chat):
+        """
+        :param chat: chat id
+        :return: bool, True if chat may act now
+        """
+        redis = await self._redis()
+        granted = await redis.set('cooldown:{}:{}'.format(self.name, chat), 1,
+                                  expire=max(1, int(math.ceil(self.interval))), exist=redis.SET_IF_NOT_EXIST)
+        self.counters['granted' if granted else 'rejected'] += 1
+        return bool(granted)
+
+    @property
+    def stats(self):
+        """
+        Granted and rejected actions
+        """
+        return dict(self.counters)
@@ -0,0 +1,78 @@
+import collections
+
+from aiogram.dispatcher.filters.builtin import StateFilter
+from aiogram.dispatcher.filters.state import State
+from aiogram.dispatcher.handler import current_handler
+
+# Handler of button and arguments it is called with besides message and session
+Route = collections.namedtuple('Route', ['handler', 'kwargs'])
+
+# Key of route in handler data
+ROUTE_KEY = 'route'
+
+
+class ButtonRouter:
+    """
+    Dispatch table of keyboard buttons: (state, button text) -> Route. Single dictionary lookup replaces walking
+    handlers with state and button membership filters one by one. As with handlers, the first route added
+    for (state, button) wins
+    """
+
+    def __init__(self, states):
+        """
+        :param states: StatesGroup of all bot states, "*" routes are added for each of them and for no state
+        """
+        self.states = [None] + list(states.all_states_names)
+        self.buttons = frozenset()
+        self._routes = {}
+
+    def add(self, states, buttons, handler, **kwargs):
+        """
+        Routes buttons pressed in states to handler
+        :param states: State, list of states or "*" for any state
+        :param buttons: iterable of button texts
+        :param handler: coroutine function called with message, session and kwargs
+        :param kwargs: handler arguments
+        """
+        if states == '*':
+            states = self.states
+        elif isinstance(states, State):
+            states = [states]
+        route = Route(handler, kwargs)
+        for state in states:
+            for button in buttons:
+                self._routes.setdefault((getattr(state, 'state', state), button), route)
+        self.buttons = frozenset(button for _, button in self._routes)
+
+    def get(self, state, text):
+        """
+        :param state: state name
+        :param text: button text
+        :return: Route or None
+        """
+        return self._routes.get((state, text))
+
+    def filter(self, message):
+        """
+        Handler filter: finds route of button in user state preloaded by session middleware
+        :param message: incoming message
+        :return: dictionary with route passed to handler or False if message is not a button of current state
+        """
+        if message.text not in self.buttons:
+            return False
+        route = self._routes.get((StateFilter.ctx_state.get(None), message.text))
+        return {ROUTE_KEY: route} if route is not None else False
+
+    def __len__(self):
+        return len(self._routes)
+
+
+def handler_name(data):
+    """
+    Name of handler processing update, routed button handler rather than router handler
+    :param data: handler data
+    :return: str
+    """
+    route = data.get(ROUTE_KEY)
+    handler = route.handler if route is not None else current_handler.get(None)
+    return getattr(handler, '__name__', 'unknown')
@@ -0,0 +1,246 @@
+import functools
+import json
+import operator
+import uuid
+
+import numpy as np
+
+import config
+import geo
+import messages
+
+# Replaces steps ARGV[1]:ARGV[2] of route list with steps ARGV[5...] and route geometry with ARGV[4],
+# both live ARGV[3] seconds. Kept steps are read and written back atomically, so concurrent change is never lost
+SPLICE_ROUTE_SCRIPT = """
+local start, finish, ttl = tonumber(ARGV[1]), tonumber(ARGV[2]), tonumber(ARGV[3])
+local tail = redis.call('lrange', KEYS[1], finish, -1)
+if start > 0 then
+    redis.call('ltrim', KEYS[1], 0, start - 1)
+else
+    redis.call('del', KEYS[1])
+end
+for i = 5, #ARGV do
+    redis.call('rpush', KEYS[1], ARGV[i])
+end
+for i = 1, #tail do
+    redis.call('rpush', KEYS[1], tail[i])
+end
+redis.call('expire', KEYS[1], ttl)
+redis.call('set', KEYS[2], ARGV[4], 'EX', ttl)
+return #tail
+"""
+
+
+def compact_step(step):
+    """
+    Keeps only step data used by the bot. Step message is rendered here for every step of the route,
+    shown or not, so navigation only looks up ready string (see benchmarks/bench_instructions.py)
+    :param step: Google Directions step
+    :return: dict, compact step record
+    """
+    return {'m': messages.reply_message(step),
+            's': [step['start_location']['lat'], step['start_location']['lng']],
+            'e': [step['end_location']['lat'], step['end_location']['lng']]}
+
+
+def build_route(gmaps_data):
+    """
+    Route build stage: flattens steps of all route legs into compact step records
+    and computes Street View headings of all steps in single vectorized pass
+    :param gmaps_data: Google Directions response
+    :return: list of compact step records
+    """
+    steps = functools.reduce(operator.iconcat, [leg["steps"] for leg in gmaps_data["routes"][0]["legs"]], [])
+    records = [compact_step(step) for step in steps]
+
+    headings = geo.bearings([record['s'] for record in records], [record['e'] for record in records])
+    for record, heading in zip(records, headings):
+        record['h'] = round(float(heading), 1)
+
+    return records
+
+
+def route_geometry(gmaps_data):
+    """
+    Decodes polylines of all route steps into one coordinate array, so live location is matched
+    against the route without decoding anything per location update
+    :param gmaps_data: Google Directions response
+    :return: tuple (points, offsets, legs): float32 array of shape (n, 2) of (lat, lng), int array of step offsets
+    in points and int array of leg offsets in steps. Points of step i are points[offsets[i]:offsets[i + 1]],
+    steps of leg j are steps legs[j]:legs[j + 1]
+    """
+    route_legs = gmaps_data["routes"][0]["legs"]
+    steps = functools.reduce(operator.iconcat, [leg["steps"] for leg in route_legs], [])
+    legs = np.cumsum([0] + [len(leg["steps"]) for leg in route_legs])
+    lines = []
+    for step in steps:
+        line = geo.decode_polyline(step['polyline']['points']) if 'polyline' in step else np.empty((0, 2))
+        if len(line) < 2:
+            line = np.array([[step['start_location']['lat'], step['start_location']['lng']],
+                             [step['end_location']['lat'], step['end_location']['lng']]])
+        lines.append(line)
+    offsets = np.cumsum([0] + [len(line) for line in lines])
+    return np.concatenate(lines).astype(np.float32), offsets, legs
+
+
+def splice_geometry(geometry, start, end, replacement):
+    """
+    Puts geometry of new steps in place of steps start:end of one leg
+    :param geometry: tuple (points, offsets, legs) of route (see route_geometry)
+    :param start: index of first replaced step
+    :param end: index of step following the last replaced one
+    :param replacement: tuple (points, offsets, legs) of single leg route
+    :return: tuple (points, offsets, legs) of route
+    """
+    points, offsets, legs = geometry
+    new_points, new_offsets, _ = replacement
+    points = np.concatenate((points[:offsets[start]], new_points, points[offsets[end]:])).astype(np.float32)
+    offsets = np.concatenate((offsets[:start], new_offsets + offsets[start],
+                              offsets[end + 1:] - offsets[end] + offsets[start] + new_offsets[-1]))
+    shift = len(new_offsets) - 1 - (end - start)
+    legs = np.where(legs > start, legs + shift, legs)
+    return points, offsets, legs
+
+
+def pack_geometry(points, offsets, legs):
+    """
+    :param points: float32 array of shape (n, 2)
+    :param offsets: array of step offsets
+    :param legs: array of leg offsets
+    :return: bytes, numbers of offsets, offsets and points as little-endian binary
+    """
+    return b''.join((np.array([len(offsets), len(legs)], dtype='<u4').tobytes(),
+                     np.asarray(offsets, dtype='<u4').tobytes(), np.asarray(legs, dtype='<u4').tobytes(),
+                     np.asarray(points, dtype='<f4').tobytes()))
+
+
+def unpack_geometry(raw):
+    """
+    :param raw: bytes made by pack_geometry
+    :return: tuple (points, offsets, legs)
+    """
+    steps, legs = np.frombuffer(raw, dtype='<u4', count=2)
+    offsets = np.frombuffer(raw, dtype='<u4', count=steps, offset=8).astype(np.int64)
+    legs = np.frombuffer(raw, dtype='<u4', count=legs, offset=4 * (2 + steps)).astype(np.int64)
+    points = np.frombuffer(raw, dtype='<f4', offset=4 * (2 + len(offsets) + len(legs))).reshape(-1, 2)
+    return points, offsets, legs
+
+
+class RouteStorage:
+    """
+    Keeps route steps in per-chat Redis lists apart from FSM data, so navigation reads only one step at a time
+    """
+
+    def __init__(self, redis, ttl=None, prefix='route'):
+        """
+        :param redis: coroutine function returning aioredis connection (e.g. RedisStorage2.redis)
+        :param ttl: route lifetime in seconds since last access
+        :param prefix: Redis keys prefix
+        """
+        self._redis = redis
+        self.ttl = ttl or config.ROUTE_TTL
+        self.prefix = prefix
+
+    def key(self, chat, route_id):
+        """
+        Redis key of route steps list
+        """
+        return '{}:{}:{}'.format(self.prefix, chat, route_id)
+
+    def geometry_key(self, chat, route_id):
+        """
+        Redis key of route geometry
+        """
+        return '{}:{}:{}:geometry'.format(self.prefix, chat, route_id)
+
+    async def save(self, chat, steps, previous_route_id=None, geometry=None):
+        """
+        Stores route steps
+        :param chat: chat id
+        :param steps: list of compact step records (see build_route)
+        :param previous_route_id: id of chat route to be replaced
+        :param geometry: tuple (points, offsets, legs) of route geometry (see route_geometry)
+        :return: str, new route id
+        """
+        route_id = uuid.uuid4().hex[:12]
+        key = self.key(chat, route_id)
+
+        redis = await self._redis()
+        transaction = redis.multi_exec()
+        if previous_route_id:
+            transaction.delete(self.key(chat, previous_route_id), self.geometry_key(chat, previous_route_id))
+        transaction.rpush(key, *[json.dumps(step, separators=(',', ':')) for step in steps])
+        transaction.expire(key, self.ttl)
+        if geometry is not None:
+            transaction.set(self.geometry_key(chat, route_id), pack_geometry(*geometry), expire=self.ttl)
+        await transaction.execute()
+
+        return route_id
+
+    async def get_step(self, chat, route_id, index):
+        """
+        Loads single route step and prolongs route lifetime
+        :param chat: chat id
+        :param route_id: route id
+        :param index: step index
+        :return: dict, compact step record or None if there is no such step
+        """
+        if not route_id or index < 0:
+            return None
+        key = self.key(chat, route_id)
+
+        redis = await self._redis()
+        pipe = redis.pipeline()
+        pipe.lindex(key, index, encoding='utf8')
+        pipe.expire(key, self.ttl)
+        pipe.expire(self.geometry_key(chat, route_id), self.ttl)
+        raw_step, _, _ = await pipe.execute()
+
+        return json.loads(raw_step) if raw_step else None
+
+    async def get_geometry(self, chat, route_id):
+        """
+        :param chat: chat id
+        :param route_id: route id
+        :return: tuple (points, offsets, legs) of route geometry or None if route has no stored geometry
+        """
+        if not route_id:
+            return None
+        redis = await self._redis()
+        raw = await redis.get(self.geometry_key(chat, route_id))
+        return unpack_geometry(raw) if raw else None
+
+    async def splice(self, chat, route_id, start, end, steps, geometry):
+        """
+        Replaces steps start:end of stored route with new ones, steps after them are kept
+        :param chat: chat id
+        :param route_id: route id
+        :param start: index of first replaced step
+        :param end: index of step following the last replaced one
+        :param steps: list of compact step records
+        :param geometry: tuple (points, offsets, legs) of whole route after replacement (see splice_geometry)
+        """
+        redis = await self._redis()
+        await redis.eval(SPLICE_ROUTE_SCRIPT, keys=[self.key(chat, route_id), self.geometry_key(chat, route_id)],
+                         args=[start, end, self.ttl, pack_geometry(*geometry),
+                               *[json.dumps(step, separators=(',', ':')) for step in steps]])
+
+    async def length(self, chat, route_id):
+        """
+        :param chat: chat id
+        :param route_id: route id
+        :return: int, number of route steps (0 if route is absent or expired)
+        """
+        if not route_id:
+            return 0
+        redis = await self._redis()
+        return await redis.llen(self.key(chat, route_id))
+
+    async def delete(self, chat, route_id):
+        """
+        :param chat: chat id
+        :param route_id: route id
+        """
+        if route_id:
+            redis = await self._redis()
+            await redis.delete(self.key(chat, route_id), self.geometry_key(chat, route_id))
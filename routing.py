@@ -0,0 +1,642 @@
+import asyncio
+import bz2
+import collections
+import concurrent.futures
+import gzip
+import heapq
+import html
+import json
+import logging
+import math
+import os
+import re
+import sys
+import time
+from xml.etree import ElementTree
+
+import numpy as np
+
+import cache
+import config
+import geo
+
+logger = logging.getLogger(__name__)
+
+GRAPH_VERSION = 1
+
+# Directions statuses meaning Google could not answer at all (as opposed to route not existing)
+FALLBACK_STATUSES = {'OVER_QUERY_LIMIT', 'OVER_DAILY_LIMIT', 'REQUEST_DENIED', 'UNKNOWN_ERROR'}
+
+# Edge access bits by travel mode
+CAR, BICYCLE, FOOT = 1, 2, 4
+MODE_ACCESS = {'driving': CAR, 'bicycling': BICYCLE, 'walking': FOOT}
+MODE_TAGS = {CAR: ('motor_vehicle', 'motorcar'), BICYCLE: ('bicycle',), FOOT: ('foot',)}
+NO_ACCESS = {'no', 'private'}
+YES_ACCESS = {'yes', 'designated', 'permissive'}
+
+# Edge flags, avoid parameter values and flags they exclude
+TOLL, MOTORWAY, FERRY, ROUNDABOUT = 1, 2, 4, 8
+AVOID_FLAGS = {'tolls': TOLL, 'highways': MOTORWAY, 'ferries': FERRY}
+
+# Driving speeds (km/h) by highway type when way has no maxspeed
+CAR_SPEEDS = {'motorway': 110, 'motorway_link': 60, 'trunk': 90, 'trunk_link': 50,
+              'primary': 60, 'primary_link': 40, 'secondary': 50, 'secondary_link': 35,
+              'tertiary': 40, 'tertiary_link': 30, 'unclassified': 30, 'residential': 25,
+              'living_street': 10, 'service': 15, 'road': 25}
+MOTORWAYS = {'motorway', 'motorway_link'}
+BICYCLE_HIGHWAYS = set(CAR_SPEEDS) - MOTORWAYS - {'trunk', 'trunk_link'} | {'cycleway', 'path', 'track'}
+FOOT_HIGHWAYS = set(CAR_SPEEDS) - MOTORWAYS - {'trunk', 'trunk_link'} | {'footway', 'pedestrian', 'path', 'steps',
+                                                                        'track', 'cycleway'}
+FERRY_SPEED = 15  # km/h
+DEFAULT_CAR_SPEED = 15  # km/h, ways opened to cars by access tags
+MAX_CAR_SPEED = 130  # km/h
+MODE_SPEEDS = {'walking': 5 / 3.6, 'bicycling': 15 / 3.6}  # m/s
+
+MAXSPEED_REGEXP = re.compile(r'\s*(\d+(?:\.\d+)?)\s*(mph)?')
+
+COMPASS = ('north', 'northeast', 'east', 'southeast', 'south', 'southwest', 'west', 'northwest')
+
+
+def parse_maxspeed(value):
+    """
+    :param value: OSM maxspeed tag value, e.g. "60" or "30 mph"
+    :return: speed in km/h or None if value is not numeric
+    """
+    match = MAXSPEED_REGEXP.match(value or '')
+    if match is None:
+        return None
+    speed = float(match.group(1))
+    return speed * 1.609344 if match.group(2) else speed
+
+
+def way_properties(tags):
+    """
+    Routing properties of OSM way
+    :param tags: dict of way tags
+    :return: tuple (modes allowed forward, modes allowed backward, flags, driving speed in km/h)
+    or None if way is not routable
+    """
+    highway = tags.get('highway')
+    if tags.get('route') == 'ferry':
+        modes, flags, speed = CAR | BICYCLE | FOOT, FERRY, FERRY_SPEED
+    elif highway in CAR_SPEEDS or highway in BICYCLE_HIGHWAYS or highway in FOOT_HIGHWAYS:
+        modes = ((CAR if highway in CAR_SPEEDS else 0) |
+                 (BICYCLE if highway in BICYCLE_HIGHWAYS else 0) |
+                 (FOOT if highway in FOOT_HIGHWAYS else 0))
+        flags = MOTORWAY if highway in MOTORWAYS else 0
+        speed = CAR_SPEEDS.get(highway, DEFAULT_CAR_SPEED)
+    else:
+        return None
+
+    if tags.get('access') in NO_ACCESS:
+        modes = 0
+    for mode, keys in MODE_TAGS.items():
+        for key in keys:
+            if tags.get(key) in NO_ACCESS:
+                modes &= ~mode
+            elif tags.get(key) in YES_ACCESS:
+                modes |= mode
+    if not modes:
+        return None
+
+    if tags.get('toll') == 'yes':
+        flags |= TOLL
+    if tags.get('junction') in ('roundabout', 'circular'):
+        flags |= ROUNDABOUT
+    maxspeed = parse_maxspeed(tags.get('maxspeed'))
+    if maxspeed:
+        speed = min(maxspeed, MAX_CAR_SPEED)
+
+    # Oneway restricts vehicles, pedestrians may walk both ways
+    oneway = tags.get('oneway')
+    if oneway is None and (flags & ROUNDABOUT or highway in MOTORWAYS):
+        oneway = 'yes'
+    restricted = CAR if tags.get('oneway:bicycle') == 'no' else CAR | BICYCLE
+    forward = backward = modes
+    if oneway in ('yes', 'true', '1'):
+        backward &= ~restricted
+    elif oneway == '-1':
+        forward &= ~restricted
+    return forward, backward, flags, speed
+
+
+def open_osm(path):
+    if path.endswith('.gz'):
+        return gzip.open(path, 'rb')
+    if path.endswith('.bz2'):
+        return bz2.open(path, 'rb')
+    return open(path, 'rb')
+
+
+def osm_elements(path, tag):
+    """
+    Streams OSM XML elements of one type, memory is freed as document is read
+    :param path: OSM XML extract (.osm, .osm.gz or .osm.bz2)
+    :param tag: element type ("node" or "way")
+    """
+    with open_osm(path) as file:
+        context = ElementTree.iterparse(file, events=('start', 'end'))
+        _, root = next(context)
+        for event, element in context:
+            if event == 'end' and element.tag in ('node', 'way', 'relation'):
+                if element.tag == tag:
+                    yield element
+                root.clear()
+
+
+def read_osm(path):
+    """
+    Reads routable ways and coordinates of their nodes from OSM XML extract. The file is read twice,
+    so coordinates of nodes not belonging to roads are never kept in memory
+    :param path: OSM XML extract (.osm, .osm.gz or .osm.bz2)
+    :return: tuple (list of ways as (node ids, properties, name), dict node id -> (lat, lng))
+    """
+    ways = []
+    needed = set()
+    for element in osm_elements(path, 'way'):
+        tags = {tag.get('k'): tag.get('v') for tag in element.iter('tag')}
+        properties = way_properties(tags)
+        if properties is None:
+            continue
+        refs = [int(nd.get('ref')) for nd in element.iter('nd')]
+        if len(refs) > 1:
+            ways.append((refs, properties, tags.get('name') or tags.get('ref') or ''))
+            needed.update(refs)
+
+    coords = {}
+    for element in osm_elements(path, 'node'):
+        node = int(element.get('id'))
+        if node in needed:
+            coords[node] = (float(element.get('lat')), float(element.get('lon')))
+    return ways, coords
+
+
+def build_graph(ways, coords):
+    """
+    Builds compact road graph. Vertices are road junctions and way ends, chains of nodes between them become
+    single edges keeping their geometry. Edges are stored in CSR arrays sorted by source vertex
+    :param ways: list of (node ids, properties, name) (see read_osm)
+    :param coords: dict node id -> (lat, lng)
+    :return: tuple (dict of numpy arrays, list of street names)
+    """
+    usage = collections.Counter()
+    for refs, _, _ in ways:
+        usage.update(refs)
+        usage[refs[0]] += 1
+        usage[refs[-1]] += 1
+
+    vertices = {}
+    names = {}
+    point_lat, point_lng, segment_offsets = [], [], [0]
+    sources, targets, segments, access, flags, edge_names, speeds = [], [], [], [], [], [], []
+
+    def vertex(node):
+        if node not in vertices:
+            vertices[node] = len(vertices)
+        return vertices[node]
+
+    def add_segment(nodes, properties, name_id):
+        forward, backward, way_flags, speed = properties
+        segment = len(segment_offsets) - 1
+        point_lat.extend(coords[node][0] for node in nodes)
+        point_lng.extend(coords[node][1] for node in nodes)
+        segment_offsets.append(len(point_lat))
+        start, end = vertex(nodes[0]), vertex(nodes[-1])
+        # Backward edges refer to segment as -(index + 1): geometry is read reversed
+        for source, target, modes, signed in ((start, end, forward, segment), (end, start, backward, -segment - 1)):
+            if modes:
+                sources.append(source)
+                targets.append(target)
+                segments.append(signed)
+                access.append(modes)
+                flags.append(way_flags)
+                edge_names.append(name_id)
+                speeds.append(speed)
+
+    for refs, properties, name in ways:
+        name_id = names.setdefault(name, len(names)) if name else -1
+        nodes = []
+        for node in refs:
+            if node not in coords:
+                # Way leaves the extract: it is cut here
+                if len(nodes) > 1:
+                    add_segment(nodes, properties, name_id)
+                nodes = []
+                continue
+            if nodes and nodes[-1] == node:
+                continue
+            nodes.append(node)
+            if len(nodes) > 1 and usage[node] > 1:
+                add_segment(nodes, properties, name_id)
+                nodes = [node]
+        if len(nodes) > 1:
+            add_segment(nodes, properties, name_id)
+
+    point_lat = np.array(point_lat, dtype=np.float64)
+    point_lng = np.array(point_lng, dtype=np.float64)
+    segment_offsets = np.array(segment_offsets, dtype=np.int64)
+
+    # Segment lengths: distances between consecutive points summed over each segment
+    points = np.column_stack([point_lat, point_lng])
+    cumulative = np.concatenate([[0.0], np.cumsum(geo.distances(points[:-1], points[1:]))])
+    segment_lengths = cumulative[segment_offsets[1:] - 1] - cumulative[segment_offsets[:-1]]
+
+    segments = np.array(segments, dtype=np.int32)
+    lengths = segment_lengths[np.where(segments >= 0, segments, -segments - 1)]
+    car_times = lengths / (np.array(speeds, dtype=np.float64) / 3.6)
+
+    sources = np.array(sources, dtype=np.int64)
+    order = np.argsort(sources, kind='stable')
+    vertex_coords = np.empty((len(vertices), 2), dtype=np.float64)
+    for node, index in vertices.items():
+        vertex_coords[index] = coords[node]
+
+    arrays = {'vertex_lat': vertex_coords[:, 0].copy(),
+              'vertex_lng': vertex_coords[:, 1].copy(),
+              'offsets': np.concatenate([[0], np.cumsum(np.bincount(sources, minlength=len(vertices)))]).astype(
+                  np.int64),
+              'targets': np.array(targets, dtype=np.int32)[order],
+              'lengths': lengths[order].astype(np.float32),
+              'car_times': car_times[order].astype(np.float32),
+              'access': np.array(access, dtype=np.uint8)[order],
+              'flags': np.array(flags, dtype=np.uint8)[order],
+              'names': np.array(edge_names, dtype=np.int32)[order],
+              'segments': segments[order],
+              'segment_offsets': segment_offsets,
+              'point_lat': point_lat,
+              'point_lng': point_lng}
+    return arrays, sorted(names, key=names.get)
+
+
+def save_graph(directory, arrays, names):
+    """
+    Saves graph as directory of .npy files, so it can be memory-mapped on load
+    """
+    os.makedirs(directory, exist_ok=True)
+    for name, array in arrays.items():
+        np.save(os.path.join(directory, name + '.npy'), array)
+    with open(os.path.join(directory, 'meta.json'), 'w') as file:
+        json.dump({'version': GRAPH_VERSION,
+                   'vertices': len(arrays['vertex_lat']),
+                   'edges': len(arrays['targets']),
+                   'max_car_speed': float(np.max(arrays['lengths'] / np.maximum(arrays['car_times'], 1e-6),
+                                                 initial=1.0)),
+                   'names': names}, file, ensure_ascii=False)
+
+
+def distance_text(meters, units):
+    """
+    :return: distance formatted like Google Directions does
+    """
+    if units == 'imperial':
+        feet = meters * 3.28084
+        return '{} ft'.format(int(round(feet, -1))) if feet < 1000 else '{:.1f} mi'.format(meters / 1609.344)
+    return '{} m'.format(int(round(meters))) if meters < 1000 else '{:.1f} km'.format(meters / 1000)
+
+
+def duration_text(seconds):
+    """
+    :return: duration formatted like Google Directions does
+    """
+    hours, minutes = divmod(max(1, int(round(seconds / 60))), 60)
+    parts = []
+    if hours:
+        parts.append('{} hour{}'.format(hours, 's' if hours > 1 else ''))
+    if minutes:
+        parts.append('{} min{}'.format(minutes, 's' if minutes > 1 else ''))
+    return ' '.join(parts)
+
+
+def instruction(turn, heading, name, step_flags, first):
+    """
+    :param turn: turn angle in degrees (-180..180, positive to the right)
+    :param heading: step initial bearing
+    :param name: street name
+    :param step_flags: edge flags of step
+    :param first: whether step starts the leg
+    :return: tuple (html instructions, maneuver or None)
+    """
+    street = '<b>{}</b>'.format(html.escape(name, quote=False)) if name else ''
+    if step_flags & FERRY:
+        return 'Take the ferry', 'ferry'
+    if first:
+        return 'Head <b>{}</b>{}'.format(COMPASS[int((heading + 22.5) % 360 // 45)],
+                                         ' on ' + street if street else ''), None
+    onto = ' onto ' + street if street else ''
+    if step_flags & ROUNDABOUT:
+        return 'Enter the roundabout' + onto, 'roundabout-right'
+    side = 'right' if turn > 0 else 'left'
+    angle = abs(turn)
+    if angle < 20:
+        return ('Continue onto ' + street if street else 'Continue straight'), 'straight'
+    if angle < 60:
+        return 'Slight <b>{}</b>{}'.format(side, onto), 'turn-slight-' + side
+    if angle < 120:
+        return 'Turn <b>{}</b>{}'.format(side, onto), 'turn-' + side
+    if angle < 165:
+        return 'Sharp <b>{}</b>{}'.format(side, onto), 'turn-sharp-' + side
+    return 'Make a <b>U-turn</b>' + onto, 'uturn-' + side
+
+
+def location(point):
+    return {'lat': point[0], 'lng': point[1]}
+
+
+class RoadGraph:
+    """
+    Road graph built by build_graph, memory-mapped from disk: startup does not depend on graph size
+    and worker processes share pages of the same file
+    """
+
+    def __init__(self, directory):
+        """
+        :param directory: graph directory (see save_graph)
+        """
+        with open(os.path.join(directory, 'meta.json')) as file:
+            meta = json.load(file)
+        if meta['version'] != GRAPH_VERSION:
+            raise ValueError('Graph {} has version {}, expected {}'.format(directory, meta['version'],
+                                                                           GRAPH_VERSION))
+        self.names = meta['names']
+        self.max_car_speed = meta['max_car_speed']
+        self.arrays = {name[:-4]: np.load(os.path.join(directory, name), mmap_mode='r')
+                       for name in os.listdir(directory) if name.endswith('.npy')}
+        # Search reads single elements: memoryview indexing returns Python numbers without numpy scalar overhead
+        self.views = {name: memoryview(array) for name, array in self.arrays.items()}
+        self._mode_vertices = {}
+
+    def __len__(self):
+        return len(self.arrays['vertex_lat'])
+
+    def mode_vertices(self, mode_bit):
+        """
+        :return: tuple (indices, lat, lng) of vertices having edges open to travel mode
+        """
+        if mode_bit not in self._mode_vertices:
+            offsets = self.arrays['offsets']
+            sources = np.repeat(np.arange(len(self), dtype=np.int64), np.diff(offsets))
+            indices = np.unique(sources[(self.arrays['access'] & mode_bit) != 0])
+            self._mode_vertices[mode_bit] = (indices, self.arrays['vertex_lat'][indices],
+                                             self.arrays['vertex_lng'][indices])
+        return self._mode_vertices[mode_bit]
+
+    def nearest(self, point, mode_bit, max_distance=None):
+        """
+        :param point: (lat, lng)
+        :param mode_bit: travel mode access bit
+        :param max_distance: maximum distance (meters) to vertex
+        :return: index of nearest vertex open to travel mode or None if there is none close enough
+        """
+        indices, lat, lng = self.mode_vertices(mode_bit)
+        if not len(indices):
+            return None
+        distances = geo.distances(np.broadcast_to(point, (len(indices), 2)), np.column_stack([lat, lng]))
+        nearest = int(np.argmin(distances))
+        if distances[nearest] > (max_distance or config.LOCAL_ROUTING_MAX_SNAP):
+            return None
+        return int(indices[nearest])
+
+    def search(self, source, target, mode, avoid=0):
+        """
+        A* search of fastest (driving) or shortest (walking, bicycling) path
+        :param source: start vertex
+        :param target: end vertex
+        :param mode: travel mode
+        :param avoid: flags of edges not to be used
+        :return: list of edges of path or None if target is unreachable
+        """
+        views = self.views
+        offsets, targets, access, flags = views['offsets'], views['targets'], views['access'], views['flags']
+        vertex_lat, vertex_lng = views['vertex_lat'], views['vertex_lng']
+        mode_bit = MODE_ACCESS[mode]
+        if mode == 'driving':
+            weights, scale = views['car_times'], 0.999 / self.max_car_speed
+        else:
+            weights, scale = views['lengths'], 0.999
+
+        target_lat, target_lng = math.radians(vertex_lat[target]), math.radians(vertex_lng[target])
+        target_cos = math.cos(target_lat)
+        radius = 2 * geo.EARTH_RADIUS * scale
+        sin, cos, asin, sqrt, radians = math.sin, math.cos, math.asin, math.sqrt, math.radians
+
+        def heuristic(vertex):
+            lat = radians(vertex_lat[vertex])
+            a = sin((lat - target_lat) / 2) ** 2 + cos(lat) * target_cos * sin((radians(vertex_lng[vertex]) -
+                                                                               target_lng) / 2) ** 2
+            return radius * asin(min(1.0, sqrt(a)))
+
+        costs = {source: 0.0}
+        previous = {}
+        heap = [(heuristic(source), 0.0, source)]
+        while heap:
+            _, cost, vertex = heapq.heappop(heap)
+            if vertex == target:
+                break
+            if cost > costs[vertex]:
+                continue
+            for edge in range(offsets[vertex], offsets[vertex + 1]):
+                if not access[edge] & mode_bit or flags[edge] & avoid:
+                    continue
+                neighbour = targets[edge]
+                neighbour_cost = cost + weights[edge]
+                if neighbour_cost < costs.get(neighbour, math.inf):
+                    costs[neighbour] = neighbour_cost
+                    previous[neighbour] = (vertex, edge)
+                    heapq.heappush(heap, (neighbour_cost + heuristic(neighbour), neighbour_cost, neighbour))
+        else:
+            return None
+
+        edges = []
+        vertex = target
+        while vertex != source:
+            vertex, edge = previous[vertex]
+            edges.append(edge)
+        return edges[::-1]
+
+    def edge_points(self, edge):
+        """
+        :return: list of (lat, lng) of edge geometry in travel direction
+        """
+        segment = self.views['segments'][edge]
+        index = segment if segment >= 0 else -segment - 1
+        offsets = self.views['segment_offsets']
+        start, end = offsets[index], offsets[index + 1]
+        points = list(zip(self.arrays['point_lat'][start:end].tolist(), self.arrays['point_lng'][start:end].tolist()))
+        return points if segment >= 0 else points[::-1]
+
+
+class LocalRouter:
+    """
+    Offline routing backend: answers Directions API requests from OpenStreetMap road graph.
+    Supports driving, walking and bicycling between coordinates, honours avoid tolls, highways and ferries.
+    Responses have Directions API shape, so they are rendered by the same code
+    """
+
+    def __init__(self, path=None, workers=None):
+        """
+        :param path: graph directory (config.LOCAL_ROUTING_GRAPH by default)
+        :param workers: number of threads searching routes
+        """
+        self.graph = RoadGraph(path or config.LOCAL_ROUTING_GRAPH)
+        self._executor = concurrent.futures.ThreadPoolExecutor(max_workers=workers or config.LOCAL_ROUTING_WORKERS,
+                                                               thread_name_prefix='local-routing')
+        self.counters = collections.Counter()
+
+    @staticmethod
+    def parse_location(value):
+        """
+        :param value: "lat,lng" string
+        :return: tuple (lat, lng) or None if value is not coordinates (e.g. address)
+        """
+        match = cache.COORDINATES_REGEXP.match(value or '')
+        return (float(match.group(1)), float(match.group(2))) if match else None
+
+    def _step(self, edges, mode, units, previous_points):
+        graph = self.graph
+        lengths, car_times = graph.views['lengths'], graph.views['car_times']
+        points = []
+        for edge in edges:
+            edge_points = graph.edge_points(edge)
+            points.extend(edge_points[1:] if points else edge_points)
+        length = sum(lengths[edge] for edge in edges)
+        duration = (sum(car_times[edge] for edge in edges) if mode == 'driving' else length / MODE_SPEEDS[mode])
+
+        heading = geo.bearing(points[0], points[1])
+        turn = 0.0
+        if previous_points is not None:
+            turn = (heading - geo.bearing(previous_points[-2], previous_points[-1]) + 540) % 360 - 180
+        name_id = graph.views['names'][edges[0]]
+        text, maneuver = instruction(turn, heading, graph.names[name_id] if name_id >= 0 else '',
+                                     graph.views['flags'][edges[0]], previous_points is None)
+        step = {'html_instructions': text,
+                'distance': {'text': distance_text(length, units), 'value': int(round(length))},
+                'duration': {'text': duration_text(duration), 'value': int(round(duration))},
+                'start_location': location(points[0]),
+                'end_location': location(points[-1]),
+                'polyline': {'points': geo.encode_polyline(points)},
+                'travel_mode': mode.upper()}
+        if maneuver:
+            step['maneuver'] = maneuver
+        return step, points
+
+    def _leg(self, edges, mode, units):
+        """
+        Groups path edges into steps: new step starts where street name changes or ferry starts or ends
+        """
+        names, flags = self.graph.views['names'], self.graph.views['flags']
+        groups = []
+        for edge in edges:
+            if groups and names[edge] == names[groups[-1][-1]] and \
+                    (flags[edge] & FERRY) == (flags[groups[-1][-1]] & FERRY):
+                groups[-1].append(edge)
+            else:
+                groups.append([edge])
+
+        steps = []
+        points = None
+        for group in groups:
+            step, points = self._step(group, mode, units, points)
+            steps.append(step)
+        distance = sum(step['distance']['value'] for step in steps)
+        duration = sum(step['duration']['value'] for step in steps)
+        return {'steps': steps,
+                'distance': {'text': distance_text(distance, units), 'value': distance},
+                'duration': {'text': duration_text(duration), 'value': duration},
+                'start_location': steps[0]['start_location'],
+                'end_location': steps[-1]['end_location'],
+                'start_address': '',
+                'end_address': ''}
+
+    def route(self, payload):
+        """
+        Builds route (blocking)
+        :param payload: dictionary of Directions API parameters
+        :return: dict, Directions API response
+        """
+        mode = payload.get('mode') or 'driving'
+        if mode not in MODE_ACCESS:
+            return {'status': 'ZERO_RESULTS', 'routes': []}
+
+        waypoints = [waypoint for waypoint in (payload.get('waypoints') or '').split('|')
+                     if waypoint and not waypoint.startswith('optimize:')]
+        points = [self.parse_location(value)
+                  for value in [payload.get('origin')] + [waypoint.replace('via:', '', 1) for waypoint in waypoints] +
+                  [payload.get('destination')]]
+        if None in points:
+            return {'status': 'NOT_FOUND', 'routes': []}
+        vertices = [self.graph.nearest(point, MODE_ACCESS[mode]) for point in points]
+        if None in vertices:
+            return {'status': 'NOT_FOUND', 'routes': []}
+
+        avoid = 0
+        for feature in (payload.get('avoid') or '').split('|'):
+            avoid |= AVOID_FLAGS.get(feature, 0)
+
+        legs = []
+        for source, target in zip(vertices[:-1], vertices[1:]):
+            edges = self.graph.search(source, target, mode, avoid)
+            if edges is None:
+                return {'status': 'ZERO_RESULTS', 'routes': []}
+            if edges:
+                legs.append(self._leg(edges, mode, payload.get('units')))
+        if not legs:
+            return {'status': 'ZERO_RESULTS', 'routes': []}
+
+        overview = [(step['start_location']['lat'], step['start_location']['lng'])
+                    for leg in legs for step in leg['steps']] + [(legs[-1]['end_location']['lat'],
+                                                                  legs[-1]['end_location']['lng'])]
+        return {'status': 'OK',
+                'geocoded_waypoints': [],
+                'routes': [{'legs': legs,
+                            'summary': 'offline route',
+                            'copyrights': 'Map data © OpenStreetMap contributors',
+                            'warnings': ['Offline route: traffic and transit are not considered'],
+                            'waypoint_order': list(range(len(waypoints))),
+                            'overview_polyline': {'points': geo.encode_polyline(overview)}}]}
+
+    async def directions(self, payload, chat=None):
+        """
+        Builds route in worker thread
+        :param payload: dictionary of Directions API parameters
+        :param chat: id of chat route is requested for (unused, same interface as Google Maps client)
+        :return: dict, Directions API response
+        """
+        started = time.perf_counter()
+        result = await asyncio.get_event_loop().run_in_executor(self._executor, self.route, payload)
+        self.counters[result['status']] += 1
+        logger.info('Offline route %s in %.3f s', result['status'], time.perf_counter() - started)
+        return result
+
+    @property
+    def stats(self):
+        """
+        Number of offline routes by status
+        """
+        return dict(self.counters)
+
+    def close(self):
+        self._executor.shutdown(wait=False)
+
+
+def main():
+    usage = 'Usage:\n' \
+            '    python routing.py build EXTRACT.osm[.gz|.bz2] GRAPH_DIR\n' \
+            '    python routing.py route GRAPH_DIR LAT,LNG LAT,LNG [driving|walking|bicycling]'
+    if len(sys.argv) >= 4 and sys.argv[1] == 'build':
+        started = time.perf_counter()
+        ways, coords = read_osm(sys.argv[2])
+        arrays, names = build_graph(ways, coords)
+        save_graph(sys.argv[3], arrays, names)
+        print('{} vertices, {} edges built in {:.1f} s'.format(len(arrays['vertex_lat']), len(arrays['targets']),
+                                                               time.perf_counter() - started))
+    elif len(sys.argv) >= 5 and sys.argv[1] == 'route':
+        router = LocalRouter(sys.argv[2], workers=1)
+        result = router.route({'origin': sys.argv[3], 'destination': sys.argv[4],
+                               'mode': sys.argv[5] if len(sys.argv) > 5 else 'driving'})
+        print(json.dumps(result, indent=1, ensure_ascii=False))
+    else:
+        sys.exit(usage)
+
+
+if __name__ == '__main__':
+    main()
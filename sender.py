@@ -0,0 +1,398 @@
+import asyncio
+import collections
+import itertools
+import logging
+import time
+
+from aiogram.utils.exceptions import MessageNotModified, RetryAfter
+
+import cache
+import config
+
+logger = logging.getLogger(__name__)
+
+# Message priorities: lower is sent first
+INTERACTIVE = 0  # replies to navigation
+INFORMATIONAL = 1  # help, options and other replies user is not waiting for on the way
+
+
+class TokenBucket:
+    """
+    In-process token bucket
+    """
+
+    def __init__(self, rate, capacity):
+        """
+        :param rate: tokens per second (0 - unlimited)
+        :param capacity: maximum number of tokens
+        """
+        self.rate = rate
+        self.capacity = max(1, capacity)
+        self.tokens = self.capacity
+        self.updated = time.monotonic()
+
+    def _refill(self):
+        now = time.monotonic()
+        self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+
+    def delay(self):
+        """
+        :return: float, seconds until token is available
+        """
+        if not self.rate:
+            return 0
+        self._refill()
+        return 0 if self.tokens >= 1 else (1 - self.tokens) / self.rate
+
+    def take(self):
+        if self.rate:
+            self._refill()
+            self.tokens -= 1
+
+    @property
+    def full(self):
+        if not self.rate:
+            return True
+        self._refill()
+        return self.tokens >= self.capacity
+
+
+class OutgoingMessage:
+    """
+    Queued Bot API request
+    """
+    __slots__ = ('request', 'priority', 'number', 'collapse', 'future', 'attempts', 'superseded')
+
+    def __init__(self, request, priority, number, collapse):
+        self.request = request
+        self.priority = priority
+        self.number = number
+        self.collapse = collapse
+        self.future = asyncio.get_event_loop().create_future()
+        # Failures of messages nobody waits for are only logged
+        self.future.add_done_callback(lambda future: future.cancelled() or future.exception())
+        self.attempts = 0
+        # Newer message of the same kind is queued while this one is being sent
+        self.superseded = False
+
+
+class ChatQueue:
+    """
+    Messages of single chat, sent strictly one after another
+    """
+    __slots__ = ('messages', 'bucket', 'paused_until', 'sending')
+
+    def __init__(self, bucket):
+        self.messages = collections.deque()
+        self.bucket = bucket
+        self.paused_until = 0
+        self.sending = None  # message being sent
+
+    @property
+    def busy(self):
+        return self.sending is not None
+
+    def ready_at(self, now):
+        """
+        :return: float, time (monotonic) next message may be sent at
+        """
+        return max(now + self.bucket.delay(), self.paused_until)
+
+
+class SendScheduler:
+    """
+    Central queue of outgoing messages. Keeps bot within Telegram limits with global and per-chat token buckets:
+    messages of each chat are sent in order, chats take turns by priority of their next message.
+    Flood control errors (RetryAfter) pause the chat and message is retried.
+    Queued step message is dropped when newer step message of the same chat is queued, so is step message
+    rejected by flood control
+    """
+
+    def __init__(self, rate=None, burst=None, chat_rate=None, chat_burst=None, max_retries=None):
+        """
+        :param rate: messages per second sent by this process (0 - unlimited)
+        :param burst: global bucket size
+        :param chat_rate: messages per second sent to one chat (0 - unlimited)
+        :param chat_burst: chat bucket size
+        :param max_retries: number of RetryAfter retries before message is given up
+        """
+        workers = max(1, config.SHARD_WORKERS)
+        # Telegram limit is shared by all worker processes
+        self.rate = (config.TELEGRAM_RATE / workers) if rate is None else rate
+        self.burst = max(1, int((config.TELEGRAM_BURST / workers) if burst is None else burst))
+        self.chat_rate = config.TELEGRAM_CHAT_RATE if chat_rate is None else chat_rate
+        self.chat_burst = config.TELEGRAM_CHAT_BURST if chat_burst is None else chat_burst
+        self.max_retries = config.TELEGRAM_MAX_RETRIES if max_retries is None else max_retries
+        self._bucket = TokenBucket(self.rate, self.burst)
+        self._chats = {}  # chat -> ChatQueue
+        self._numbers = itertools.count()
+        self._wakeup = None
+        self._worker = None
+        self._in_flight = set()
+        self.counters = collections.Counter(queued=0, sent=0, collapsed=0, retried=0, failed=0, max_queue=0)
+
+    def send(self, chat, request, priority=INFORMATIONAL, collapse=None):
+        """
+        Queues Bot API request
+        :param chat: chat id
+        :param request: coroutine function making request, e.g. lambda: message.answer(text)
+        :param priority: INTERACTIVE or INFORMATIONAL
+        :param collapse: kind of message superseding queued messages of the same kind in chat (e.g. 'step')
+        :return: asyncio.Future resolved with request result (None if message was superseded)
+        """
+        queue = self._chats.get(chat)
+        if queue is None:
+            queue = self._chats[chat] = ChatQueue(TokenBucket(self.chat_rate, self.chat_burst))
+        if collapse is not None:
+            for queued in [queued for queued in queue.messages if queued.collapse == collapse]:
+                queue.messages.remove(queued)
+                if not queued.future.done():
+                    queued.future.set_result(None)
+                self.counters['collapsed'] += 1
+            if queue.sending is not None and queue.sending.collapse == collapse:
+                # Not retried if flood control rejects it
+                queue.sending.superseded = True
+
+        message = OutgoingMessage(request, priority, next(self._numbers), collapse)
+        queue.messages.append(message)
+        self.counters['queued'] += 1
+        self.counters['max_queue'] = max(self.counters['max_queue'], self.queue_depth())
+
+        if self._wakeup is None:
+            self._wakeup = asyncio.Event()
+        if self._worker is None or self._worker.done():
+            self._worker = asyncio.ensure_future(self._run())
+        self._wakeup.set()
+        return message.future
+
+    def answer(self, message, text, priority=INFORMATIONAL, collapse=None, **kwargs):
+        """
+        Queues reply to message
+        :param message: incoming message
+        :param text: reply text
+        :param priority: INTERACTIVE or INFORMATIONAL
+        :param collapse: kind of message superseding queued messages of the same kind
+        :param kwargs: answer arguments
+        :return: asyncio.Future resolved with sent message
+        """
+        return self.send(message.chat.id, lambda: message.answer(text, **kwargs), priority, collapse)
+
+    def _next_chat(self):
+        """
+        :return: tuple (chat to send to or None, seconds until some chat may be sent to or None if nothing is queued)
+        """
+        now = time.monotonic()
+        best, best_key, wait = None, None, None
+        for chat, queue in list(self._chats.items()):
+            if queue.busy:
+                continue
+            if not queue.messages:
+                if queue.bucket.full and queue.paused_until <= now:
+                    # Chat has nothing to send and limit of next message is the same as for new chat
+                    del self._chats[chat]
+                continue
+            ready_at = queue.ready_at(now)
+            if ready_at > now:
+                wait = ready_at - now if wait is None else min(wait, ready_at - now)
+                continue
+            head = queue.messages[0]
+            if best_key is None or (head.priority, head.number) < best_key:
+                best, best_key = chat, (head.priority, head.number)
+        return best, (0 if best is not None else wait)
+
+    async def _run(self):
+        while True:
+            chat, wait = self._next_chat()
+            if chat is None:
+                self._wakeup.clear()
+                try:
+                    await asyncio.wait_for(self._wakeup.wait(), wait)
+                except asyncio.TimeoutError:
+                    pass
+                continue
+
+            delay = self._bucket.delay()
+            if delay > 0:
+                await asyncio.sleep(delay)
+                # Queue may have changed while waiting, e.g. message of higher priority has come
+                continue
+
+            queue = self._chats[chat]
+            message = queue.messages.popleft()
+            self._bucket.take()
+            queue.bucket.take()
+            queue.sending = message
+            task = asyncio.ensure_future(self._deliver(chat, queue, message))
+            self._in_flight.add(task)
+            task.add_done_callback(self._in_flight.discard)
+
+    async def _deliver(self, chat, queue, message):
+        try:
+            result = await message.request()
+        except RetryAfter as error:
+            message.attempts += 1
+            if message.superseded or (message.collapse is not None and
+                                      any(queued.collapse == message.collapse for queued in queue.messages)):
+                # Newer message of the same kind is sent instead
+                self.counters['collapsed'] += 1
+                if not message.future.done():
+                    message.future.set_result(None)
+            elif message.attempts > self.max_retries:
+                self.counters['failed'] += 1
+                logger.warning('Message to chat %s is given up after %s retries', chat, self.max_retries)
+                if not message.future.done():
+                    message.future.set_exception(error)
+            else:
+                # Flood control: chat waits as long as Telegram asks, longer with every retry
+                self.counters['retried'] += 1
+                queue.paused_until = time.monotonic() + error.timeout * 2 ** (message.attempts - 1)
+                queue.messages.appendleft(message)
+        except asyncio.CancelledError:
+            message.future.cancel()
+            raise
+        except Exception as error:
+            self.counters['failed'] += 1
+            logger.warning('Message to chat %s is not sent: %r', chat, error)
+            if not message.future.done():
+                message.future.set_exception(error)
+        else:
+            self.counters['sent'] += 1
+            if not message.future.done():
+                message.future.set_result(result)
+        finally:
+            queue.sending = None
+            self._wakeup.set()
+
+    def queue_depth(self):
+        """
+        :return: int, number of queued messages
+        """
+        return sum(len(queue.messages) for queue in self._chats.values())
+
+    async def drain(self, timeout=None):
+        """
+        Waits until queued messages are sent
+        :param timeout: maximum waiting time in seconds
+        """
+        deadline = time.monotonic() + (config.TELEGRAM_DRAIN_TIMEOUT if timeout is None else timeout)
+        while (self.queue_depth() or self._in_flight) and time.monotonic() < deadline:
+            await asyncio.sleep(0.05)
+
+    async def close(self):
+        """
+        Sends queued messages and stops
+        """
+        await self.drain()
+        if self._worker is not None:
+            self._worker.cancel()
+        for task in list(self._in_flight):
+            task.cancel()
+
+    @property
+    def stats(self):
+        """
+        Queued, sent, collapsed, retried and failed messages and queue depth
+        """
+        return dict(self.counters, queue_depth=self.queue_depth())
+
+
+class MessageEditor:
+    """
+    Keeps bot message up to date by editing it in place. Edits requested within delay are merged into one edit
+    with the latest content, edits that would not change the message are not sent at all
+    """
+
+    def __init__(self, scheduler, delay=None, cache_size=None):
+        """
+        :param scheduler: SendScheduler
+        :param delay: seconds edit waits for newer content before it is sent
+        :param cache_size: number of messages shown content is remembered for
+        """
+        self.scheduler = scheduler
+        self.delay = config.NAVIGATION_EDIT_DELAY if delay is None else delay
+        self._pending = {}  # (chat, message id) -> (message, text, edit arguments, priority)
+        self._timers = {}  # (chat, message id) -> timer of pending edit
+        self._shown = cache.LRUCache(cache_size or config.NAVIGATION_MESSAGES_CACHE_SIZE)
+        self.counters = collections.Counter(sent=0, requested=0, merged=0, unchanged=0, edited=0)
+
+    @staticmethod
+    def _content(text, kwargs):
+        return text, tuple(sorted(kwargs.items()))
+
+    def send(self, message, text, priority=INTERACTIVE, collapse=None, **kwargs):
+        """
+        Queues reply to message and remembers its content, so it is not edited to the same content later
+        :param message: incoming message
+        :param text: reply text
+        :param priority: INTERACTIVE or INFORMATIONAL
+        :param collapse: kind of message superseding queued messages of the same kind
+        :param kwargs: answer arguments
+        :return: asyncio.Future resolved with sent message
+        """
+        self.counters['sent'] += 1
+        content = self._content(text, kwargs)
+
+        def remember(future):
+            if not future.cancelled() and future.exception() is None and future.result() is not None:
+                sent = future.result()
+                self._shown.set((sent.chat.id, sent.message_id), content, config.ROUTE_TTL)
+
+        future = self.scheduler.answer(message, text, priority, collapse, **kwargs)
+        future.add_done_callback(remember)
+        return future
+
+    def edit(self, message, text, priority=INTERACTIVE, **kwargs):
+        """
+        Requests bot message edit
+        :param message: bot message to edit
+        :param text: new text
+        :param priority: INTERACTIVE or INFORMATIONAL
+        :param kwargs: edit_text arguments
+        """
+        self.counters['requested'] += 1
+        key = (message.chat.id, message.message_id)
+        if key in self._pending:
+            self.counters['merged'] += 1
+        else:
+            self._timers[key] = asyncio.get_event_loop().call_later(self.delay, self._flush, key)
+        self._pending[key] = (message, text, kwargs, priority)
+
+    def _flush(self, key):
+        del self._timers[key]
+        message, text, kwargs, priority = self._pending.pop(key)
+        content = self._content(text, kwargs)
+        if self._shown.get(key) == content:
+            # E.g. "previous" on the first step or "next" and "previous" pressed within delay
+            self.counters['unchanged'] += 1
+            return
+        self._shown.set(key, content, config.ROUTE_TTL)
+        self.counters['edited'] += 1
+
+        async def request():
+            try:
+                return await message.edit_text(text, **kwargs)
+            except MessageNotModified:
+                # Content shown before bot restart is not remembered
+                return None
+            except Exception:
+                self._shown.pop(key)
+                raise
+
+        # Queued edit of the same message is replaced with this one
+        self.scheduler.send(message.chat.id, request, priority, collapse=('edit', message.message_id))
+
+    def flush(self):
+        """
+        Queues pending edits right away, e.g. before scheduler is closed
+        """
+        for key, timer in list(self._timers.items()):
+            timer.cancel()
+            self._flush(key)
+
+    @property
+    def stats(self):
+        """
+        Sent messages, requested, merged, skipped unchanged and sent edits
+        """
+        return dict(self.counters, pending=len(self._pending))
@@ -0,0 +1,418 @@
+import asyncio
+import collections
+import logging
+import math
+import multiprocessing
+import signal
+import time
+import uuid
+
+from aiogram import Bot, types
+from aiogram.dispatcher import Dispatcher
+from aiogram.dispatcher.handler import CancelHandler
+from aiogram.dispatcher.middlewares import BaseMiddleware
+from aiogram.utils import json
+
+import config
+
+logger = logging.getLogger(__name__)
+
+WORKERS_KEY = 'shard:workers'
+
+# Prolongs lease only if it is still held by given worker
+RENEW_LEASE_SCRIPT = """
+if redis.call('get', KEYS[1]) == ARGV[1] then
+    return redis.call('pexpire', KEYS[1], ARGV[2])
+end
+return 0
+"""
+
+# Stores shard cursor only if lease is still held by given worker
+WRITE_CURSOR_SCRIPT = """
+if redis.call('get', KEYS[1]) == ARGV[1] then
+    redis.call('set', KEYS[2], ARGV[2])
+    return 1
+end
+return 0
+"""
+
+# Removes lease only if it is still held by given worker
+RELEASE_LEASE_SCRIPT = """
+if redis.call('get', KEYS[1]) == ARGV[1] then
+    return redis.call('del', KEYS[1])
+end
+return 0
+"""
+
+
+def shard_of(chat_id, shards=None):
+    """
+    :param chat_id: chat id
+    :param shards: number of shards
+    :return: int, shard number of chat. All updates of one chat go to the same shard
+    """
+    return int(chat_id) % (shards or config.SHARD_COUNT)
+
+
+def stream_key(shard):
+    """
+    Redis stream of shard updates
+    """
+    return 'shard:{}:updates'.format(shard)
+
+
+def cursor_key(shard):
+    """
+    Redis key of last processed update id of shard
+    """
+    return 'shard:{}:cursor'.format(shard)
+
+
+def lease_key(shard):
+    """
+    Redis key of shard lease. Shard is processed only by worker holding its lease
+    """
+    return 'shard:{}:lease'.format(shard)
+
+
+def update_chat_id(update: types.Update):
+    """
+    :param update: Telegram update
+    :return: id of chat update belongs to (0 if update has no chat)
+    """
+    for message in (update.message, update.edited_message, update.channel_post, update.edited_channel_post):
+        if message:
+            return message.chat.id
+    if update.callback_query:
+        query = update.callback_query
+        return query.message.chat.id if query.message else query.from_user.id
+    return 0
+
+
+class UpdatePublisher(BaseMiddleware):
+    """
+    Receiving side of multi-worker mode: instead of processing, each update is added to the stream of its chat shard
+    """
+
+    def __init__(self, redis, shards=None):
+        """
+        :param redis: coroutine function returning aioredis connection (e.g. RedisStorage2.redis)
+        :param shards: number of shards
+        """
+        super(UpdatePublisher, self).__init__()
+        self._redis = redis
+        self.shards = shards or config.SHARD_COUNT
+
+    async def on_pre_process_update(self, update: types.Update, data):
+        redis = await self._redis()
+        await redis.xadd(stream_key(shard_of(update_chat_id(update), self.shards)),
+                         {'update': json.dumps(update.to_python())},
+                         max_len=config.SHARD_STREAM_MAX_LEN)
+        raise CancelHandler()
+
+
+class ShardWorker:
+    """
+    Processes updates of shards it holds leases for. Updates of one chat are processed strictly in order,
+    different chats are processed concurrently: each chat has queue of its own, so slow chat holds back only itself.
+    Shard cursor is advanced past updates as soon as they and all updates before them are processed.
+    Shards are spread evenly between live workers: when worker exits (or dies and its leases expire)
+    remaining workers take its shards over
+    """
+
+    def __init__(self, dispatcher: Dispatcher, redis, shards=None, worker_id=None, max_pending=None):
+        """
+        :param dispatcher: bot dispatcher
+        :param redis: coroutine function returning aioredis connection (e.g. RedisStorage2.redis)
+        :param shards: number of shards
+        :param worker_id: unique worker name
+        :param max_pending: maximum number of read updates waiting for processing or being processed
+        """
+        self.dispatcher = dispatcher
+        self._redis = redis
+        self.shards = shards or config.SHARD_COUNT
+        self.worker_id = worker_id or uuid.uuid4().hex[:12]
+        self.lease_ttl = int(config.SHARD_LEASE_TTL * 1000)
+        self.max_pending = max_pending or config.SHARD_BATCH_SIZE
+        self.cursors = {}  # owned shard -> id of last read update
+        self._pending = {}  # owned shard -> read update ids in order -> whether update is processed
+        self._advanced = {}  # shard -> id of last update processed with all before it, not written yet
+        self._chats = {}  # chat -> deque of (shard, its pending updates, update id, update) to process in order
+        self._progress = asyncio.Event()
+        self._releasing = set()
+        self._stopping = False
+        self.counters = collections.Counter(updates=0, failed=0, dropped=0, acquired=0, released=0)
+
+    async def _heartbeat(self):
+        """
+        Registers worker as alive and returns number of live workers
+        """
+        redis = await self._redis()
+        now = time.time()
+        pipe = redis.pipeline()
+        pipe.zadd(WORKERS_KEY, now, self.worker_id)
+        pipe.zremrangebyscore(WORKERS_KEY, max=now - config.SHARD_LEASE_TTL)
+        pipe.zcard(WORKERS_KEY)
+        *_, workers = await pipe.execute()
+        return workers
+
+    def _drop(self, shard):
+        """
+        Forgets shard whose lease is lost: its queued updates are not processed, new owner reads them again
+        """
+        logger.warning('Worker %s lost shard %s', self.worker_id, shard)
+        self.cursors.pop(shard, None)
+        self._pending.pop(shard, None)
+        self._advanced.pop(shard, None)
+
+    async def rebalance(self):
+        """
+        Renews held leases, releases shards above fair share and acquires free shards below it
+        """
+        redis = await self._redis()
+        fair_share = math.ceil(self.shards / max(await self._heartbeat(), 1))
+
+        for shard in list(self.cursors):
+            renewed = await redis.eval(RENEW_LEASE_SCRIPT, keys=[lease_key(shard)],
+                                       args=[self.worker_id, self.lease_ttl])
+            if not renewed:
+                # Lease expired and may be taken by another worker already
+                self._drop(shard)
+
+        # Extra shards are released by processing loop after their read updates are processed
+        self._releasing = set(sorted(self.cursors)[fair_share:])
+
+        for shard in range(self.shards):
+            if len(self.cursors) >= fair_share:
+                break
+            if shard in self.cursors:
+                continue
+            if await redis.set(lease_key(shard), self.worker_id, pexpire=self.lease_ttl, exist=redis.SET_IF_NOT_EXIST):
+                self.cursors[shard] = await redis.get(cursor_key(shard), encoding='utf8') or '0'
+                self._pending[shard] = collections.OrderedDict()
+                self.counters['acquired'] += 1
+                logger.info('Worker %s acquired shard %s', self.worker_id, shard)
+
+    async def release(self, shards):
+        """
+        Gives shards away after their read updates are processed and cursors are written
+        :param shards: shards to give away
+        """
+        await self.drain(shards)
+        await self.write_cursors()
+        redis = await self._redis()
+        for shard in shards:
+            if self.cursors.pop(shard, None) is not None:
+                self._pending.pop(shard, None)
+                await redis.eval(RELEASE_LEASE_SCRIPT, keys=[lease_key(shard)], args=[self.worker_id])
+                self.counters['released'] += 1
+                logger.info('Worker %s released shard %s', self.worker_id, shard)
+
+    async def _rebalance_loop(self):
+        while not self._stopping:
+            try:
+                await self.rebalance()
+            except asyncio.CancelledError:
+                raise
+            except Exception:
+                logger.exception('Shards rebalance failed')
+            await asyncio.sleep(config.SHARD_LEASE_TTL / 3)
+
+    def pending_count(self, shards=None):
+        """
+        :param shards: shards to count updates of (all held shards if None)
+        :return: int, number of read updates not processed yet
+        """
+        return sum(len(self._pending.get(shard) or ()) for shard in (self.cursors if shards is None else shards))
+
+    async def drain(self, shards=None):
+        """
+        Waits until read updates of shards are processed
+        :param shards: shards to wait for (all held shards if None)
+        """
+        while self.pending_count(shards):
+            self._progress.clear()
+            await self._progress.wait()
+
+    def _done(self, shard, pending, update_id):
+        """
+        Marks update processed and advances cursor of its shard past updates processed with all before them
+        """
+        pending[update_id] = True
+        while pending and next(iter(pending.values())):
+            self._advanced[shard], _ = pending.popitem(last=False)
+        self._progress.set()
+
+    async def _process_chat(self, chat, queue):
+        """
+        Processes queued updates of single chat one by one
+        """
+        try:
+            while queue:
+                shard, pending, update_id, update = queue[0]
+                if self._pending.get(shard) is not pending:
+                    # Shard lease is lost: new owner processes update
+                    queue.popleft()
+                    self.counters['dropped'] += 1
+                    self._progress.set()
+                    continue
+                try:
+                    # Workers are separate processes without UpdatePublisher, so update middlewares are run as usual
+                    await self.dispatcher.updates_handler.notify(update)
+                    self.counters['updates'] += 1
+                except asyncio.CancelledError:
+                    raise
+                except Exception:
+                    self.counters['failed'] += 1
+                    logger.exception('Update %s processing failed', update.update_id)
+                queue.popleft()
+                self._done(shard, pending, update_id)
+        finally:
+            del self._chats[chat]
+
+    async def write_cursors(self):
+        """
+        Writes cursors advanced since last write. Cursor is written only if worker still holds shard lease,
+        otherwise shard is dropped
+        """
+        if not self._advanced:
+            return
+        advanced, self._advanced = self._advanced, {}
+        redis = await self._redis()
+        pipe = redis.pipeline()
+        for shard, update_id in advanced.items():
+            pipe.eval(WRITE_CURSOR_SCRIPT, keys=[lease_key(shard), cursor_key(shard)], args=[self.worker_id, update_id])
+        for shard, written in zip(advanced, await pipe.execute()):
+            if not written and shard in self.cursors:
+                self._drop(shard)
+
+    async def process_batch(self):
+        """
+        Reads next batch of updates from held shards and queues them to chats. Updates are processed in background:
+        reading goes on while some chats are busy, as long as fewer than max_pending updates are not processed
+        """
+        shards = list(self.cursors)
+        if not shards:
+            await asyncio.sleep(1)
+            return
+
+        room = self.max_pending - self.pending_count()
+        if room <= 0:
+            # Wait until some update is processed
+            self._progress.clear()
+            try:
+                await asyncio.wait_for(self._progress.wait(), config.SHARD_BLOCK_TIMEOUT / 1000)
+            except asyncio.TimeoutError:
+                pass
+            await self.write_cursors()
+            return
+
+        redis = await self._redis()
+        entries = await redis.xread([stream_key(shard) for shard in shards],
+                                    timeout=config.SHARD_BLOCK_TIMEOUT,
+                                    count=room,
+                                    latest_ids=[self.cursors[shard] for shard in shards])
+        for stream, entry_id, fields in entries or []:
+            shard, update_id = int(stream.split(b':')[1]), entry_id.decode()
+            pending = self._pending.get(shard)
+            if pending is None:
+                # Lease was lost while reading
+                continue
+            self.cursors[shard] = update_id
+            pending[update_id] = False
+            update = types.Update(**json.loads(fields[b'update']))
+            chat = update_chat_id(update)
+            queue = self._chats.get(chat)
+            if queue is None:
+                queue = self._chats[chat] = collections.deque()
+                asyncio.ensure_future(self._process_chat(chat, queue))
+            queue.append((shard, pending, update_id, update))
+
+        await self.write_cursors()
+
+    async def serve(self):
+        """
+        Processing loop. Returns after stop() with all held shards released
+        """
+        Bot.set_current(self.dispatcher.bot)
+        Dispatcher.set_current(self.dispatcher)
+        rebalance = asyncio.ensure_future(self._rebalance_loop())
+        try:
+            while not self._stopping:
+                await self.process_batch()
+                if self._releasing:
+                    await self.release(self._releasing)
+                    self._releasing = set()
+        finally:
+            rebalance.cancel()
+            await self.release(list(self.cursors))
+            redis = await self._redis()
+            await redis.zrem(WORKERS_KEY, self.worker_id)
+            logger.info('Worker %s stopped: %s', self.worker_id, dict(self.counters))
+
+    def stop(self):
+        """
+        Finishes processing of read updates and stops worker
+        """
+        self._stopping = True
+
+    def run(self, on_shutdown=None):
+        """
+        Runs worker in current process until SIGTERM or SIGINT (blocking)
+        :param on_shutdown: coroutine function called with dispatcher after worker is stopped
+        """
+        loop = asyncio.get_event_loop()
+        for signal_number in (signal.SIGTERM, signal.SIGINT):
+            loop.add_signal_handler(signal_number, self.stop)
+        loop.run_until_complete(self.serve())
+        if on_shutdown is not None:
+            loop.run_until_complete(on_shutdown(self.dispatcher))
+        loop.run_until_complete(self.dispatcher.bot.session.close())
+
+
+class WorkerPool:
+    """
+    Starts worker processes and restarts ones that exited unexpectedly
+    """
+
+    def __init__(self, target, workers=None):
+        """
+        :param target: function running worker, called with worker number in child process
+        :param workers: number of worker processes
+        """
+        self.target = target
+        self.workers = workers or config.SHARD_WORKERS
+        self._context = multiprocessing.get_context('spawn')
+        self._processes = {}
+        self._supervisor = None
+
+    def _start_process(self, number):
+        process = self._context.Process(target=self.target, args=(number,), name='shard-worker-{}'.format(number))
+        process.start()
+        self._processes[number] = process
+
+    async def _supervise(self):
+        while True:
+            await asyncio.sleep(1)
+            for number, process in list(self._processes.items()):
+                if not process.is_alive():
+                    logger.warning('Worker process %s exited with code %s, restarting', number, process.exitcode)
+                    self._start_process(number)
+
+    def start(self):
+        for number in range(self.workers):
+            self._start_process(number)
+        self._supervisor = asyncio.ensure_future(self._supervise())
+
+    async def stop(self):
+        """
+        Asks workers to finish current batches and waits until they exit
+        """
+        if self._supervisor is not None:
+            self._supervisor.cancel()
+        for process in self._processes.values():
+            process.terminate()
+        loop = asyncio.get_event_loop()
+        for process in self._processes.values():
+            await loop.run_in_executor(None, process.join)
+        self._processes = {}
@@ -0,0 +1,55 @@
+import asyncio
+import os
+import sys
+
+import pytest
+
+# Bot modules are top-level modules of repository root
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+
+def pytest_configure(config):
+    # Pinned aiogram and aioredis pass loop arguments deprecated by newer Python
+    for module in ('aiogram', 'aioredis'):
+        config.addinivalue_line('filterwarnings', 'ignore::DeprecationWarning:{}.*'.format(module))
+
+
+@pytest.hookimpl(tryfirst=True)
+def pytest_pyfunc_call(pyfuncitem):
+    """
+    Runs coroutine tests in event loop of their own
+    """
+    if not asyncio.iscoroutinefunction(pyfuncitem.obj):
+        return None
+    previous, loop = asyncio.get_event_loop(), asyncio.new_event_loop()
+    asyncio.set_event_loop(loop)
+    try:
+        arguments = {name: pyfuncitem.funcargs[name] for name in pyfuncitem._fixtureinfo.argnames}
+        loop.run_until_complete(pyfuncitem.obj(**arguments))
+    finally:
+        # Background tasks (e.g. Redis connection readers) are stopped before loop is closed
+        tasks = [task for task in asyncio.all_tasks(loop) if not task.done()]
+        for task in tasks:
+            task.cancel()
+        loop.run_until_complete(asyncio.gather(*tasks, return_exceptions=True))
+        loop.close()
+        asyncio.set_event_loop(previous)
+    return True
+
+
+@pytest.fixture
+def redis():
+    """
+    Coroutine function returning connection to empty in-memory Redis, as RedisStorage2.redis does
+    """
+    fakeredis = pytest.importorskip('fakeredis.aioredis')
+    connection = None
+
+    async def connect():
+        nonlocal connection
+        # Concurrent callers share one connection (each pool has in-memory database of its own)
+        if connection is None:
+            connection = asyncio.ensure_future(fakeredis.create_redis_pool())
+        return await connection
+
+    return connect
@@ -0,0 +1,148 @@
+import asyncio
+import os
+
+import cache
+
+
+def payload(**parameters):
+    return dict({'origin': '55.75,37.62', 'destination': 'Red Square', 'mode': 'walking'}, **parameters)
+
+
+def test_lru_cache_evicts_least_recently_used():
+    lru = cache.LRUCache(2)
+    lru.set('a', 1, 60)
+    lru.set('b', 2, 60)
+    assert lru.get('a') == 1
+    lru.set('c', 3, 60)
+    assert lru.get('b') is None
+    assert (lru.get('a'), lru.get('c'), len(lru)) == (1, 3, 2)
+    assert lru.pop('a') == 1
+    assert lru.pop('a') is None
+
+
+def test_lru_cache_expires_entries():
+    lru = cache.LRUCache(2)
+    lru.set('a', 1, -1)
+    assert lru.get('a') is None
+    assert len(lru) == 0
+
+
+def test_equal_routes_have_equal_keys():
+    assert cache.directions_key(payload()) == cache.directions_key(
+        {'origin': ' 55.750001 , 37.62 ', 'destination': 'red  square ', 'mode': 'WALKING', 'avoid': ''})
+    assert cache.directions_key(payload(avoid='tolls|ferries')) == cache.directions_key(payload(avoid='ferries|tolls'))
+
+
+def test_different_routes_have_different_keys():
+    assert cache.directions_key(payload()) != cache.directions_key(payload(mode='driving'))
+    assert cache.directions_key(payload(waypoints='A|B')) != cache.directions_key(payload(waypoints='B|A'))
+
+
+def test_traffic_routes_live_shorter():
+    assert cache.directions_ttl(payload(mode='driving', traffic_model='best_guess', departure_time='now')) < \
+        cache.directions_ttl(payload(mode='driving')) < cache.directions_ttl(payload())
+
+
+async def test_directions_cache_tiers(redis):
+    directions = cache.DirectionsCache(redis, max_size=10)
+    result = {'status': 'OK', 'routes': [{'legs': []}]}
+    assert await directions.get(payload()) is None
+    await directions.set(payload(), result)
+    assert await directions.get(payload()) == result
+
+    # Another worker finds response in Redis
+    other = cache.DirectionsCache(redis, max_size=10)
+    assert await other.get(payload()) == result
+    assert await other.get(payload()) == result
+    assert other.counters['redis_hits'] == other.counters['local_hits'] == 1
+    assert directions.stats['hit_ratio'] == 0.5
+
+
+async def test_failed_responses_are_not_cached(redis):
+    directions = cache.DirectionsCache(redis)
+    await directions.set(payload(), {'status': 'NOT_FOUND', 'routes': []})
+    assert await directions.get(payload()) is None
+    assert await (await redis()).dbsize() == 0
+
+
+def street_view_payload(**parameters):
+    return dict({'location': '55.75,37.62', 'heading': 90, 'size': '640x640'}, **parameters)
+
+
+def test_street_view_key_buckets_heading_and_location():
+    assert cache.street_view_key(street_view_payload()) == cache.street_view_key(
+        street_view_payload(location='55.750001,37.620001', heading=91))
+    assert cache.street_view_key(street_view_payload()) != cache.street_view_key(street_view_payload(heading=180))
+
+
+async def test_disk_cache_evicts_least_recently_used(tmp_path):
+    disk = cache.DiskCache(str(tmp_path), max_bytes=10)
+    await disk.set('a', b'aaaa')
+    await disk.set('b', b'bbbb')
+    assert await disk.get('a') == b'aaaa'
+    await disk.set('c', b'cccc')
+    assert await disk.get('b') is None
+    assert (await disk.get('a'), await disk.get('c')) == (b'aaaa', b'cccc')
+    assert len(os.listdir(str(tmp_path))) == 2
+
+
+async def test_disk_cache_reads_files_of_other_processes(tmp_path):
+    disk, other = cache.DiskCache(str(tmp_path), max_bytes=10), cache.DiskCache(str(tmp_path), max_bytes=10)
+    await other.set('a', b'aaaa')
+    assert await disk.get('a') == b'aaaa'
+    await disk.set('b', b'bbbb')
+    await disk.set('c', b'cccc')
+    # File written by the other process is indexed and evicted as any other
+    assert await disk.get('a') is None
+    assert disk._total == 8
+
+
+async def test_disk_cache_concurrent_writes(tmp_path):
+    disk = cache.DiskCache(str(tmp_path), max_bytes=1000)
+    await asyncio.gather(*[disk.set(str(number), bytes(number)) for number in range(100)])
+    assert disk._total == sum(os.path.getsize(str(path)) for path in tmp_path.iterdir()) <= 1000
+
+
+async def test_file_ids_are_shared(redis, tmp_path):
+    street_view = cache.StreetViewCache(redis, directory=str(tmp_path), max_bytes=100)
+    assert await street_view.get_file_id(street_view_payload()) is None
+    await street_view.set_file_id(street_view_payload(), 'file')
+    other = cache.StreetViewCache(redis, directory=str(tmp_path), max_bytes=100)
+    assert await other.get_file_id(street_view_payload(heading=91)) == 'file'
+    await other.delete_file_id(street_view_payload())
+    assert await street_view.get_file_id(street_view_payload()) is None
+
+
+async def test_images_are_kept_on_disk(redis, tmp_path):
+    street_view = cache.StreetViewCache(redis, directory=str(tmp_path), max_bytes=100)
+    assert await street_view.get_image(street_view_payload()) is None
+    await street_view.set_image(street_view_payload(), b'image')
+    assert await street_view.get_image(street_view_payload()) == b'image'
+    assert street_view.stats['size_bytes'] == 5
+
+
+def test_typed_places_are_normalized():
+    assert cache.normalize_address(' Red  Square ,Moscow. ') == cache.normalize_address('RED SQUARE, MOSCOW')
+    assert cache.normalize_address('Straße 1;Berlin') == 'strasse 1, berlin'
+    assert cache.geocode_key('Ｒｅｄ square') == cache.geocode_key('red square')
+    assert cache.format_location('55.123456', 37.1, precision=4) == '55.1235,37.1000'
+
+
+async def test_geocode_cache_tiers(redis):
+    geocode = cache.GeocodeCache(redis, max_size=10)
+    assert await geocode.get('Red Square') is None
+    await geocode.set('Red Square', '55.7539,37.6208')
+    assert await geocode.get('red  square') == '55.7539,37.6208'
+
+    other = cache.GeocodeCache(redis, max_size=10)
+    assert await other.get('RED SQUARE') == '55.7539,37.6208'
+    assert other.counters['redis_hits'] == 1
+    assert geocode.stats['hit_ratio'] == 0.5
+
+
+async def test_unknown_places_are_remembered_for_shorter_time(redis, monkeypatch):
+    monkeypatch.setattr(cache.config, 'GEOCODE_NEGATIVE_TTL', 60)
+    geocode = cache.GeocodeCache(redis)
+    await geocode.set('Nowhere', '')
+    assert await geocode.get('nowhere') == ''
+    assert 0 < await (await redis()).ttl(cache.geocode_key('Nowhere')) <= 60
@@ -0,0 +1,93 @@
+import copy
+import json
+
+import config
+import fsm_storage
+
+
+def user_data(**fields):
+    data = copy.deepcopy(config.DEFAULT_USER_DATA)
+    data.update(fields)
+    return data
+
+
+def test_default_data_is_binary():
+    preferences, navigation = fsm_storage.encode_data(config.DEFAULT_USER_DATA)
+    assert preferences[:1] == navigation[:1] == bytes([fsm_storage.FORMAT_VERSION])
+    assert fsm_storage.decode_data(preferences, navigation) == config.DEFAULT_USER_DATA
+
+
+def test_navigation_round_trip():
+    data = user_data(mode='transit', units='imperial', avoid={'tolls': True, 'highways': False, 'ferries': True,
+                                                              'indoor': False},
+                     origin='Красная площадь', destination='55.75,37.62', waypoints=['A', '', 'Б'],
+                     route='0123456789ab', step=42)
+    assert fsm_storage.decode_data(*fsm_storage.encode_data(data)) == data
+
+
+def test_unrepresentable_part_is_json():
+    data = user_data(mode='hovercraft', step=-1)
+    preferences, navigation = fsm_storage.encode_data(data)
+    assert preferences[:1] == navigation[:1] == b'{'
+    assert fsm_storage.decode_data(preferences, navigation) == data
+
+
+def test_expired_part_is_default():
+    preferences, navigation = fsm_storage.encode_data(user_data(mode='walking', route='abc', step=3))
+    data = fsm_storage.decode_data(None, navigation)
+    assert data['mode'] == config.DEFAULT_USER_DATA['mode']
+    assert (data['route'], data['step']) == ('abc', 3)
+    data = fsm_storage.decode_data(preferences, None)
+    assert data['mode'] == 'walking'
+    assert (data['route'], data['step']) == (None, 0)
+
+
+def test_nothing_stored():
+    assert fsm_storage.decode_data(None, None) == {}
+    assert fsm_storage.encode_data({}) == (None, None)
+
+
+async def test_storage_keeps_parts_separately(redis):
+    storage = fsm_storage.CompactRedisStorage(navigation_ttl=60, preferences_ttl=120)
+    storage._redis = await redis()
+    data = user_data(mode='walking', origin='A', route='abc')
+    await storage.set_data(chat=1, user=2, data=data)
+    assert await storage.get_data(chat=1, user=2) == data
+
+    connection = await redis()
+    assert 60 < await connection.ttl(storage.generate_key(1, 2, fsm_storage.PREFERENCES_KEY)) <= 120
+    assert 0 < await connection.ttl(storage.generate_key(1, 2, fsm_storage.STATE_DATA_KEY)) <= 60
+    await storage.set_data(chat=1, user=2, data={})
+    assert await connection.dbsize() == 0
+    assert await storage.get_data(chat=1, user=2) == {}
+
+
+async def test_json_data_is_migrated(redis):
+    connection = await redis()
+    await connection.set('fsm:1:1:data', json.dumps(user_data(origin='A', step=2)))
+    await connection.set('fsm:1:1:state', 'STATE')
+    await connection.set('fsm:2:2:data', fsm_storage.encode_data(user_data())[1])
+
+    result = await fsm_storage.migrate(connection, navigation_ttl=60, preferences_ttl=120)
+    assert (result['migrated'], result['skipped']) == (1, 1)
+    assert result['bytes_saved'] > 0
+    raw_preferences, raw_navigation = await connection.mget('fsm:1:1:preferences', 'fsm:1:1:data')
+    assert fsm_storage.decode_data(raw_preferences, raw_navigation) == user_data(origin='A', step=2)
+    assert 60 < await connection.ttl('fsm:1:1:state') <= 120
+
+
+def test_data_of_storage_before_split():
+    legacy = {'mode': 'bicycling', 'origin': 'A', 'destination': 'B', 'waypoints': [], 'step': 5,
+              'directions': {'routes': [{'legs': []}]}}
+    data = fsm_storage.decode_data(None, json.dumps(legacy).encode())
+    assert 'directions' not in data
+    assert data == user_data(mode='bicycling', origin='A', destination='B', step=5)
+
+
+async def test_data_of_storage_before_split_is_migrated(redis):
+    connection = await redis()
+    await connection.set('fsm:1:1:data', json.dumps({'mode': 'walking', 'directions': {'routes': []}}))
+    await fsm_storage.migrate(connection)
+    raw_preferences, raw_navigation = await connection.mget('fsm:1:1:preferences', 'fsm:1:1:data')
+    assert raw_preferences[:1] == raw_navigation[:1] == bytes([fsm_storage.FORMAT_VERSION])
+    assert fsm_storage.decode_data(raw_preferences, raw_navigation) == user_data(mode='walking')
@@ -0,0 +1,64 @@
+import numpy as np
+
+import geo
+import messages
+import routes
+
+# Example of Google encoded polyline algorithm documentation
+POINTS = [(38.5, -120.2), (40.7, -120.95), (43.252, -126.453)]
+ENCODED = '_p~iF~ps|U_ulLnnqC_mqNvxq`@'
+
+
+def test_bearing():
+    assert geo.bearing((0, 0), (1, 0)) == 0
+    assert round(geo.bearing((0, 0), (0, 1)), 6) == 90
+    assert round(geo.bearing((0, 0), (-1, 0)), 6) == 180
+    assert round(geo.bearing((0, 0), (0, -1)), 6) == 270
+
+
+def test_bearings_match_bearing():
+    points = np.random.RandomState(0).uniform([-80, -180], [80, 180], size=(20, 2))
+    starts, ends = points[:10], points[10:]
+    np.testing.assert_allclose(geo.bearings(starts, ends), [geo.bearing(start, end)
+                                                            for start, end in zip(starts, ends)])
+
+
+def test_headings_are_computed_when_route_is_built():
+    step = {'distance': {'text': '1 km'}, 'duration': {'text': '1 min'},
+            'start_location': {'lat': 55.75, 'lng': 37.6}, 'end_location': {'lat': 55.76, 'lng': 37.61}}
+    [record] = routes.build_route({'routes': [{'legs': [{'steps': [step]}]}]})
+    assert record['h'] == round(geo.bearing(record['s'], record['e']), 1)
+    # Step records stored before headings get the same Street View image
+    assert messages.street_view_payload(record) == messages.street_view_payload(
+        {'s': record['s'], 'e': record['e']})
+
+
+def test_distance():
+    # One degree of meridian
+    assert round(geo.distance((0, 0), (1, 0))) == 111195
+    assert geo.distance((55.75, 37.62), (55.75, 37.62)) == 0
+
+
+def test_distances_match_distance():
+    points = np.random.RandomState(0).uniform([-80, -180], [80, 180], size=(20, 2))
+    starts, ends = points[:10], points[10:]
+    np.testing.assert_allclose(geo.distances(starts, ends), [geo.distance(start, end)
+                                                             for start, end in zip(starts, ends)])
+
+
+def test_encode_polyline():
+    assert geo.encode_polyline(POINTS) == ENCODED
+
+
+def test_decode_polyline():
+    np.testing.assert_allclose(geo.decode_polyline(ENCODED), POINTS)
+
+
+def test_polyline_round_trip():
+    points = np.random.RandomState(0).uniform([-90, -180], [90, 180], size=(100, 2)).round(5)
+    np.testing.assert_allclose(geo.decode_polyline(geo.encode_polyline(points)), points, atol=1e-9)
+
+
+def test_empty_polyline():
+    assert geo.encode_polyline([]) == ''
+    assert geo.decode_polyline('').shape == (0, 2)
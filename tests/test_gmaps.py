@@ -0,0 +1,131 @@
+import aiohttp
+import pytest
+from aiohttp import web
+
+import config
+import gmaps
+
+
+async def start_server(responses):
+    """
+    Local server answering requests with given responses one by one
+    :param responses: list of (status, body[, content type]) or exceptions raised instead of answering
+    :return: tuple (server url, list of received query parameters, runner)
+    """
+    received = []
+
+    async def handle(request):
+        received.append(dict(request.query))
+        response = responses[min(len(received), len(responses)) - 1]
+        if isinstance(response, Exception):
+            raise response
+        return web.Response(status=response[0], body=response[1],
+                            content_type=response[2] if len(response) > 2 else 'application/octet-stream')
+
+    app = web.Application()
+    app.router.add_get('/api', handle)
+    runner = web.AppRunner(app)
+    await runner.setup()
+    site = web.TCPSite(runner, '127.0.0.1', 0)
+    await site.start()
+    port = site._server.sockets[0].getsockname()[1]
+    return 'http://127.0.0.1:{}/api'.format(port), received, runner
+
+
+async def request(responses, retries=2):
+    url, received, runner = await start_server(responses)
+    client = gmaps.GoogleMapsClient(key='key', retries=retries, backoff=0.001)
+    try:
+        result = await client._request(url, {'origin': 'A', 'waypoints': None})
+    finally:
+        await client.close()
+        await runner.cleanup()
+    return result, received
+
+
+async def test_request_adds_key_and_drops_empty_parameters():
+    (status, content_type, body), received = await request([(200, b'ok', 'text/plain')])
+    assert (status, content_type, body) == (200, 'text/plain', b'ok')
+    assert received == [{'origin': 'A', 'key': 'key'}]
+
+
+async def test_transient_errors_are_retried():
+    (status, _, body), received = await request([(503, b''), (429, b''), (200, b'ok')])
+    assert (status, body) == (200, b'ok')
+    assert len(received) == 3
+
+
+async def test_retries_are_bounded():
+    (status, _, _), received = await request([(500, b'')], retries=2)
+    assert status == 500
+    assert len(received) == 3
+
+
+async def test_client_errors_are_not_retried():
+    (status, _, _), received = await request([(400, b'bad'), (200, b'ok')])
+    assert status == 400
+    assert len(received) == 1
+
+
+async def test_connection_errors_are_retried_then_raised():
+    client = gmaps.GoogleMapsClient(key='key', retries=1, backoff=0.001)
+    try:
+        with pytest.raises(aiohttp.ClientError):
+            # Nothing listens on port 9 of localhost
+            await client._request('http://127.0.0.1:9/api', {})
+    finally:
+        await client.close()
+
+
+async def test_directions_failure_is_reported_as_status(monkeypatch):
+    url, received, runner = await start_server([(200, b'not json')])
+    monkeypatch.setattr(config, 'GMAPS_DIRECTIONS_URL', url)
+    client = gmaps.GoogleMapsClient(key='key', retries=0)
+    try:
+        assert (await client.directions({'origin': 'A'}))['status'] == 'UNKNOWN_ERROR'
+    finally:
+        await client.close()
+        await runner.cleanup()
+
+
+async def test_backoff_is_jittered_and_grows(monkeypatch):
+    caps = []
+    monkeypatch.setattr(gmaps.random, 'uniform', lambda low, high: caps.append(high) or 0)
+    (status, _, _), _ = await request([(503, b'')], retries=3)
+    assert status == 503
+    assert caps == [0.001, 0.002, 0.004]
+
+
+async def street_view(response, monkeypatch):
+    url, received, runner = await start_server([response])
+    monkeypatch.setattr(config, 'GMAPS_IMAGE_URL', url)
+    client = gmaps.GoogleMapsClient(key='key', retries=0)
+    try:
+        return await client.street_view({'location': '1,2'})
+    finally:
+        await client.close()
+        await runner.cleanup()
+
+
+async def test_street_view_returns_image(monkeypatch):
+    assert await street_view((200, b'jpeg', 'image/jpeg'), monkeypatch) == b'jpeg'
+
+
+async def test_street_view_error_is_not_returned_as_image(monkeypatch):
+    with pytest.raises(gmaps.ImageNotAvailable):
+        await street_view((200, b'{"error": "over quota"}', 'application/json'), monkeypatch)
+    with pytest.raises(gmaps.ImageNotAvailable):
+        await street_view((403, b'forbidden', 'image/png'), monkeypatch)
+
+
+async def test_geocode(monkeypatch):
+    url, received, runner = await start_server([(200, b'{"status": "OK", "results": []}'), (200, b'<html>')])
+    monkeypatch.setattr(config, 'GMAPS_GEOCODE_URL', url)
+    client = gmaps.GoogleMapsClient(key='key', retries=0)
+    try:
+        assert (await client.geocode('Red Square'))['status'] == 'OK'
+        assert (await client.geocode('Red Square'))['status'] == 'UNKNOWN_ERROR'
+    finally:
+        await client.close()
+        await runner.cleanup()
+    assert received[0] == {'address': 'Red Square', 'key': 'key'}
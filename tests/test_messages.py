@@ -0,0 +1,33 @@
+import pytest
+
+import messages
+
+
+@pytest.mark.parametrize('instructions, expected', [
+    ('Turn <b>left</b> onto <b>Main St</b><div style="font-size:0.9em">Destination will be on the right</div>',
+     'Turn <b>left</b> onto <b>Main St</b>. <b>Destination will be on the right</b>'),
+    ('Walk to <span class="location">Station</span>', 'Walk to <i>Station</i>'),
+    ('<DIV>Upper case</DIV>', '. <b>Upper case</b>'),
+])
+def test_tags_are_translated(instructions, expected):
+    assert messages.process_instructions(instructions) == expected
+
+
+def test_unknown_tags_are_removed():
+    assert messages.process_instructions('Take <wbr/>exit <a href="#">3</a>') == 'Take exit 3'
+
+
+def test_tag_nested_in_itself_is_skipped():
+    assert messages.process_instructions('<b>a <strong>b</strong> c</b>') == '<b>a b c</b>'
+
+
+def test_unbalanced_tags():
+    assert messages.process_instructions('Head <b>north <i>fast') == 'Head <b>north <i>fast</i></b>'
+    assert messages.process_instructions('ok</b> fine') == 'ok fine'
+
+
+def test_balanced_tags_are_replaced_from_table():
+    assert messages.tag_replacements(('div', 'span', '/span', '/div', 'wbr')) == ('. <b>', '<i>', '</i>', '</b>', '')
+    assert messages.tag_replacements(('b', 'i')) is None
+    assert messages.tag_replacements(('b', 'strong', '/strong', '/b')) is None
+    assert messages.tag_replacements(('DIV', '/DIV')) is None
@@ -0,0 +1,89 @@
+import asyncio
+import time
+
+import prometheus_client
+
+import cache
+import metrics
+import ratelimit
+
+
+def test_payload_size():
+    assert metrics.payload_size(('SET', b'key', 'value', 10, [b'ab', ('c',)])) == 14
+    assert metrics.payload_size(None) == 0
+
+
+async def test_redis_round_trips_of_update_are_counted(redis):
+    connection = metrics.instrument_redis(await redis())
+    assert metrics.instrument_redis(connection) is connection
+
+    probe = metrics.UpdateProbe()
+    token = metrics.current_update.set(probe)
+    try:
+        await connection.set('key', 'value')
+        assert await connection.get('key') == b'value'
+        pipe = connection.pipeline()
+        pipe.get('key')
+        pipe.get('other')
+        await pipe.execute()
+    finally:
+        metrics.current_update.reset(token)
+    assert probe.round_trips == 3
+    # Arguments and replies: SET key value -> OK, GET key -> value, pipeline GET key, GET other -> value, nil
+    assert probe.payload_bytes == len('keyvalueOK') + len('keyvalue') + len('keyothervalue')
+
+    # Redis use outside of update is not counted
+    await connection.get('key')
+    assert probe.round_trips == 3
+
+
+def test_navigation_sessions_expire(monkeypatch):
+    tracker = metrics.NavigationTracker(window=10)
+    tracker.touch(1, True)
+    tracker.touch(2, True)
+    tracker.touch(2, False)
+    assert tracker.count() == 1
+    now = time.monotonic()
+    monkeypatch.setattr(metrics.time, 'monotonic', lambda: now + 11)
+    assert tracker.count() == 0
+
+
+async def test_directions_cache_collector(redis):
+    directions = cache.DirectionsCache(redis, max_size=10)
+    payload = {'origin': 'A', 'destination': 'B', 'mode': 'walking'}
+    await directions.get(payload)
+    await directions.set(payload, {'status': 'OK', 'routes': []})
+    await directions.get(payload)
+
+    registry = prometheus_client.CollectorRegistry()
+    registry.register(metrics.DirectionsCacheCollector(directions))
+    assert registry.get_sample_value('directions_cache_lookups_total', {'result': 'local_hits'}) == 1
+    assert registry.get_sample_value('directions_cache_lookups_total', {'result': 'misses'}) == 1
+    assert registry.get_sample_value('directions_cache_hit_ratio') == 0.5
+    assert registry.get_sample_value('directions_cache_entries') == 1
+
+
+async def test_single_flight_collector(redis):
+    flight = cache.SingleFlight(redis, prefix='flight')
+
+    async def call():
+        return 'result'
+
+    await asyncio.gather(flight.do('key', call), flight.do('key', call))
+    registry = prometheus_client.CollectorRegistry()
+    registry.register(metrics.SingleFlightCollector({'directions': flight}))
+    assert registry.get_sample_value('single_flight_requests_total', {'flight': 'directions', 'result': 'calls'}) == 1
+    assert registry.get_sample_value('single_flight_requests_total',
+                                     {'flight': 'directions', 'result': 'local_shared'}) == 1
+
+
+async def test_rate_limiter_collector(redis):
+    limiter = ratelimit.RateLimiter(redis, rates={'directions': (10, 1)}, quotas={'directions': 0}, timeout=1)
+    await limiter.acquire('directions', chat=1)
+    registry = prometheus_client.CollectorRegistry()
+    registry.register(metrics.RateLimiterCollector(limiter))
+    labels = {'endpoint': 'directions'}
+    assert registry.get_sample_value('gmaps_ratelimit_requests_total', dict(labels, result='granted')) == 1
+    assert registry.get_sample_value('gmaps_ratelimit_requests_total', dict(labels, result='rejected')) == 0
+    assert registry.get_sample_value('gmaps_ratelimit_wait_seconds_total', labels) >= 0
+    assert registry.get_sample_value('gmaps_ratelimit_queue_depth', labels) == 0
@@ -0,0 +1,90 @@
+import itertools
+
+import numpy as np
+
+import geo
+import planner
+
+
+def path_length(matrix, path):
+    return sum(matrix[start, end] for start, end in zip(path, path[1:]))
+
+
+def line_matrix(n):
+    points = np.arange(n, dtype=float)
+    return np.abs(points[:, None] - points[None, :])
+
+
+def test_two_opt_untangles_path():
+    assert planner.two_opt(line_matrix(6), [0, 3, 1, 4, 2, 5]) == [0, 1, 2, 3, 4, 5]
+
+
+def test_two_opt_keeps_ends_and_points():
+    matrix = line_matrix(7)
+    path = planner.two_opt(matrix, [0, 6, 5, 4, 3, 2, 1])
+    assert path[0] == 0 and path[-1] == 1
+    assert sorted(path) == list(range(7))
+
+
+def test_two_opt_never_makes_path_longer():
+    random = np.random.RandomState(1)
+    for _ in range(20):
+        points = random.uniform(size=(8, 2))
+        matrix = np.linalg.norm(points[:, None] - points[None, :], axis=-1)
+        path = planner.nearest_neighbour_path(matrix)
+        improved = planner.two_opt(matrix, path)
+        best = min(path_length(matrix, (0,) + middle + (7,)) for middle in itertools.permutations(range(1, 7)))
+        assert best - 1e-9 <= path_length(matrix, improved) <= path_length(matrix, path) + 1e-9
+
+
+def test_two_opt_short_paths():
+    matrix = line_matrix(3)
+    assert planner.two_opt(matrix, [0, 2]) == [0, 2]
+    assert planner.two_opt(matrix, [0, 1, 2]) == [0, 1, 2]
+
+
+def test_distance_matrix():
+    points = [(55.75, 37.62), (59.94, 30.31), (0, 0)]
+    matrix = geo.distance_matrix(points)
+    np.testing.assert_allclose(matrix, [[geo.distance(start, end) for end in points] for start in points])
+
+
+def test_waypoints_are_ordered():
+    origin, destination = '0,0', '0,5'
+    assert planner.optimize_waypoints(origin, destination, ['0,3', '0,1', '0,4', '0,2']) == \
+        ['0,1', '0,2', '0,3', '0,4']
+    # Places typed as text are kept as typed
+    assert planner.optimize_waypoints(origin, destination, ['0,3', 'Moscow', '0,1']) == ['0,3', 'Moscow', '0,1']
+
+
+def test_stops_are_split_into_chunks():
+    stops = list(range(8))
+    assert planner.split_stops(stops, max_waypoints=2) == [[0, 1, 2, 3], [3, 4, 5, 6], [6, 7]]
+    assert planner.split_stops(stops, max_waypoints=6) == [stops]
+
+
+async def test_long_route_is_requested_in_chunks():
+    requests = []
+
+    async def directions(payload):
+        requests.append(payload)
+        legs = [{'start_address': stop} for stop in [payload['origin']] + payload['waypoints'].split('|') if stop]
+        return {'status': 'OK', 'routes': [{'legs': legs, 'warnings': ['w'], 'overview_polyline': {}}]}
+
+    payload = {'origin': 'A', 'destination': 'E', 'waypoints': 'B|C|D', 'mode': 'walking'}
+    result = await planner.chunked_directions(payload, directions, max_waypoints=1)
+    assert [(request['origin'], request['waypoints'], request['destination']) for request in requests] == \
+        [('A', 'B', 'C'), ('C', 'D', 'E')]
+    route = result['routes'][0]
+    assert [leg['start_address'] for leg in route['legs']] == ['A', 'B', 'C', 'D']
+    assert route['waypoint_order'] == [0, 1, 2]
+    assert route['warnings'] == ['w']
+    assert 'overview_polyline' not in route
+
+
+async def test_failed_chunk_fails_route():
+    async def directions(payload):
+        return {'status': 'OK' if payload['origin'] == 'A' else 'ZERO_RESULTS', 'routes': []}
+
+    payload = {'origin': 'A', 'destination': 'D', 'waypoints': 'B|C'}
+    assert (await planner.chunked_directions(payload, directions, max_waypoints=1))['status'] == 'ZERO_RESULTS'
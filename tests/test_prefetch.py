@@ -0,0 +1,77 @@
+import asyncio
+
+import cache
+import prefetch
+import routes
+
+
+class Client:
+    def __init__(self):
+        self.requests = []
+
+    async def street_view(self, payload, chat=None):
+        self.requests.append(payload)
+        return b'image'
+
+
+def directions(steps):
+    return {'routes': [{'legs': [{'steps': [{'distance': {'text': '1 km'}, 'duration': {'text': '1 min'},
+                                             'start_location': {'lat': 55.0, 'lng': 37.0 + number},
+                                             'end_location': {'lat': 55.0, 'lng': 38.0 + number}}
+                                            for number in range(steps)]}]}]}
+
+
+async def make_prefetcher(redis, tmp_path, **parameters):
+    route_storage = routes.RouteStorage(redis)
+    route_id = await route_storage.save(1, routes.build_route(directions(4)))
+    street_view_cache = cache.StreetViewCache(redis, directory=str(tmp_path))
+    prefetcher = prefetch.StreetViewPrefetcher(route_storage, street_view_cache, Client(), **parameters)
+    return prefetcher, route_id
+
+
+async def wait(prefetcher, chat):
+    await asyncio.gather(*prefetcher._tasks.get(chat, {}).values())
+
+
+async def test_upcoming_steps_are_prefetched(redis, tmp_path):
+    prefetcher, route_id = await make_prefetcher(redis, tmp_path, steps=2)
+    prefetcher.schedule(1, route_id, 0)
+    await wait(prefetcher, 1)
+    assert len(prefetcher.client.requests) == 2
+    assert all([await prefetcher.street_view_cache.has_image(payload) for payload in prefetcher.client.requests])
+
+    # Images already fetched are not requested again, steps after last one are skipped
+    prefetcher.schedule(1, route_id, 1)
+    await wait(prefetcher, 1)
+    prefetcher.schedule(1, route_id, 3)
+    await wait(prefetcher, 1)
+    assert len(prefetcher.client.requests) == 4
+    assert prefetcher.stats['cached'] == 1
+    assert prefetcher.stats['active_chats'] == 0
+
+
+async def test_budget_limits_images_of_route(redis, tmp_path):
+    prefetcher, route_id = await make_prefetcher(redis, tmp_path, steps=4, budget=3)
+    prefetcher.schedule(1, route_id, 0)
+    await wait(prefetcher, 1)
+    assert len(prefetcher.client.requests) == 3
+    assert prefetcher.stats['over_budget'] == 1
+
+
+async def test_steps_left_behind_are_cancelled(redis, tmp_path):
+    prefetcher, route_id = await make_prefetcher(redis, tmp_path, steps=2)
+    prefetcher.schedule(1, route_id, 0)
+    prefetcher.schedule(1, route_id, 2)
+    assert sorted(prefetcher._tasks[1]) == [2, 3]
+    prefetcher.cancel(1)
+    await asyncio.sleep(0)
+    assert prefetcher.stats['cancelled'] == 4
+    assert prefetcher.client.requests == []
+
+
+async def test_budgets_of_least_recent_chats_are_forgotten(redis, tmp_path):
+    prefetcher, route_id = await make_prefetcher(redis, tmp_path, budget=3, cache_size=1)
+    assert prefetcher._spend(1, route_id)
+    assert prefetcher._spend(2, route_id)
+    assert prefetcher._spent.get(1) is None
+    assert prefetcher._spent.get(2) == (route_id, 1)
@@ -0,0 +1,64 @@
+import asyncio
+import json
+import os
+
+from aiogram import types
+
+import profiler
+
+
+def test_old_profiles_are_removed(tmp_path, monkeypatch):
+    monkeypatch.setattr(profiler.time, 'strftime', lambda format: '20240101-000000')
+    for update_id in range(1, 4):
+        path = profiler.write_profile(str(tmp_path / 'profiles'), 2, {'update_id': update_id})
+    assert sorted(os.listdir(str(tmp_path / 'profiles'))) == ['20240101-000000-2.json', '20240101-000000-3.json']
+    with open(path) as file:
+        assert json.load(file) == {'update_id': 3}
+
+
+async def test_coroutine_frames():
+    async def inner():
+        await asyncio.sleep(1)
+
+    async def outer():
+        await inner()
+
+    task = asyncio.ensure_future(outer())
+    await asyncio.sleep(0)
+    assert [frame.f_code.co_name for frame in profiler.coroutine_frames(task._coro)][:2] == ['outer', 'inner']
+    task.cancel()
+
+
+async def test_profiled_chats_are_shared(redis):
+    first = profiler.ProfilerMiddleware(redis, sample_rate=0, slow_threshold=0)
+    second = profiler.ProfilerMiddleware(redis, sample_rate=0, slow_threshold=0)
+    await first.enable_chat(1, ttl=60)
+    await first.enable_chat(2, ttl=-1)
+    assert list(await second.profiled_chats()) == [1]
+    assert await second._chat_profiled(1)
+    await second.disable_chat(1)
+    assert await second.profiled_chats() == {}
+
+
+async def test_slow_update_is_profiled(redis, tmp_path):
+    middleware = profiler.ProfilerMiddleware(redis, sample_rate=0, slow_threshold=0.02, directory=str(tmp_path))
+    middleware.sampler.interval = 0.001
+    update = types.Update(update_id=7)
+
+    async def process(duration):
+        data = {}
+        await middleware.on_pre_process_update(update, data)
+        await asyncio.sleep(duration)
+        await middleware.on_post_process_update(update, [], data)
+
+    await asyncio.ensure_future(process(0))
+    assert os.listdir(str(tmp_path)) == []
+
+    await asyncio.ensure_future(process(0.05))
+    [name] = os.listdir(str(tmp_path))
+    with open(str(tmp_path / name)) as file:
+        profile = json.load(file)
+    assert (profile['update_id'], profile['reason']) == (7, 'slow')
+    assert profile['samples'] > 0
+    assert any(stack.startswith('process (test_profiler.py') for stack, _ in profile['stacks'])
+    assert middleware.stats == {'slow': 1}
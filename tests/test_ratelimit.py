@@ -0,0 +1,73 @@
+import asyncio
+import calendar
+
+import pytest
+
+import ratelimit
+
+
+async def test_token_bucket(redis):
+    limiter = ratelimit.RateLimiter(redis, rates={'directions': (1, 2)}, quotas={'directions': 0})
+    assert await limiter._take_token('directions') == 0
+    assert await limiter._take_token('directions') == 0
+    assert 0 < await limiter._take_token('directions') <= 1
+
+
+async def test_daily_quota(redis):
+    limiter = ratelimit.RateLimiter(redis, rates={'directions': (100, 100)}, quotas={'directions': 2})
+    await limiter.acquire('directions')
+    await limiter.acquire('directions')
+    with pytest.raises(ratelimit.QuotaExceeded):
+        await limiter.acquire('directions')
+    assert limiter.stats['directions']['granted'] == 2
+    assert limiter.stats['directions']['rejected'] == 1
+
+
+def test_quota_day_is_pacific_date():
+    def timestamp(*utc):
+        return calendar.timegm(utc + (0,) * (6 - len(utc)))
+
+    assert ratelimit.quota_day(timestamp(2024, 1, 1, 7, 59)) == '2023-12-31'
+    assert ratelimit.quota_day(timestamp(2024, 1, 1, 8)) == '2024-01-01'
+    assert ratelimit.quota_day(timestamp(2024, 7, 1, 6, 59)) == '2024-06-30'
+    assert ratelimit.quota_day(timestamp(2024, 7, 1, 7)) == '2024-07-01'
+    # Days of daylight saving time switches (2024-03-10 and 2024-11-03)
+    assert ratelimit.quota_day(timestamp(2024, 3, 10, 9, 59)) == '2024-03-10'
+    assert ratelimit.quota_day(timestamp(2024, 3, 11, 6, 59)) == '2024-03-10'
+    assert ratelimit.quota_day(timestamp(2024, 11, 4, 7, 59)) == '2024-11-03'
+    assert ratelimit.quota_day(timestamp(2024, 11, 4, 8)) == '2024-11-04'
+
+
+async def test_chats_are_served_round_robin(redis):
+    limiter = ratelimit.RateLimiter(redis, rates={'directions': (1000, 1)}, quotas={'directions': 0})
+    granted = []
+
+    async def request(chat, number):
+        await limiter.acquire('directions', chat=chat)
+        granted.append((chat, number))
+
+    await asyncio.gather(*[request('a', number) for number in range(3)], request('b', 0))
+    assert granted == [('a', 0), ('b', 0), ('a', 1), ('a', 2)]
+    assert limiter.queue_depth('directions') == 0
+
+
+async def test_request_waiting_too_long_is_rejected(redis):
+    limiter = ratelimit.RateLimiter(redis, rates={'directions': (0.01, 1)}, quotas={'directions': 0}, timeout=0.05)
+    await limiter.acquire('directions')
+    with pytest.raises(ratelimit.QuotaExceeded):
+        await limiter.acquire('directions')
+
+
+async def test_endpoint_without_limit_is_not_queued(redis):
+    limiter = ratelimit.RateLimiter(redis, rates={'directions': (0.01, 1)}, quotas={})
+    await asyncio.wait_for(limiter.acquire('street_view'), 0.1)
+    assert limiter.stats == {}
+
+
+async def test_chat_cooldown(redis):
+    cooldown = ratelimit.ChatCooldown(redis, 'reroute', 30)
+    assert await cooldown.take(1)
+    assert not await cooldown.take(1)
+    assert await ratelimit.ChatCooldown(redis, 'reroute', 30).take(2)
+    assert cooldown.stats == {'granted': 1, 'rejected': 1}
+    assert 0 < await (await redis()).ttl('cooldown:reroute:1') <= 30
@@ -0,0 +1,68 @@
+from aiogram import types
+from aiogram.dispatcher.filters.builtin import StateFilter
+from aiogram.dispatcher.filters.state import State, StatesGroup
+from aiogram.dispatcher.handler import current_handler
+
+import router
+
+
+class States(StatesGroup):
+    FIRST = State()
+    SECOND = State()
+
+
+async def first_handler(message, session):
+    pass
+
+
+async def second_handler(message, session):
+    pass
+
+
+def make_router():
+    button_router = router.ButtonRouter(States)
+    button_router.add(States.FIRST, ['next', 'previous'], first_handler, content='step')
+    button_router.add([States.FIRST, States.SECOND], ['next', 'back'], second_handler)
+    button_router.add('*', ['cancel'], second_handler, cancelled=True)
+    return button_router
+
+
+def test_get():
+    button_router = make_router()
+    assert button_router.get(States.FIRST.state, 'next') == router.Route(first_handler, {'content': 'step'})
+    assert button_router.get(States.SECOND.state, 'next').handler is second_handler
+    assert button_router.get(States.SECOND.state, 'previous') is None
+    assert button_router.get(States.FIRST.state, 'unknown') is None
+
+
+def test_first_route_wins():
+    assert make_router().get(States.FIRST.state, 'next').handler is first_handler
+
+
+def test_any_state():
+    button_router = make_router()
+    for state in (None, States.FIRST.state, States.SECOND.state):
+        assert button_router.get(state, 'cancel') == router.Route(second_handler, {'cancelled': True})
+    assert len(button_router) == 8
+
+
+def test_filter():
+    button_router = make_router()
+    # State filters of other tests' dispatchers read the same context variable
+    token = StateFilter.ctx_state.set(States.SECOND.state)
+    try:
+        assert button_router.filter(types.Message(text='back')) == {router.ROUTE_KEY: router.Route(second_handler, {})}
+        assert button_router.filter(types.Message(text='previous')) is False
+        assert button_router.filter(types.Message(text='free text')) is False
+        assert button_router.filter(types.Message()) is False
+    finally:
+        StateFilter.ctx_state.reset(token)
+
+
+def test_handler_name():
+    assert router.handler_name({router.ROUTE_KEY: router.Route(first_handler, {})}) == 'first_handler'
+    token = current_handler.set(second_handler)
+    try:
+        assert router.handler_name({}) == 'second_handler'
+    finally:
+        current_handler.reset(token)
@@ -0,0 +1,145 @@
+import numpy as np
+
+import geo
+import routes
+
+
+def directions_step(number):
+    return {'html_instructions': 'Step <b>{}</b>'.format(number),
+            'distance': {'text': '{} km'.format(number)},
+            'duration': {'text': '{} mins'.format(number)},
+            'start_location': {'lat': 55.0, 'lng': 37.0 + number},
+            'end_location': {'lat': 55.0, 'lng': 38.0 + number}}
+
+
+def directions(steps):
+    return {'routes': [{'legs': [{'steps': [directions_step(number) for number in range(steps)]}]}]}
+
+
+def test_compact_step():
+    message = 'Step <b>1</b>\nDistance: <b>1 km</b>\nDuration: <b>1 mins</b>'
+    assert routes.compact_step(directions_step(1)) == {'m': message, 's': [55.0, 38.0], 'e': [55.0, 39.0]}
+
+
+def test_compact_transit_step():
+    step = dict(directions_step(1),
+                steps=[directions_step(2)],
+                transit_details={'departure_stop': {'name': 'A'}, 'arrival_stop': {'name': 'B'},
+                                 'line': {'name': 'Line 1'}})
+    message = routes.compact_step(step)['m']
+    assert message.endswith('\nStep <b>2</b> (<b>2 km</b>)\nFrom: <b>A</b>\nTo: <b>B</b>\nBus: <b>Line 1</b>')
+
+
+def test_build_route_joins_legs():
+    gmaps_data = {'routes': [{'legs': [{'steps': [directions_step(0), directions_step(1)]},
+                                       {'steps': [directions_step(2)]}]}]}
+    assert [step['s'][1] for step in routes.build_route(gmaps_data)] == [37.0, 38.0, 39.0]
+
+
+async def test_steps_are_read_one_by_one(redis):
+    storage = routes.RouteStorage(redis, ttl=60)
+    route_id = await storage.save(1, routes.build_route(directions(3)))
+    assert await storage.length(1, route_id) == 3
+    assert (await storage.get_step(1, route_id, 2))['m'].startswith('Step <b>2</b>')
+    assert await storage.get_step(1, route_id, 3) is None
+    assert await storage.get_step(1, route_id, -1) is None
+    assert 0 < await (await redis()).ttl(storage.key(1, route_id)) <= 60
+
+
+async def test_new_route_replaces_previous_one(redis):
+    storage = routes.RouteStorage(redis)
+    first = await storage.save(1, routes.build_route(directions(1)))
+    second = await storage.save(1, routes.build_route(directions(1)), previous_route_id=first)
+    assert first != second
+    assert await storage.length(1, first) == 0
+    assert await storage.length(1, second) == 1
+
+
+async def test_missing_route(redis):
+    storage = routes.RouteStorage(redis)
+    route_id = await storage.save(1, routes.build_route(directions(1)))
+    # Sessions stored before route ids have no route
+    assert await storage.get_step(1, None, 0) is None
+    assert await storage.length(1, None) == 0
+    assert await storage.get_step(2, route_id, 0) is None
+    await storage.delete(1, route_id)
+    await storage.delete(1, None)
+    assert await storage.length(1, route_id) == 0
+
+
+def test_route_geometry():
+    line = [(55, 37), (55.5, 37.5), (55, 38)]
+    with_polyline = dict(directions_step(0), polyline={'points': geo.encode_polyline(line)})
+    points, offsets, legs = routes.route_geometry({'routes': [{'legs': [{'steps': [with_polyline]},
+                                                                        {'steps': [directions_step(1)]}]}]})
+    assert points.dtype == np.float32
+    assert offsets.tolist() == [0, 3, 5]
+    assert legs.tolist() == [0, 1, 2]
+    # Step without polyline is straight line
+    np.testing.assert_array_equal(points[3:], [(55, 38), (55, 39)])
+
+
+def test_pack_geometry_round_trip():
+    geometry = routes.route_geometry(directions(3))
+    for unpacked, original in zip(routes.unpack_geometry(routes.pack_geometry(*geometry)), geometry):
+        np.testing.assert_array_equal(unpacked, original)
+
+
+async def test_geometry_is_stored_with_route(redis):
+    storage = routes.RouteStorage(redis)
+    first = await storage.save(1, routes.build_route(directions(2)), geometry=routes.route_geometry(directions(2)))
+    points, offsets, legs = await storage.get_geometry(1, first)
+    assert offsets.tolist() == [0, 2, 4]
+    assert await storage.get_geometry(1, None) is None
+
+    second = await storage.save(1, routes.build_route(directions(1)), previous_route_id=first)
+    assert await storage.get_geometry(1, first) is None
+    assert await storage.get_geometry(1, second) is None
+
+
+def straight_directions(*legs):
+    """
+    Directions response of straight steps
+    :param legs: lists of step end points, each leg starts where the previous one ends
+    """
+    start, route_legs = (0.0, 0.0), []
+    for ends in legs:
+        steps = []
+        for end in ends:
+            steps.append({'start_location': {'lat': start[0], 'lng': start[1]},
+                          'end_location': {'lat': end[0], 'lng': end[1]}})
+            start = end
+        route_legs.append({'steps': steps})
+    return {'routes': [{'legs': route_legs}]}
+
+
+def test_splice_geometry():
+    geometry = routes.route_geometry(straight_directions([(0, 1), (0, 2), (0, 3)], [(1, 3), (2, 3)]))
+    # Step 1 of the first leg is replaced with a detour of three steps
+    replacement = routes.route_geometry(straight_directions([(1, 1), (1, 2), (0, 2)]))
+    points, offsets, legs = routes.splice_geometry(geometry, 1, 2, replacement)
+    assert offsets.tolist() == [0, 2, 4, 6, 8, 10, 12, 14]
+    assert legs.tolist() == [0, 5, 7]
+    np.testing.assert_array_equal(points[:2], geometry[0][:2])
+    np.testing.assert_array_equal(points[2:8], replacement[0])
+    np.testing.assert_array_equal(points[8:], geometry[0][4:])
+
+
+def test_splice_geometry_of_last_steps():
+    geometry = routes.route_geometry(straight_directions([(0, 1), (0, 2), (0, 3)]))
+    replacement = routes.route_geometry(straight_directions([(5, 5)]))
+    points, offsets, legs = routes.splice_geometry(geometry, 1, 3, replacement)
+    assert offsets.tolist() == [0, 2, 4]
+    assert legs.tolist() == [0, 2]
+    np.testing.assert_array_equal(points[2:], replacement[0])
+
+
+async def test_route_steps_are_spliced(redis):
+    storage = routes.RouteStorage(redis)
+    route_id = await storage.save(1, routes.build_route(directions(4)), geometry=routes.route_geometry(directions(4)))
+    detour = routes.build_route(directions(2))
+    geometry = routes.splice_geometry(routes.route_geometry(directions(4)), 1, 3, routes.route_geometry(directions(2)))
+    await storage.splice(1, route_id, 1, 3, detour, geometry)
+    steps = [await storage.get_step(1, route_id, index) for index in range(await storage.length(1, route_id))]
+    assert [step['s'][1] for step in steps] == [37.0, 37.0, 38.0, 40.0]
+    assert (await storage.get_geometry(1, route_id))[1].tolist() == geometry[1].tolist()
@@ -0,0 +1,99 @@
+import os
+import re
+import subprocess
+import sys
+
+import pytest
+
+import routing
+
+# Square block: North street is one-way eastwards, West street is toll road
+OSM = '''<?xml version="1.0" encoding="UTF-8"?>
+<osm version="0.6">
+ <node id="1" lat="0.0" lon="0.0"/>
+ <node id="2" lat="0.0" lon="0.01"/>
+ <node id="3" lat="0.01" lon="0.01"/>
+ <node id="4" lat="0.01" lon="0.0"/>
+ <node id="5" lat="0.5" lon="0.5"/>
+ <way id="1"><nd ref="1"/><nd ref="2"/><tag k="highway" v="residential"/><tag k="name" v="North"/>
+  <tag k="oneway" v="yes"/></way>
+ <way id="2"><nd ref="2"/><nd ref="3"/><tag k="highway" v="residential"/><tag k="name" v="East"/></way>
+ <way id="3"><nd ref="3"/><nd ref="4"/><tag k="highway" v="residential"/><tag k="name" v="South"/></way>
+ <way id="4"><nd ref="4"/><nd ref="1"/><tag k="highway" v="residential"/><tag k="name" v="West"/>
+  <tag k="toll" v="yes"/></way>
+ <way id="5"><nd ref="3"/><nd ref="5"/><tag k="building" v="yes"/></way>
+</osm>
+'''
+
+
+@pytest.fixture
+def router(tmp_path):
+    extract = tmp_path / 'extract.osm'
+    extract.write_text(OSM)
+    ways, coords = routing.read_osm(str(extract))
+    arrays, names = routing.build_graph(ways, coords)
+    routing.save_graph(str(tmp_path / 'graph'), arrays, names)
+    router = routing.LocalRouter(str(tmp_path / 'graph'), workers=1)
+    yield router
+    router.close()
+
+
+def streets(result):
+    return [re.findall(r'<b>([^<]*)</b>', step['html_instructions'])[-1]
+            for leg in result['routes'][0]['legs'] for step in leg['steps']]
+
+
+def test_way_properties():
+    forward, backward, flags, speed = routing.way_properties({'highway': 'primary', 'oneway': 'yes',
+                                                              'maxspeed': '30 mph'})
+    assert forward == routing.CAR | routing.BICYCLE | routing.FOOT
+    assert backward == routing.FOOT
+    assert round(speed) == 48
+    assert routing.way_properties({'highway': 'footway'})[0] == routing.FOOT
+    assert routing.way_properties({'highway': 'residential', 'access': 'private'}) is None
+    assert routing.way_properties({'building': 'yes'}) is None
+
+
+def test_one_way_street_is_driven_around(router):
+    result = router.route({'origin': '0,0.01', 'destination': '0,0', 'mode': 'driving'})
+    assert result['status'] == 'OK'
+    assert streets(result) == ['East', 'South', 'West']
+    assert result['routes'][0]['legs'][0]['distance']['text'] == '3.3 km'
+
+
+def test_pedestrians_walk_one_way_street_both_ways(router):
+    result = router.route({'origin': '0,0.01', 'destination': '0,0', 'mode': 'walking'})
+    assert streets(result) == ['North']
+
+
+def test_avoided_roads(router):
+    result = router.route({'origin': '0,0.01', 'destination': '0,0', 'mode': 'driving', 'avoid': 'tolls'})
+    assert result['status'] == 'ZERO_RESULTS'
+
+
+def test_addresses_are_not_resolved_offline(router):
+    assert router.route({'origin': 'Red Square', 'destination': '0,0'})['status'] == 'NOT_FOUND'
+    assert router.route({'origin': '0,0', 'destination': '0,0', 'mode': 'transit'})['status'] == 'ZERO_RESULTS'
+
+
+async def test_directions_are_built_in_thread(router):
+    result = await router.directions({'origin': '0,0', 'destination': '0.01,0.01', 'mode': 'walking'})
+    assert result['status'] == 'OK'
+    assert router.stats == {'OK': 1}
+
+
+def test_coordinates_are_parsed():
+    assert routing.LocalRouter.parse_location(' 55.75 , 37.62 ') == (55.75, 37.62)
+    assert routing.LocalRouter.parse_location('Red Square') is None
+    assert routing.LocalRouter.parse_location(None) is None
+
+
+@pytest.mark.parametrize('environment, error', [
+    ({'ROUTING_BACKEND': 'local', 'LOCAL_ROUTING_GRAPH': ''}, 'LOCAL_ROUTING_GRAPH is not set'),
+    ({'ROUTING_BACKEND': 'osm'}, 'ROUTING_BACKEND must be'),
+])
+def test_routing_configuration_is_checked(environment, error):
+    result = subprocess.run([sys.executable, '-c', 'import config'], cwd=os.path.dirname(routing.__file__),
+                            env=dict(os.environ, **environment), stderr=subprocess.PIPE, universal_newlines=True)
+    assert result.returncode != 0
+    assert error in result.stderr
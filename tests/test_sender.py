@@ -0,0 +1,190 @@
+import asyncio
+from types import SimpleNamespace
+
+import pytest
+from aiogram.utils.exceptions import MessageNotModified, RetryAfter
+
+import keyboard
+import sender
+
+
+def recorder(sent):
+    def request(text, error=None):
+        async def call():
+            sent.append(text)
+            if error is not None:
+                raise error
+            return text
+        return call
+    return request
+
+
+def make_scheduler(**kwargs):
+    return sender.SendScheduler(**dict(dict(rate=0, burst=1, chat_rate=0, chat_burst=1, max_retries=2), **kwargs))
+
+
+async def test_messages_are_sent_in_order_by_priority():
+    sent = []
+    request = recorder(sent)
+    scheduler = make_scheduler()
+    futures = [scheduler.send(1, request('help')),
+               scheduler.send(1, request('options')),
+               scheduler.send(2, request('step'), priority=sender.INTERACTIVE)]
+    assert await asyncio.gather(*futures) == ['help', 'options', 'step']
+    # Chat 2 goes first, messages of chat 1 keep their order
+    assert sent == ['step', 'help', 'options']
+    assert scheduler.stats['sent'] == 3
+    await scheduler.close()
+
+
+async def test_queued_step_message_is_superseded():
+    sent = []
+    request = recorder(sent)
+    scheduler = make_scheduler()
+    first = scheduler.send(1, request('step 1'), collapse='step')
+    help_message = scheduler.send(1, request('help'))
+    second = scheduler.send(1, request('step 2'), collapse='step')
+    assert await asyncio.gather(first, help_message, second) == [None, 'help', 'step 2']
+    assert sent == ['help', 'step 2']
+    assert scheduler.counters['collapsed'] == 1
+    await scheduler.close()
+
+
+async def test_flood_control_retries_message():
+    sent = []
+    request = recorder(sent)
+    scheduler = make_scheduler()
+    attempts = []
+
+    async def flooded():
+        attempts.append(1)
+        if len(attempts) == 1:
+            raise RetryAfter(0)
+        return 'step'
+
+    future = scheduler.send(1, flooded)
+    later = scheduler.send(1, request('help'))
+    assert await asyncio.gather(future, later) == ['step', 'help']
+    assert (len(attempts), sent, scheduler.counters['retried']) == (2, ['help'], 1)
+    await scheduler.close()
+
+
+async def test_message_is_given_up_after_retries():
+    sent = []
+    scheduler = make_scheduler(max_retries=1)
+    with pytest.raises(RetryAfter):
+        await scheduler.send(1, recorder(sent)('step', RetryAfter(0)))
+    assert len(sent) == 2
+    assert scheduler.counters['failed'] == 1
+    await scheduler.close()
+
+
+async def test_chat_rate_is_limited():
+    sent = []
+    request = recorder(sent)
+    scheduler = make_scheduler(chat_rate=20)
+    futures = [scheduler.send(1, request(number)) for number in range(3)] + [scheduler.send(2, request('other'))]
+    await asyncio.sleep(0.01)
+    # Chat bucket of one message: second message of chat 1 waits, chat 2 does not
+    assert sent == [0, 'other']
+    await asyncio.gather(*futures)
+    assert sent == [0, 'other', 1, 2]
+    await scheduler.close()
+
+
+class FakeMessage:
+    """
+    Bot message recording edits
+    """
+
+    def __init__(self, chat=1, message_id=10, error=None):
+        self.chat = SimpleNamespace(id=chat)
+        self.message_id = message_id
+        self.error = error
+        self.edits = []
+
+    async def answer(self, text, **kwargs):
+        return self
+
+    async def edit_text(self, text, **kwargs):
+        self.edits.append(text)
+        if self.error is not None:
+            raise self.error
+        return self
+
+
+def make_editor(delay=0.01):
+    return sender.MessageEditor(sender.SendScheduler(rate=0, chat_rate=0), delay=delay, cache_size=10)
+
+
+async def settle(editor):
+    await asyncio.sleep(editor.delay * 2)
+    await editor.scheduler.drain(1)
+
+
+async def test_edits_within_delay_are_merged():
+    editor, message = make_editor(), FakeMessage()
+    for step in ('step 2', 'step 3', 'step 4'):
+        editor.edit(message, step)
+    await settle(editor)
+    assert message.edits == ['step 4']
+    assert (editor.counters['merged'], editor.counters['edited']) == (2, 1)
+    await editor.scheduler.close()
+
+
+async def test_unchanged_message_is_not_edited():
+    editor, message = make_editor(), FakeMessage()
+    assert await editor.send(message, 'step 1') is message
+    editor.edit(message, 'step 1')
+    await settle(editor)
+    editor.edit(message, 'step 2')
+    await settle(editor)
+    editor.edit(message, 'step 2')
+    await settle(editor)
+    assert message.edits == ['step 2']
+    assert editor.counters['unchanged'] == 2
+    await editor.scheduler.close()
+
+
+async def test_unknown_content_is_not_an_error():
+    editor, message = make_editor(), FakeMessage(error=MessageNotModified('Message is not modified'))
+    editor.edit(message, 'step 1')
+    await settle(editor)
+    assert message.edits == ['step 1']
+    assert editor.scheduler.counters['failed'] == 0
+    await editor.scheduler.close()
+
+
+async def test_pending_edits_are_flushed():
+    editor, message = make_editor(delay=60), FakeMessage()
+    editor.edit(message, 'step 2')
+    editor.flush()
+    await editor.scheduler.drain(1)
+    assert message.edits == ['step 2']
+    assert editor.stats['pending'] == 0
+    await editor.scheduler.close()
+
+
+def test_inline_buttons_callback_data():
+    assert keyboard.CALLBACKS[keyboard.callback_data('navigation', 'next')] == ('navigation', 'next')
+    assert set(keyboard.INLINE_KEYBOARDS) == set(keyboard.INLINE_BUTTONS)
+
+
+async def test_step_message_superseded_in_flight_is_not_retried():
+    sent = []
+    scheduler = make_scheduler()
+    in_flight = asyncio.Event()
+
+    async def flooded():
+        sent.append('step 1')
+        in_flight.set()
+        await asyncio.sleep(0.01)
+        raise RetryAfter(0)
+
+    first = scheduler.send(1, flooded, collapse='step')
+    await in_flight.wait()
+    second = scheduler.send(1, recorder(sent)('step 2'), collapse='step')
+    assert await asyncio.gather(first, second) == [None, 'step 2']
+    assert sent == ['step 1', 'step 2']
+    assert (scheduler.counters['retried'], scheduler.counters['collapsed']) == (0, 1)
+    await scheduler.close()
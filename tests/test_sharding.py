@@ -0,0 +1,199 @@
+import asyncio
+
+import pytest
+from aiogram import Bot, Dispatcher, types
+from aiogram.dispatcher.handler import CancelHandler
+from aiogram.utils import json
+
+import sharding
+
+
+def message_update(update_id, chat, text):
+    return types.Update(**{'update_id': update_id,
+                           'message': {'message_id': update_id, 'date': 0, 'text': text,
+                                       'chat': {'id': chat, 'type': 'private'},
+                                       'from': {'id': chat, 'is_bot': False, 'first_name': 'User'}}})
+
+
+async def connect(redis):
+    """
+    Redis connection with minimal streams support (fakeredis has no streams)
+    """
+    connection = await redis()
+    streams = connection.test_streams = {}
+
+    async def xadd(key, fields, max_len=None):
+        entries = streams.setdefault(key, [])
+        entries.append(('{}-0'.format(len(entries) + 1),
+                        {name.encode(): value.encode() for name, value in fields.items()}))
+        return entries[-1][0]
+
+    async def xread(keys, timeout=0, count=None, latest_ids=None):
+        result = []
+        for key, latest_id in zip(keys, latest_ids):
+            result += [(key.encode(), entry_id.encode(), fields) for entry_id, fields in streams.get(key, [])
+                       if int(entry_id.split('-')[0]) > int(latest_id.split('-')[0])]
+        if not result:
+            # Blocks until timeout as Redis does (no new entries come meanwhile in tests)
+            await asyncio.sleep(timeout / 1000)
+        return result[:count]
+
+    connection.xadd, connection.xread = xadd, xread
+    return connection
+
+
+def make_worker(redis, worker_id, processed=None, handle=None):
+    dispatcher = Dispatcher(Bot('123456:token'))
+
+    async def record(message: types.Message):
+        processed.append((message.chat.id, message.text))
+
+    dispatcher.register_message_handler(handle or record)
+    return sharding.ShardWorker(dispatcher, redis, shards=4, worker_id=worker_id)
+
+
+def test_chat_updates_go_to_one_shard():
+    assert sharding.shard_of(5, 4) == sharding.shard_of(9, 4) == 1
+    assert sharding.update_chat_id(message_update(1, 7, 'a')) == 7
+    assert sharding.update_chat_id(types.Update(update_id=1)) == 0
+
+
+async def test_publisher_adds_update_to_shard_stream(redis):
+    connection = await connect(redis)
+    publisher = sharding.UpdatePublisher(redis, shards=4)
+    with pytest.raises(CancelHandler):
+        await publisher.on_pre_process_update(message_update(1, 5, 'a'), {})
+    [(_, fields)] = connection.test_streams[sharding.stream_key(1)]
+    assert json.loads(fields[b'update'])['message']['text'] == 'a'
+
+
+async def test_shards_are_shared_between_workers(redis):
+    await connect(redis)
+    first, second = make_worker(redis, 'first'), make_worker(redis, 'second')
+    await first.rebalance()
+    assert sorted(first.cursors) == [0, 1, 2, 3]
+
+    await second.rebalance()
+    assert second.cursors == {}
+    # First worker sees second one and gives extra shards away
+    await first.rebalance()
+    await first.release(first._releasing)
+    await second.rebalance()
+    assert sorted(first.cursors) == [0, 1]
+    assert sorted(second.cursors) == [2, 3]
+
+
+async def test_lost_lease_is_dropped(redis):
+    connection = await connect(redis)
+    worker = make_worker(redis, 'first')
+    await worker.rebalance()
+    await connection.set(sharding.lease_key(0), 'other')
+    await worker.rebalance()
+    assert 0 not in worker.cursors
+    assert await connection.get(sharding.lease_key(0), encoding='utf8') == 'other'
+
+
+async def test_updates_are_processed_in_order_and_cursor_is_handed_over(redis):
+    connection = await connect(redis)
+    publisher = sharding.UpdatePublisher(redis, shards=4)
+    for update_id, (chat, text) in enumerate([(1, 'a'), (5, 'b'), (1, 'c'), (2, 'd')], start=1):
+        with pytest.raises(CancelHandler):
+            await publisher.on_pre_process_update(message_update(update_id, chat, text), {})
+
+    processed = []
+    first = make_worker(redis, 'first', processed)
+    await first.rebalance()
+    await first.process_batch()
+    await first.drain()
+    await first.write_cursors()
+    assert [text for chat, text in processed if chat == 1] == ['a', 'c']
+    assert sorted(processed) == [(1, 'a'), (1, 'c'), (2, 'd'), (5, 'b')]
+    assert first.counters['updates'] == 4
+    assert await connection.get(sharding.cursor_key(1), encoding='utf8') == '3-0'
+
+    # Worker taking shard over continues after processed updates
+    await first.release([1])
+    with pytest.raises(CancelHandler):
+        await publisher.on_pre_process_update(message_update(5, 1, 'e'), {})
+    processed.clear()
+    second = make_worker(redis, 'second', processed)
+    await second.rebalance()
+    assert second.cursors[1] == '3-0'
+    await second.process_batch()
+    await second.drain()
+    assert processed == [(1, 'e')]
+
+
+async def test_slow_chat_does_not_hold_back_others(redis):
+    connection = await connect(redis)
+    publisher = sharding.UpdatePublisher(redis, shards=4)
+    # Chats 1 and 5 share shard 1
+    for update_id, (chat, text) in enumerate([(1, 'slow'), (5, 'a'), (1, 'after slow'), (5, 'b')], start=1):
+        with pytest.raises(CancelHandler):
+            await publisher.on_pre_process_update(message_update(update_id, chat, text), {})
+
+    processed, release = [], asyncio.Event()
+
+    async def handle(message: types.Message):
+        if message.text == 'slow':
+            await release.wait()
+        processed.append((message.chat.id, message.text))
+
+    worker = make_worker(redis, 'first', handle=handle)
+    await worker.rebalance()
+    await worker.process_batch()
+    for _ in range(100):
+        if len(processed) == 2:
+            break
+        await asyncio.sleep(0.01)
+    assert processed == [(5, 'a'), (5, 'b')]
+    # Cursor does not pass update still being processed
+    await worker.write_cursors()
+    assert await connection.get(sharding.cursor_key(1)) is None
+
+    release.set()
+    await worker.drain()
+    await worker.write_cursors()
+    assert processed[2:] == [(1, 'slow'), (1, 'after slow')]
+    assert await connection.get(sharding.cursor_key(1), encoding='utf8') == '4-0'
+
+
+async def test_cursor_is_not_written_without_lease(redis):
+    connection = await connect(redis)
+    publisher = sharding.UpdatePublisher(redis, shards=4)
+    with pytest.raises(CancelHandler):
+        await publisher.on_pre_process_update(message_update(1, 1, 'a'), {})
+
+    processed = []
+    worker = make_worker(redis, 'first', processed)
+    await worker.rebalance()
+    await worker.process_batch()
+    await worker.drain()
+    # Lease has expired and another worker has taken shard over meanwhile
+    await connection.set(sharding.lease_key(1), 'other')
+    await worker.write_cursors()
+    assert await connection.get(sharding.cursor_key(1)) is None
+    assert 1 not in worker.cursors
+
+
+async def test_worker_processes_updates_until_stopped(redis, monkeypatch):
+    monkeypatch.setattr(sharding.config, 'SHARD_BLOCK_TIMEOUT', 10)
+    connection = await connect(redis)
+    publisher = sharding.UpdatePublisher(redis, shards=4)
+    for update_id, chat in enumerate([1, 2, 3], start=1):
+        with pytest.raises(CancelHandler):
+            await publisher.on_pre_process_update(message_update(update_id, chat, 'a'), {})
+
+    processed = []
+    worker = make_worker(redis, 'first', processed)
+    await worker.rebalance()
+    serving = asyncio.ensure_future(worker.serve())
+    for _ in range(100):
+        if len(processed) == 3:
+            break
+        await asyncio.sleep(0.01)
+    worker.stop()
+    await serving
+    assert sorted(processed) == [(1, 'a'), (2, 'a'), (3, 'a')]
+    assert await connection.get(sharding.cursor_key(3), encoding='utf8') == '1-0'
+    assert await connection.get(sharding.lease_key(3)) is None
@@ -0,0 +1,85 @@
+import asyncio
+
+import pytest
+
+import cache
+
+
+def single_flight(redis):
+    return cache.SingleFlight(redis, 'test', lock_ttl=1, result_ttl=1, poll_interval=0.01)
+
+
+def slow_call(calls, result, delay=0.05):
+    async def call():
+        calls.append(result)
+        await asyncio.sleep(delay)
+        return result
+    return call
+
+
+async def test_identical_calls_of_process_are_coalesced(redis):
+    flight, calls = single_flight(redis), []
+    results = await asyncio.gather(*[flight.do('key', slow_call(calls, {'status': 'OK'})) for _ in range(3)])
+    assert results == [{'status': 'OK'}] * 3
+    assert len(calls) == 1
+    assert flight.stats == {'calls': 1, 'local_shared': 2, 'remote_shared': 0, 'saved': 2}
+    # Finished call is not shared anymore
+    await flight.do('key', slow_call(calls, {'status': 'OK'}, delay=0))
+    assert len(calls) == 2
+
+
+async def test_different_calls_are_not_coalesced(redis):
+    flight, calls = single_flight(redis), []
+    await asyncio.gather(flight.do('a', slow_call(calls, 'a')), flight.do('b', slow_call(calls, 'b')))
+    assert sorted(calls) == ['a', 'b']
+
+
+async def test_calls_of_processes_are_coalesced(redis):
+    leader, follower, calls = single_flight(redis), single_flight(redis), []
+    results = await asyncio.gather(leader.do('key', slow_call(calls, 'leader')),
+                                   follower.do('key', slow_call(calls, 'follower')))
+    assert results == ['leader', 'leader']
+    assert calls == ['leader']
+    assert follower.counters['remote_shared'] == 1
+
+
+async def test_follower_calls_itself_when_lock_is_released_without_result(redis):
+    leader, follower, calls = single_flight(redis), single_flight(redis), []
+
+    async def failing_call():
+        await asyncio.sleep(0.05)
+        raise RuntimeError('failed')
+
+    results = await asyncio.gather(leader.do('key', failing_call), follower.do('key', slow_call(calls, 'follower')),
+                                   return_exceptions=True)
+    assert isinstance(results[0], RuntimeError)
+    assert results[1] == 'follower'
+    assert follower.counters['calls'] == 1
+
+
+async def test_error_is_shared_with_local_callers(redis):
+    flight = single_flight(redis)
+
+    async def failing_call():
+        await asyncio.sleep(0.01)
+        raise RuntimeError('failed')
+
+    results = await asyncio.gather(flight.do('key', failing_call), flight.do('key', failing_call),
+                                   return_exceptions=True)
+    assert all(isinstance(result, RuntimeError) for result in results)
+    assert flight.counters['calls'] == 1
+    with pytest.raises(RuntimeError):
+        await flight.do('key', failing_call)
+
+
+async def test_waiting_caller_takes_over_cancelled_call(redis):
+    flight, calls = single_flight(redis), []
+    leader = asyncio.ensure_future(flight.do('key', slow_call(calls, 'leader')))
+    await asyncio.sleep(0.01)
+    followers = [asyncio.ensure_future(flight.do('key', slow_call(calls, 'follower'))) for _ in range(2)]
+    await asyncio.sleep(0.01)
+    leader.cancel()
+    assert await asyncio.gather(*followers) == ['follower', 'follower']
+    assert leader.cancelled()
+    assert calls == ['leader', 'follower']
+    assert flight.stats == {'calls': 2, 'local_shared': 1, 'remote_shared': 0, 'saved': 1}
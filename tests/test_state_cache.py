@@ -0,0 +1,137 @@
+import asyncio
+
+import fsm_storage
+import user_session
+
+
+async def make_storage(redis, **kwargs):
+    storage = fsm_storage.CompactRedisStorage(cache_size=10, **kwargs)
+    storage._redis = await redis()
+    return storage
+
+
+async def listening(cache):
+    # First lookup starts listening to invalidation channel
+    cache.get(0, 0)
+    for _ in range(100):
+        if cache._subscribed:
+            return
+        await asyncio.sleep(0.01)
+    raise AssertionError('Invalidation channel is not listened to')
+
+
+async def test_entries_are_cached_only_while_listening(redis):
+    storage = await make_storage(redis)
+    cache = storage.cache
+    cache.set(1, 2, (b'STATE', None, None))
+    assert cache.get(1, 2) is None
+
+    await listening(cache)
+    cache.set(1, 2, (b'STATE', None, None))
+    assert cache.get(1, 2) == (b'STATE', None, None)
+    assert cache.stats['entries'] == 1
+    cache.close()
+
+
+async def test_cache_is_bounded(redis):
+    storage = await make_storage(redis)
+    cache = storage.cache
+    await listening(cache)
+    for user in range(12):
+        cache.set(1, user, (b'STATE', None, None))
+    assert cache.stats['entries'] == 10
+    assert cache.counters['evictions'] == 2
+    assert cache.get(1, 0) is None
+    assert cache.get(1, 11) is not None
+
+    cache.max_bytes = cache.ENTRY_OVERHEAD + 100
+    cache.set(1, 12, (b'x' * 100, None, None))
+    assert cache.stats['entries'] == 1
+    assert cache.bytes == cache.ENTRY_OVERHEAD + 100
+    cache.close()
+
+
+async def test_session_is_served_from_cache(redis):
+    storage = await make_storage(redis)
+    await listening(storage.cache)
+
+    session = user_session.UserSession(storage, 1, 2)
+    await session.load()
+    session.set_state('STATE')
+    session.update_data(step=1)
+    await session.commit()
+
+    cached = user_session.UserSession(storage, 1, 2)
+    await cached.load()
+    assert cached.round_trips == 0
+    assert (cached.state, cached.data['step']) == ('STATE', 1)
+    storage.cache.close()
+
+
+async def test_other_worker_changes_invalidate_entries(redis):
+    storage, other = await make_storage(redis), await make_storage(redis)
+    await listening(storage.cache)
+    await listening(other.cache)
+
+    session = user_session.UserSession(storage, 1, 2)
+    await session.load()
+    assert storage.cache.get(1, 2) is not None
+
+    await other.set_state(chat=1, user=2, state='OTHER')
+    for _ in range(100):
+        if storage.cache.counters['invalidations']:
+            break
+        await asyncio.sleep(0.01)
+    session = user_session.UserSession(storage, 1, 2)
+    await session.load()
+    assert session.state == 'OTHER'
+    assert session.round_trips == 1
+    storage.cache.close()
+    other.cache.close()
+
+
+async def test_values_loaded_during_invalidation_are_not_cached(redis):
+    storage = await make_storage(redis)
+    cache = storage.cache
+    await listening(cache)
+    generation = cache.generation(1, 2)
+    cache.invalidate(1, 2)
+    cache.set(1, 2, (b'OLD', None, None), generation)
+    assert cache.get(1, 2) is None
+    assert cache.counters['stale_loads'] == 1
+
+    cache.set(1, 2, (b'NEW', None, None), cache.generation(1, 2))
+    assert cache.get(1, 2) == (b'NEW', None, None)
+    cache.close()
+
+
+async def test_session_load_racing_with_other_worker_write(redis):
+    storage, other = await make_storage(redis), await make_storage(redis)
+    await listening(storage.cache)
+    await listening(other.cache)
+    await other.set_state(chat=1, user=2, state='OLD')
+
+    connection = await redis()
+    mget = connection.mget
+
+    async def racing_mget(*keys):
+        values = await mget(*keys)
+        # Other worker writes after values are read, its invalidation comes before they are cached
+        invalidations = storage.cache.counters['invalidations']
+        await other.set_state(chat=1, user=2, state='NEW')
+        while storage.cache.counters['invalidations'] == invalidations:
+            await asyncio.sleep(0.01)
+        return values
+
+    connection.mget = racing_mget
+    session = user_session.UserSession(storage, 1, 2)
+    await session.load()
+    assert session.state == 'OLD'
+    assert storage.cache.get(1, 2) is None
+
+    connection.mget = mget
+    session = user_session.UserSession(storage, 1, 2)
+    await session.load()
+    assert session.state == 'NEW'
+    storage.cache.close()
+    other.cache.close()
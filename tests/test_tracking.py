@@ -0,0 +1,80 @@
+import pytest
+
+import routes
+import tracking
+
+# Route going east along equator for 4 km, then north for 2 km. Steps: 0 - first 2 km east, 1 - next 2 km, 2 - north.
+# First leg ends after step 1
+OFFSETS = [0, 2, 4, 6]
+LEGS = [0, 2, 3]
+STEP_POINTS = [(0, 0), (0, 0.018), (0, 0.018), (0, 0.036), (0, 0.036), (0.018, 0.036)]
+
+
+@pytest.fixture
+def index():
+    return tracking.RouteIndex(STEP_POINTS, OFFSETS, LEGS)
+
+
+def test_location_is_matched_to_step(index):
+    position = index.locate(0.0001, 0.027)
+    assert position.step == 1
+    assert 10 < position.distance < 12
+    assert 2900 < position.progress < 3100
+    assert not position.off_route and not position.arrived
+
+
+def test_off_route_and_arrival(index):
+    assert index.locate(0.01, 0.01).off_route
+    assert index.locate(0.018, 0.036).arrived
+
+
+def test_leg_end(index):
+    assert index.leg_end(0) == (2, (0, 0.036))
+    assert index.leg_end(2) == (3, (0.018, 0.036))
+
+
+def test_passed_steps_are_penalized(index):
+    # Point equally near end of step 0 and start of step 1 stays on current step
+    assert index.locate(0.0001, 0.018, step=0).step == 0
+    assert index.locate(0.0001, 0.018, step=1).step == 1
+
+
+class Storage:
+    def __init__(self):
+        self.loads = 0
+
+    async def get_geometry(self, chat, route_id):
+        self.loads += 1
+        return routes.unpack_geometry(routes.pack_geometry(STEP_POINTS, OFFSETS, LEGS)) if route_id else None
+
+
+def test_small_moves_are_debounced():
+    tracker = tracking.LiveTracker(Storage(), min_move=15)
+    assert not tracker.debounce(1, 0, 0)
+    assert tracker.debounce(1, 0, 0.0001)
+    assert not tracker.debounce(1, 0, 0.001)
+    assert not tracker.debounce(2, 0, 0)
+    assert tracker.stats['debounced'] == 1
+
+
+async def test_route_index_is_loaded_once_per_route():
+    tracker = tracking.LiveTracker(Storage())
+    assert (await tracker.locate(1, 'route', 0, 0.027, 0)).step == 1
+    assert (await tracker.locate(1, 'route', 0.009, 0.036, 1)).step == 2
+    assert tracker.route_storage.loads == 1
+    assert await tracker.locate(1, None, 0, 0, 0) is None
+    assert tracker.stats['advanced'] == 2
+
+    tracker.forget(1)
+    assert tracker.stats['routes'] == 0
+    # Navigation of chat without live location ends the same way
+    tracker.forget(2)
+    await tracker.locate(1, 'route', 0, 0.027, 0)
+    assert tracker.route_storage.loads == 3
+
+
+async def test_updated_route_is_used_without_loading():
+    tracker = tracking.LiveTracker(Storage())
+    tracker.update(1, 'route', (STEP_POINTS[:2], OFFSETS[:2], LEGS[:2]))
+    assert (await tracker.locate(1, 'route', 0, 0.027, 0)).off_route
+    assert tracker.route_storage.loads == 0
@@ -0,0 +1,93 @@
+import copy
+
+import config
+import fsm_storage
+import user_session
+
+
+async def make_storage(redis):
+    storage = fsm_storage.CompactRedisStorage(navigation_ttl=60, preferences_ttl=120)
+    storage._redis = await redis()
+    return storage
+
+
+def user_data(**fields):
+    data = copy.deepcopy(config.DEFAULT_USER_DATA)
+    data.update(fields)
+    return data
+
+
+async def test_changes_are_written_by_commit(redis):
+    storage = await make_storage(redis)
+    session = user_session.UserSession(storage, 1, 2)
+    await session.load()
+    assert (session.state, session.data) == (None, {})
+
+    session.set_state('STATE')
+    session.update_data(**user_data(origin='A', waypoints=['B']))
+    assert await storage.get_state(chat=1, user=2) is None
+    await session.commit()
+    assert session.round_trips == 2
+    assert await storage.get_state(chat=1, user=2) == 'STATE'
+    assert await storage.get_data(chat=1, user=2) == user_data(origin='A', waypoints=['B'])
+
+    # State lives as long as route options, navigation data expires sooner
+    connection = await redis()
+    assert 60 < await connection.ttl(session.key(fsm_storage.STATE_KEY)) <= 120
+    assert 60 < await connection.ttl(session.key(fsm_storage.PREFERENCES_KEY)) <= 120
+    assert 0 < await connection.ttl(session.key(fsm_storage.STATE_DATA_KEY)) <= 60
+
+
+async def test_session_reads_storage_data(redis):
+    storage = await make_storage(redis)
+    await storage.set_state(chat=1, user=2, state='STATE')
+    await storage.set_data(chat=1, user=2, data=user_data(step=3))
+    session = user_session.UserSession(storage, 1, 2)
+    await session.load()
+    assert (session.state, session.data) == ('STATE', user_data(step=3))
+    assert session.data_bytes == sum(len(raw) for raw in fsm_storage.encode_data(user_data(step=3)))
+    assert session.round_trips == 1
+
+
+async def test_unchanged_session_is_not_written(redis):
+    storage = await make_storage(redis)
+    session = user_session.UserSession(storage, 1, 2)
+    await session.load()
+    await session.commit()
+    assert session.round_trips == 1
+    assert await (await redis()).dbsize() == 0
+
+
+async def test_state_is_reset(redis):
+    storage = await make_storage(redis)
+    await storage.set_state(chat=1, user=2, state='STATE')
+    session = user_session.UserSession(storage, 1, 2)
+    await session.load()
+    session.set_state(None)
+    await session.commit()
+    assert await storage.get_state(chat=1, user=2) is None
+
+
+def test_update_data_copies_values():
+    defaults = {'waypoints': []}
+    session = user_session.UserSession(fsm_storage.CompactRedisStorage(), 1, 2)
+    session.update_data(**defaults)
+    session.data['waypoints'].append('A')
+    assert defaults == {'waypoints': []}
+
+
+async def test_only_changed_part_is_written(redis):
+    storage = await make_storage(redis)
+    await storage.set_data(chat=1, user=2, data=user_data(mode='walking'))
+    connection = await redis()
+    preferences_key = storage.generate_key(1, 2, fsm_storage.PREFERENCES_KEY)
+    raw_preferences = await connection.get(preferences_key)
+    await connection.expire(preferences_key, 10)
+
+    session = user_session.UserSession(storage, 1, 2)
+    await session.load()
+    session.update_data(step=1)
+    await session.commit()
+    assert await connection.get(preferences_key) == raw_preferences
+    assert await connection.ttl(preferences_key) > 60
+    assert await storage.get_data(chat=1, user=2) == user_data(mode='walking', step=1)
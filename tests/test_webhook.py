@@ -0,0 +1,64 @@
+import asyncio
+
+from aiohttp import web
+from aiohttp.test_utils import TestClient, TestServer
+from aiogram import Bot, Dispatcher
+
+import config
+import webhook
+
+UPDATE = {'update_id': 1, 'message': {'message_id': 1, 'date': 0, 'chat': {'id': 1, 'type': 'private'},
+                                      'from': {'id': 1, 'is_bot': False, 'first_name': 'User'}, 'text': 'hello'}}
+
+
+async def start_client(secret, received, requests):
+    bot = Bot('123456:token')
+
+    async def request(method, data=None, *args, **kwargs):
+        requests.append((method, data))
+        return True
+
+    bot.request = request
+    dispatcher = Dispatcher(bot)
+    dispatcher.register_message_handler(lambda message: received.append(message.text))
+    server = webhook.WebhookServer(dispatcher, path='/hook', secret=secret)
+    await server.set_webhook()
+    # Webhook handler without application startup and shutdown hooks
+    server._semaphore = asyncio.Semaphore(1)
+    app = web.Application()
+    app.router.add_post('/hook', server.handle)
+    client = TestClient(TestServer(app))
+    await client.start_server()
+    return server, client
+
+
+async def post(secret, headers):
+    received, requests = [], []
+    server, client = await start_client(secret, received, requests)
+    try:
+        response = await client.post('/hook', json=UPDATE, headers=headers)
+        await server.wait_closed()
+    finally:
+        await client.close()
+    return response.status, received, requests
+
+
+async def test_update_with_secret_is_processed():
+    status, received, requests = await post('secret', {webhook.SECRET_TOKEN_HEADER: 'secret'})
+    assert (status, received) == (200, ['hello'])
+    assert ('setWebhook', requests[0][1]) == requests[0]
+    assert requests[0][1]['secret_token'] == 'secret'
+
+
+async def test_update_without_secret_is_rejected():
+    for headers in ({}, {webhook.SECRET_TOKEN_HEADER: 'wrong'}):
+        status, received, _ = await post('secret', headers)
+        assert (status, received) == (403, [])
+
+
+async def test_secret_is_always_required(monkeypatch):
+    monkeypatch.setattr(config, 'WEBHOOK_SECRET', '')
+    status, received, requests = await post(None, {})
+    assert (status, received) == (403, [])
+    assert len(requests[0][1]['secret_token']) >= 32
+    assert webhook.WebhookServer(None).secret != webhook.WebhookServer(None).secret
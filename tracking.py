@@ -0,0 +1,197 @@
+import collections
+import math
+
+import numpy as np
+from aiogram.dispatcher.handler import CancelHandler
+from aiogram.dispatcher.middlewares import BaseMiddleware
+
+import cache
+import config
+import geo
+
+# Place of live location on route: step index, distance to route and meters along route passed and left
+Position = collections.namedtuple('Position', ['step', 'distance', 'progress', 'remaining', 'off_route', 'arrived'])
+
+
+class RouteIndex:
+    """
+    Route polyline prepared for nearest segment lookups: segments are projected once to plane in meters,
+    so location is matched against all of them with few vectorized operations
+    """
+
+    def __init__(self, points, offsets, legs):
+        """
+        :param points: array of shape (n, 2), (lat, lng) of route points
+        :param offsets: array of step offsets in points (see routes.route_geometry)
+        :param legs: array of leg offsets in steps
+        """
+        self.geometry = (points, offsets, legs)
+        points = np.asarray(points, dtype=float).reshape(-1, 2)
+        if len(points) == 1:
+            points = np.repeat(points, 2, axis=0)
+        self.cos_lat = math.cos(math.radians(float(points[:, 0].mean())))
+        xy = self.project(points)
+        self.starts = xy[:-1]
+        self.vectors = np.diff(xy, axis=0)
+        self.squares = (self.vectors ** 2).sum(axis=1)
+        lengths = np.sqrt(self.squares)
+        self.cumulative = np.concatenate(([0], np.cumsum(lengths)[:-1]))
+        self.length = float(lengths.sum())
+        # Segment k joins points k and k + 1 and belongs to step of point k
+        self.steps = np.searchsorted(np.asarray(offsets), np.arange(len(self.starts)), side='right') - 1
+        self.last_step = len(offsets) - 2
+
+    def leg_end(self, step):
+        """
+        :param step: step index
+        :return: tuple (index of step following the last step of leg, (lat, lng) of leg end)
+        """
+        points, offsets, legs = self.geometry
+        end = int(legs[np.searchsorted(legs, step, side='right')])
+        lat, lng = points[offsets[end] - 1]
+        return end, (float(lat), float(lng))
+
+    def project(self, points):
+        """
+        Equirectangular projection, precise enough within one route
+        :param points: array of shape (n, 2), (lat, lng) in degrees
+        :return: array of shape (n, 2), (x, y) in meters
+        """
+        radians = np.radians(np.asarray(points, dtype=float).reshape(-1, 2))
+        return np.column_stack((radians[:, 1] * self.cos_lat, radians[:, 0])) * geo.EARTH_RADIUS
+
+    def locate(self, lat, lng, step=0):
+        """
+        Finds route segment nearest to location
+        :param lat: location latitude
+        :param lng: location longitude
+        :param step: index of current step. Steps already passed are penalized,
+        so location noise where route crosses itself does not move navigation back
+        :return: Position
+        """
+        relative = self.project((lat, lng))[0] - self.starts
+        fractions = np.clip((relative * self.vectors).sum(axis=1) / np.maximum(self.squares, 1e-9), 0, 1)
+        distances = np.hypot(*(relative - fractions[:, None] * self.vectors).T)
+        nearest = int(np.argmin(distances + np.where(self.steps < step, config.LIVE_BACKTRACK_PENALTY, 0)))
+        progress = float(self.cumulative[nearest] + fractions[nearest] * math.sqrt(self.squares[nearest]))
+        distance, remaining = float(distances[nearest]), self.length - progress
+        return Position(int(self.steps[nearest]), distance, progress, remaining,
+                        off_route=distance > config.LIVE_OFF_ROUTE_DISTANCE,
+                        arrived=remaining <= config.LIVE_ARRIVAL_DISTANCE)
+
+
+class LiveTracker:
+    """
+    Follows live locations of navigating chats. Locations closer than min_move to the last processed one
+    are dropped before user state is read, route geometry is loaded once per route and kept in memory
+    """
+
+    def __init__(self, route_storage, min_move=None, cache_size=None):
+        """
+        :param route_storage: routes.RouteStorage
+        :param min_move: meters user moves before location update is processed
+        :param cache_size: number of chats route geometry and last location are kept for
+        """
+        self.route_storage = route_storage
+        self.min_move = config.LIVE_MIN_MOVE if min_move is None else min_move
+        cache_size = cache_size or config.LIVE_CACHE_SIZE
+        self._indexes = cache.LRUCache(cache_size)  # chat -> (route id, RouteIndex)
+        self._positions = cache.LRUCache(cache_size)  # chat -> last processed (lat, lng)
+        self.counters = collections.Counter(updates=0, debounced=0, located=0, advanced=0, off_route=0,
+                                            index_loads=0)
+
+    def debounce(self, chat, lat, lng):
+        """
+        Remembers location unless user has not moved far enough since the last processed one
+        :param chat: chat id
+        :param lat: location latitude
+        :param lng: location longitude
+        :return: bool, True if location update should be dropped
+        """
+        self.counters['updates'] += 1
+        previous = self._positions.get(chat)
+        if previous is not None and geo.distance(previous, (lat, lng)) < self.min_move:
+            self.counters['debounced'] += 1
+            return True
+        self._positions.set(chat, (lat, lng), config.LIVE_POSITION_TTL)
+        return False
+
+    async def index(self, chat, route_id):
+        """
+        :param chat: chat id
+        :param route_id: route id
+        :return: RouteIndex of chat route or None if route geometry is not stored
+        """
+        entry = self._indexes.get(chat)
+        if entry is not None and entry[0] == route_id:
+            return entry[1]
+        geometry = await self.route_storage.get_geometry(chat, route_id)
+        if geometry is None:
+            return None
+        self.counters['index_loads'] += 1
+        return self.update(chat, route_id, geometry)
+
+    def update(self, chat, route_id, geometry):
+        """
+        Replaces chat route geometry kept in memory, e.g. after route is partially rebuilt
+        :param chat: chat id
+        :param route_id: route id
+        :param geometry: tuple (points, offsets, legs)
+        :return: RouteIndex
+        """
+        index = RouteIndex(*geometry)
+        self._indexes.set(chat, (route_id, index), config.ROUTE_TTL)
+        return index
+
+    async def locate(self, chat, route_id, lat, lng, step):
+        """
+        :param chat: chat id
+        :param route_id: route id
+        :param lat: location latitude
+        :param lng: location longitude
+        :param step: index of current step
+        :return: Position or None if route is not stored
+        """
+        index = await self.index(chat, route_id)
+        if index is None:
+            return None
+        position = index.locate(lat, lng, step)
+        if position.off_route:
+            self.counters['off_route'] += 1
+        else:
+            self.counters['located'] += 1
+            self.counters['advanced'] += position.step != step
+        return position
+
+    def forget(self, chat):
+        """
+        Drops chat route geometry and last location
+        """
+        self._indexes.pop(chat)
+        self._positions.pop(chat)
+
+    @property
+    def stats(self):
+        """
+        Live location counters and number of chats with route geometry in memory
+        """
+        return dict(self.counters, routes=len(self._indexes))
+
+
+class LiveLocationMiddleware(BaseMiddleware):
+    """
+    Drops live location updates of users who have not moved far enough before user session is loaded,
+    so location stream of standing or slow user costs no Redis requests
+    """
+
+    def __init__(self, tracker: LiveTracker):
+        """
+        :param tracker: LiveTracker
+        """
+        super(LiveLocationMiddleware, self).__init__()
+        self.tracker = tracker
+
+    async def on_pre_process_edited_message(self, message, data):
+        location = message.location
+        if location is not None and self.tracker.debounce(message.chat.id, location.latitude, location.longitude):
+            raise CancelHandler()
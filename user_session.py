@@ -0,0 +1,169 @@
+import copy
+import logging
+
+from aiogram.dispatcher.filters.builtin import StateFilter
+from aiogram.dispatcher.filters.state import State
+from aiogram.dispatcher.middlewares import BaseMiddleware
+
+import fsm_storage
+
+logger = logging.getLogger(__name__)
+
+
+class UserSession:
+    """
+    In-memory view of user state and data during processing of single update.
+    All changes are written to Redis at once by commit()
+    """
+
+    def __init__(self, storage, chat, user):
+        """
+        :param storage: fsm_storage.CompactRedisStorage instance
+        :param chat: chat id
+        :param user: user id
+        """
+        self.storage = storage
+        self.chat, self.user = storage.check_address(chat=chat, user=user)
+        self.state = None
+        self.data = {}
+        self.round_trips = 0
+        self.data_bytes = 0  # size of data as stored in Redis
+        self._state_changed = False
+        self._changed_parts = set()  # storage keys of changed data parts
+        self._raw = [None, None, None]  # stored state, preferences and data
+
+    def key(self, part):
+        """
+        Redis key of user state or data
+        """
+        return self.storage.generate_key(self.chat, self.user, part)
+
+    async def load(self):
+        """
+        Loads user state and data in single round trip
+        """
+        cache = self.storage.cache
+        values = cache.get(self.chat, self.user) if cache is not None else None
+        if values is None:
+            # Invalidation coming while values are read means they may be stale already
+            generation = cache.generation(self.chat, self.user) if cache is not None else None
+            redis = await self.storage.redis()
+            values = await redis.mget(self.key(fsm_storage.STATE_KEY), self.key(fsm_storage.PREFERENCES_KEY),
+                                      self.key(fsm_storage.STATE_DATA_KEY))
+            self.round_trips += 1
+            if cache is not None:
+                cache.set(self.chat, self.user, tuple(values), generation)
+        raw_state, raw_preferences, raw_data = values
+        self._raw = list(values)
+
+        self.state = raw_state.decode('utf8') if raw_state else None
+        self.data = fsm_storage.decode_data(raw_preferences, raw_data)
+        self.data_bytes = len(raw_preferences or b'') + len(raw_data or b'')
+
+    def update_data(self, **kwargs):
+        """
+        Changes user data fields
+        """
+        # Copy values, so shared defaults (e.g. config.DEFAULT_USER_DATA) are never changed in place
+        self.data.update(copy.deepcopy(kwargs))
+        for name in kwargs:
+            self._changed_parts.add(fsm_storage.PREFERENCES_KEY if name in fsm_storage.PREFERENCE_FIELDS
+                                    else fsm_storage.STATE_DATA_KEY)
+
+    def set_state(self, state):
+        """
+        :param state: new user state (State, state name or None)
+        """
+        self.state = state.state if isinstance(state, State) else state
+        self._state_changed = True
+
+    async def commit(self):
+        """
+        Writes changed state and data in single pipelined transaction. Only changed data parts are written:
+        each of them is a single binary value, so changed part is rewritten as a whole
+        """
+        if not (self._state_changed or self._changed_parts):
+            return
+
+        redis = await self.storage.redis()
+        transaction = redis.multi_exec()
+        if self._changed_parts:
+            parts = self._changed_parts
+            if (self._raw[2] or b'')[:1] == b'{':
+                # JSON data may hold route options of storage before split, they are moved to their own key
+                parts = None
+            written = self.storage.write_data(transaction, self.chat, self.user, self.data, parts)
+            for index, part, raw in zip((1, 2), (fsm_storage.PREFERENCES_KEY, fsm_storage.STATE_DATA_KEY), written):
+                if parts is None or part in parts:
+                    self._raw[index] = raw
+            self.data_bytes = sum(len(raw) for raw in self._raw[1:] if raw)
+        if self._state_changed:
+            if self.state is None:
+                transaction.delete(self.key(fsm_storage.STATE_KEY))
+            else:
+                transaction.set(self.key(fsm_storage.STATE_KEY), self.state, expire=self.storage._state_ttl)
+            self._raw[0] = self.state.encode('utf8') if self.state is not None else None
+
+        # Write-through: other workers drop their copies, this one keeps written values
+        cache = self.storage.cache
+        if cache is not None:
+            cache.pop(self.chat, self.user)
+            cache.publish(transaction, self.chat, self.user)
+        await transaction.execute()
+        self.round_trips += 1
+        if cache is not None:
+            cache.set(self.chat, self.user, tuple(self._raw))
+
+        self._state_changed = False
+        self._changed_parts = set()
+
+
+class SessionMiddleware(BaseMiddleware):
+    """
+    Unit of work for user state: loads state and data once per update, passes them to handlers
+    as "session" argument and flushes all changes after handler is finished
+    """
+
+    def __init__(self):
+        super(SessionMiddleware, self).__init__()
+        self.updates = 0
+        self.round_trips = 0
+
+    async def on_pre_process_message(self, message, data):
+        await self._open(message.chat.id, message.from_user.id, data)
+
+    async def on_pre_process_callback_query(self, query, data):
+        if query.message is not None:
+            await self._open(query.message.chat.id, query.from_user.id, data)
+
+    async def _open(self, chat, user, data):
+        session = UserSession(self.manager.dispatcher.storage, chat, user)
+        await session.load()
+
+        # State filters take preloaded state instead of requesting storage again
+        StateFilter.ctx_state.set(session.state)
+        data['session'] = session
+
+    async def on_post_process_message(self, message, results, data):
+        session = data.get('session')
+        if session is None:
+            return
+        await session.commit()
+
+        self.updates += 1
+        self.round_trips += session.round_trips
+        logger.debug('Update of chat %s: %s state round trips', session.chat, session.round_trips)
+
+    # Live location updates come as edited messages
+    on_pre_process_edited_message = on_pre_process_message
+    on_post_process_edited_message = on_post_process_message
+    # Inline navigation buttons
+    on_post_process_callback_query = on_post_process_message
+
+    @property
+    def stats(self):
+        """
+        Number of processed updates and state round trips per update
+        """
+        return {'updates': self.updates,
+                'round_trips_per_update': self.round_trips / self.updates if self.updates else 0}
@@ -0,0 +1,146 @@
+import asyncio
+import logging
+import secrets
+
+from aiohttp import web
+from aiogram import Bot, types
+from aiogram.dispatcher import Dispatcher
+from aiogram.utils import json
+
+import config
+
+logger = logging.getLogger(__name__)
+
+SECRET_TOKEN_HEADER = 'X-Telegram-Bot-Api-Secret-Token'
+
+# Updates handled by bot (other update types are not sent by Telegram at all)
+ALLOWED_UPDATES = ['message', 'edited_message', 'callback_query']
+
+
+class WebhookServer:
+    """
+    Receives Telegram updates over HTTP. Each update is acknowledged right away and processed in background,
+    number of updates processed at once is limited
+    """
+
+    def __init__(self, dispatcher: Dispatcher, path=None, secret=None, concurrency=None):
+        """
+        :param dispatcher: bot dispatcher
+        :param path: webhook url path
+        :param secret: secret token Telegram sends with every update (config.WEBHOOK_SECRET by default).
+        Random secret is generated when none is configured, it is registered in Telegram on startup
+        :param concurrency: maximum number of updates processed at once
+        """
+        self.dispatcher = dispatcher
+        self.path = path or config.WEBHOOK_PATH
+        # Updates are never accepted without secret: anybody knowing the url could send forged ones
+        self.secret = secret or config.WEBHOOK_SECRET or secrets.token_urlsafe(32)
+        self.concurrency = concurrency or config.WEBHOOK_CONCURRENCY
+        self._semaphore = None
+        self._tasks = set()
+
+    @property
+    def url(self):
+        """
+        Public webhook url registered in Telegram
+        """
+        return config.WEBHOOK_HOST.rstrip('/') + self.path
+
+    async def handle(self, request: web.Request):
+        """
+        Webhook request processing: checks secret token and schedules update processing
+        """
+        token = request.headers.get(SECRET_TOKEN_HEADER, '').encode()
+        if not secrets.compare_digest(token, self.secret.encode()):
+            return web.Response(status=403)
+
+        try:
+            update = types.Update(**await request.json(loads=json.loads))
+        except (ValueError, TypeError):
+            return web.Response(status=400)
+
+        # When all slots are busy acknowledgement is delayed, so Telegram slows down instead of updates piling up
+        await self._semaphore.acquire()
+        task = asyncio.ensure_future(self._process_update(update))
+        self._tasks.add(task)
+        task.add_done_callback(self._tasks.discard)
+
+        return web.Response()
+
+    async def _process_update(self, update: types.Update):
+        Bot.set_current(self.dispatcher.bot)
+        Dispatcher.set_current(self.dispatcher)
+        try:
+            # Through update middlewares, same as polling does
+            await self.dispatcher.updates_handler.notify(update)
+        except Exception:
+            logger.exception('Update %s processing failed', update.update_id)
+        finally:
+            self._semaphore.release()
+
+    async def set_webhook(self):
+        """
+        Registers webhook url and secret token in Telegram
+        """
+        payload = {'url': self.url,
+                   'max_connections': config.WEBHOOK_MAX_CONNECTIONS,
+                   'allowed_updates': json.dumps(ALLOWED_UPDATES),
+                   'secret_token': self.secret}
+        await self.dispatcher.bot.request('setWebhook', payload)
+        logger.info('Webhook set to %s', self.url)
+
+    async def delete_webhook(self):
+        """
+        Removes webhook, so bot can be switched back to polling
+        """
+        await self.dispatcher.bot.delete_webhook()
+        logger.info('Webhook deleted')
+
+    async def wait_closed(self):
+        """
+        Waits until updates being processed are finished
+        """
+        if self._tasks:
+            await asyncio.wait(self._tasks)
+
+    def create_app(self, on_startup=None, on_shutdown=None):
+        """
+        :param on_startup: coroutine function called with dispatcher after webhook is set
+        :param on_shutdown: coroutine function called with dispatcher after all updates are processed
+        :return: aiohttp application
+        """
+        app = web.Application(client_max_size=config.WEBHOOK_MAX_BODY_SIZE)
+        app.router.add_post(self.path, self.handle)
+
+        async def startup(_):
+            self._semaphore = asyncio.Semaphore(self.concurrency)
+            Bot.set_current(self.dispatcher.bot)
+            Dispatcher.set_current(self.dispatcher)
+            await self.set_webhook()
+            if on_startup is not None:
+                await on_startup(self.dispatcher)
+
+        async def shutdown(_):
+            await self.delete_webhook()
+            await self.wait_closed()
+            if on_shutdown is not None:
+                await on_shutdown(self.dispatcher)
+            await self.dispatcher.bot.session.close()
+
+        app.on_startup.append(startup)
+        app.on_shutdown.append(shutdown)
+        return app
+
+
+def start_webhook(dispatcher: Dispatcher, on_startup=None, on_shutdown=None):
+    """
+    Runs bot in webhook mode (blocking)
+    :param dispatcher: bot dispatcher
+    :param on_startup: coroutine function called with dispatcher on startup
+    :param on_shutdown: coroutine function called with dispatcher on shutdown
+    """
+    server = WebhookServer(dispatcher)
+    web.run_app(server.create_app(on_startup=on_startup, on_shutdown=on_shutdown),
+                host=config.WEBAPP_HOST,
+                port=config.WEBAPP_PORT,
+                access_log=None)